@@ -0,0 +1,290 @@
+"""
+Batched enemy AI.
+
+Normally every ControllerComponent subscribes to 'tick' by itself, so each
+tick costs a Python-level dispatch per enemy tank even if most of them are
+just waiting for their movement cooldown. EnemyAISystem keeps the state of
+all enemy controllers in NumPy arrays and updates them in a single pass per
+tick: cooldowns, line of fire and the weighted random choice of direction
+are all computed for the whole batch at once. Only the tanks that actually
+move, turn or shoot this tick are touched from Python.
+
+Requires NumPy. It is only imported when batched AI is requested, so the
+game itself doesn't depend on it.
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.widgets import Listener
+
+import numpy as np
+import random
+
+from entities import ControllerComponent, RoutedComponent
+
+
+# Same order as in ControllerComponent's direction list, which matters only
+# for the RNG stream
+DIRECTIONS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+DIRECTION_INDEX = {d: i for i, d in enumerate(DIRECTIONS)}
+DOWN, UP, RIGHT, LEFT = range(4)
+
+
+class BatchedControllerComponent(ControllerComponent):
+    """
+    A ControllerComponent whose state lives in EnemyAISystem arrays.
+
+    It doesn't subscribe to 'tick'; the system does all the tick processing
+    for it. Collisions are processed by the component itself, exactly like in
+    ControllerComponent. All the controller attributes (cooldowns, delays,
+    direction and the rotation guard) can be read and set as usual.
+
+    These should be created via ``EnemyAISystem.create_controller``.
+    """
+    def __init__(self, *args, ai_system, **kwargs):
+        # Slot should exist before ControllerComponent.__init__ sets the
+        # initial values
+        self.ai_system = ai_system
+        self.slot = ai_system.allocate(self)
+        super().__init__(*args, **kwargs)
+        self.dispatcher.unregister_listener(self, ['tick'])
+
+    @property
+    def owner(self):
+        return self._owner
+
+    @owner.setter
+    def owner(self, value):
+        RoutedComponent.owner.fset(self, value)
+        if value is not None:
+            self.ai_system.owner_slots[value.id] = self.slot
+
+    @property
+    def move_cd(self):
+        return float(self.ai_system.move_cd[self.slot])
+
+    @move_cd.setter
+    def move_cd(self, value):
+        self.ai_system.move_cd[self.slot] = value
+
+    @property
+    def shoot_cd(self):
+        return float(self.ai_system.shoot_cd[self.slot])
+
+    @shoot_cd.setter
+    def shoot_cd(self, value):
+        self.ai_system.shoot_cd[self.slot] = value
+
+    @property
+    def move_delay(self):
+        return float(self.ai_system.move_delay[self.slot])
+
+    @move_delay.setter
+    def move_delay(self, value):
+        self.ai_system.move_delay[self.slot] = value
+
+    @property
+    def shoot_delay(self):
+        return float(self.ai_system.shoot_delay[self.slot])
+
+    @shoot_delay.setter
+    def shoot_delay(self, value):
+        self.ai_system.shoot_delay[self.slot] = value
+
+    @property
+    def weight_distance(self):
+        return float(self.ai_system.weight_distance[self.slot])
+
+    @weight_distance.setter
+    def weight_distance(self, value):
+        self.ai_system.weight_distance[self.slot] = value
+
+    @property
+    def rotated_this_tick(self):
+        return bool(self.ai_system.rotated[self.slot])
+
+    @rotated_this_tick.setter
+    def rotated_this_tick(self, value):
+        self.ai_system.rotated[self.slot] = value
+
+    @property
+    def direction(self):
+        d = self.ai_system.direction[self.slot]
+        return DIRECTIONS[d] if d >= 0 else None
+
+    @direction.setter
+    def direction(self, value):
+        self.ai_system.direction[self.slot] = \
+            DIRECTION_INDEX[value] if value is not None else -1
+
+
+class EnemyAISystem(Listener):
+    """
+    Updates all enemy controllers in one pass per tick.
+
+    Should be subscribed to 'tick' and 'ecs_destroy', after the enemy spawner
+    (so that the tanks spawned during a tick get that tick, just like
+    ControllerComponents would).
+
+    The behaviour is that of ControllerComponent: when the movement cooldown is
+    over, a tank that has a line of fire to the player (not blocked by walls,
+    if it has a line of sight index) turns towards them, moves and (if the
+    shooting cooldown is over) shoots; a tank that has a flow field follows
+    it; a tank without a direction picks a random one, weighted towards the
+    player. The random choices come from the system's own NumPy generator,
+    which is seeded from the global RNG unless ``seed`` is set.
+
+    :param capacity: initial array size. Arrays grow as necessary.
+
+    :param seed: seed for the direction RNG.
+    """
+    def __init__(self, *args, capacity=16, seed=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.rng = np.random.default_rng(seed)
+        self.controllers = [None] * capacity
+        self.active = np.zeros(capacity, dtype=bool)
+        self.move_cd = np.zeros(capacity)
+        self.shoot_cd = np.zeros(capacity)
+        self.move_delay = np.zeros(capacity)
+        self.shoot_delay = np.zeros(capacity)
+        self.weight_distance = np.ones(capacity)
+        self.rotated = np.zeros(capacity, dtype=bool)
+        # -1 for no direction, otherwise index in DIRECTIONS
+        self.direction = np.full(capacity, -1, dtype=np.int8)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        # {entity_id: slot}
+        self.owner_slots = {}
+
+    def create_controller(self, dispatcher, **kwargs):
+        """
+        Create a new enemy controller managed by this system.
+
+        kwargs are passed to BatchedControllerComponent.
+        """
+        return BatchedControllerComponent(dispatcher, ai_system=self, **kwargs)
+
+    def allocate(self, controller):
+        """
+        Reserve an array slot for the controller and return its index
+        """
+        if not self.free_slots:
+            self._grow()
+        slot = self.free_slots.pop()
+        self.controllers[slot] = controller
+        self.active[slot] = True
+        self.rotated[slot] = False
+        self.direction[slot] = -1
+        return slot
+
+    def release(self, slot):
+        self.controllers[slot] = None
+        self.active[slot] = False
+        self.free_slots.append(slot)
+
+    def _grow(self):
+        old = len(self.controllers)
+        new = old * 2
+        self.controllers.extend([None] * old)
+        for name in ('active', 'move_cd', 'shoot_cd', 'move_delay',
+                     'shoot_delay', 'weight_distance', 'rotated', 'direction'):
+            array = getattr(self, name)
+            grown = np.resize(array, new)
+            grown[old:] = -1 if name == 'direction' else \
+                1 if name == 'weight_distance' else 0
+            setattr(self, name, grown)
+        # Lower slots are handed out first
+        self.free_slots = list(range(new - 1, old - 1, -1)) + self.free_slots
+
+    def __len__(self):
+        return len(self.owner_slots)
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_destroy':
+            slot = self.owner_slots.pop(event.event_value, None)
+            if slot is not None:
+                self.release(slot)
+        elif event.event_type == 'tick':
+            self.process_tick(event.event_value)
+
+    def process_tick(self, dt):
+        self.rotated[:] = False
+        self.move_cd -= dt
+        self.shoot_cd -= dt
+        acting = np.flatnonzero(self.active & (self.move_cd <= 0))
+        if len(acting) == 0:
+            return
+        try:
+            player = EntityTracker().entities['player']
+        except KeyError:
+            # DO NOTHING AFTER THE PLAYER IS DEAD
+            return
+        controllers = [self.controllers[i] for i in acting]
+        positions = np.array([c.owner.position.pos for c in controllers],
+                             dtype=np.int64).reshape(-1, 2)
+        dx = player.position.x - positions[:, 0]
+        dy = player.position.y - positions[:, 1]
+        direction = self.direction[acting]
+        # Turn towards player if has direct line of fire. Horizontal line
+        # takes precedence, like in ControllerComponent
+        vertical_line = np.abs(dx) < 3
+        horizontal_line = np.abs(dy) < 3
+        for i in np.flatnonzero(vertical_line | horizontal_line):
+            # Only aligned tanks need the (O(1), but not vectorized) line of
+            # sight check
+            if controllers[i].line_of_sight is not None:
+                vertical_line[i], horizontal_line[i] = \
+                    controllers[i].lines_of_fire(int(dx[i]), int(dy[i]))
+        direction[vertical_line] = np.where(dy[vertical_line] > 0, DOWN, UP)
+        direction[horizontal_line] = np.where(dx[horizontal_line] > 0,
+                                              RIGHT, LEFT)
+        line_of_fire = vertical_line | horizontal_line
+        # Flow field lookups are O(1) each, but not vectorized
+        followed = np.zeros(len(acting), dtype=bool)
+        for i in np.flatnonzero(~line_of_fire):
+            controller = controllers[i]
+            if controller.flow_field is None:
+                continue
+            if controller.detour_left > 0:
+                controller.detour_left -= 1
+                continue
+            d = controller.flow_field.direction(int(positions[i, 0]),
+                                                int(positions[i, 1]))
+            if d is not None and DIRECTION_INDEX[d] != direction[i]:
+                direction[i] = DIRECTION_INDEX[d]
+                followed[i] = True
+        moving = direction >= 0
+        shooting = moving & line_of_fire & (self.shoot_cd[acting] <= 0)
+        # Weighted random direction for those who have none. Every direction
+        # has a weight of 1, plus one for every weight_distance chars to the
+        # player along it
+        choosing = np.flatnonzero(~moving)
+        if len(choosing):
+            cdx = dx[choosing]
+            cdy = dy[choosing]
+            distance = self.weight_distance[acting[choosing]]
+            weights = np.ones((len(choosing), 4), dtype=np.int64)
+            weights[:, DOWN] += np.where(cdy > 0, cdy // distance, 0)\
+                .astype(np.int64)
+            weights[:, UP] += np.where(cdy < 0, -cdy // distance, 0)\
+                .astype(np.int64)
+            weights[:, RIGHT] += np.where(cdx > 0, cdx // distance, 0)\
+                .astype(np.int64)
+            weights[:, LEFT] += np.where(cdx < 0, -cdx // distance, 0)\
+                .astype(np.int64)
+            cumulative = weights.cumsum(axis=1)
+            picks = self.rng.random(len(choosing)) * cumulative[:, -1]
+            direction[choosing] = (picks[:, None] < cumulative).argmax(axis=1)
+        self.direction[acting] = direction
+        self.move_cd[acting] = self.move_delay[acting]
+        # Only tanks that actually do something are processed in Python
+        turned = line_of_fire | ~moving | followed
+        for i in np.flatnonzero(turned | moving):
+            controller = controllers[i]
+            d = DIRECTIONS[direction[i]]
+            if turned[i]:
+                controller.owner.widget.switch_to_image(controller.images[d])
+            if moving[i]:
+                controller.owner.position.relative_move(*d)
+                if shooting[i]:
+                    controller.shoot()
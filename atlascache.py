@@ -0,0 +1,212 @@
+"""
+Decoded atlas cache.
+
+Every launch, Atlas parses the whole .xp file (gunzip, then a Python loop over
+every cell of every layer) the first time any image is requested, and slices
+the elements out of the result. CachedAtlas does this once, stores all the
+elements pre-decoded in a binary file next to the .xp, and afterwards only
+maps that file into memory and decodes the elements that are actually asked
+for. The cache is keyed by a hash of the .xp and .json contents, so it is
+rebuilt automatically whenever either of them changes.
+
+Cache format (all numbers little-endian): ``b'ACAT'``, version (uint8), key
+(16 bytes), number of elements and colors (2 uint16). Then the colors, each
+as length (uint8) and ASCII string, and the elements, each as name length
+(uint8), name, region (4 uint16: x, y, xsize, ysize) and the offset of its
+cells (uint32) from the start of the file. Cells are row by row, each a
+codepoint (uint32) and color index (uint16, NO_COLOR for None).
+"""
+
+from bear_hug.resources import Atlas, XpLoader
+
+from hashlib import blake2b
+import mmap
+import os
+import struct
+
+
+MAGIC = b'ACAT'
+VERSION = 1
+NO_COLOR = 0xFFFF
+
+_HEADER = struct.Struct('<4sB16sHH')
+_ENTRY = struct.Struct('<HHHHI')
+_CELL = struct.Struct('<IH')
+
+
+def source_key(xp_path, json_path):
+    """
+    Hash the atlas sources.
+
+    :returns: 16 bytes
+    """
+    h = blake2b(digest_size=16)
+    h.update(bytes((VERSION,)))
+    for path in (xp_path, json_path):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+def encode_atlas(atlas, key):
+    """
+    Decode every element of an Atlas and pack them all into the cache format.
+
+    :param atlas: Atlas
+
+    :param key: ``source_key`` of the atlas sources
+
+    :returns: bytes
+    """
+    elements = {name: atlas.get_element(name) for name in atlas.elements}
+    colors = {}
+    for _, element_colors in elements.values():
+        for row in element_colors:
+            for color in row:
+                if color is not None and color not in colors:
+                    colors[color] = len(colors)
+    head = [None, b''.join(bytes((len(x),)) + x.encode('ascii')
+                           for x in colors)]
+    names = [name.encode() for name in elements]
+    size = _HEADER.size + len(head[1]) + \
+        sum(1 + len(x) + _ENTRY.size for x in names)
+    cells = []
+    for encoded, (name, (chars, element_colors)) in zip(names,
+                                                       elements.items()):
+        head.append(bytes((len(encoded),)) + encoded)
+        head.append(_ENTRY.pack(*atlas.elements[name], size))
+        for char_row, color_row in zip(chars, element_colors):
+            for char, color in zip(char_row, color_row):
+                cells.append(_CELL.pack(
+                    ord(char), NO_COLOR if color is None else colors[color]))
+        size += len(chars) * len(chars[0]) * _CELL.size
+    head[0] = _HEADER.pack(MAGIC, VERSION, key, len(elements), len(colors))
+    return b''.join(head) + b''.join(cells)
+
+
+class CachedAtlas(Atlas):
+    """
+    An Atlas that keeps its elements pre-decoded in a cache file.
+
+    It can be used anywhere an Atlas can: ``elements`` is the same dict of
+    regions, and ``get_element`` returns new (chars, colors) lists every time.
+
+    If the cache file is missing, damaged or made for different sources, the
+    atlas is decoded as usual and the cache is written anew. ``rebuilt`` is
+    True if that was the case. If the cache can't be written (eg the
+    directory is read-only), the decoded elements are just kept in memory.
+
+    :param xp_path: path to a .xp file
+
+    :param json_path: path to a JSON file with element regions, like for Atlas
+
+    :param cache_path: where to keep the cache. Defaults to the .xp path with
+    the extension changed to .atlascache
+    """
+    def __init__(self, xp_path, json_path, cache_path=None):
+        self.xp_path = xp_path
+        self.json_path = json_path
+        self.cache_path = cache_path or \
+            os.path.splitext(xp_path)[0] + '.atlascache'
+        self.loader = None
+        self.key = source_key(xp_path, json_path)
+        self.rebuilt = False
+        # {name: offset of the cells}
+        self.offsets = {}
+        self.colors = []
+        self.data = self._read_cache()
+        if self.data is None:
+            self.rebuild()
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Also ValueError for an empty file, which can't be mapped
+            return None
+        try:
+            self._parse(data)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+            data.close()
+            return None
+        return data
+
+    def _parse(self, data):
+        magic, version, key, element_count, color_count = \
+            _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or key != self.key:
+            raise ValueError('Stale or foreign atlas cache')
+        offset = _HEADER.size
+        colors = []
+        for _ in range(color_count):
+            length = data[offset]
+            colors.append(
+                data[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+        elements = {}
+        offsets = {}
+        for _ in range(element_count):
+            length = data[offset]
+            name = data[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+            *region, cells = _ENTRY.unpack_from(data, offset)
+            offset += _ENTRY.size
+            if cells + region[2] * region[3] * _CELL.size > len(data):
+                raise ValueError('Truncated atlas cache')
+            elements[name] = tuple(region)
+            offsets[name] = cells
+        self.colors = colors
+        self.elements = elements
+        self.offsets = offsets
+
+    def rebuild(self):
+        """
+        Decode the sources and write the cache anew
+        """
+        atlas = Atlas(XpLoader(self.xp_path), self.json_path)
+        self.loader = atlas.loader
+        data = encode_atlas(atlas, self.key)
+        self._parse(data)
+        self.data = data
+        self.rebuilt = True
+        # Written under a temporary name and then renamed, so that another
+        # process never sees a half-written cache
+        temp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def get_element(self, name):
+        """
+        Return an element with a given name.
+
+        If nothing with this name was described in JSON file, raises KeyError
+
+        :param name: A sub-image ID.
+        :returns: A region (chars, colors)
+        """
+        _, _, xsize, ysize = self.elements[name]
+        offset = self.offsets[name]
+        colors = self.colors
+        cells = _CELL.iter_unpack(
+            self.data[offset:offset + xsize * ysize * _CELL.size])
+        chars = []
+        element_colors = []
+        for _ in range(ysize):
+            char_row = []
+            color_row = []
+            for _ in range(xsize):
+                codepoint, color = next(cells)
+                char_row.append(chr(codepoint))
+                color_row.append(None if color == NO_COLOR
+                                 else colors[color])
+            chars.append(char_row)
+            element_colors.append(color_row)
+        return chars, element_colors
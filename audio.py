@@ -0,0 +1,245 @@
+"""
+Sound mixer.
+
+bear_hug's SoundListener starts a separate simpleaudio playback for every
+'play_sound' event, right in the game loop. In a firefight that's dozens of
+overlapping playbacks a second. Mixer decodes every sound once, collects the
+requests over a tick (so that ten tanks shooting at once make a single shot
+sound), and leaves the mixing and playback to a background thread. The game
+loop only ever puts a tuple of names into a queue.
+
+There is never more than one playback at a time: whenever new sounds arrive,
+the thread mixes them with whatever is still playing (up to ``max_voices``
+voices, the oldest ones are dropped first) and restarts the output with the
+result.
+
+Requires NumPy. The backends are ``SimpleAudioBackend`` (requires
+simpleaudio) and ``NullBackend``, which plays nothing, for headless runs.
+"""
+
+from bear_hug.bear_utilities import BearSoundException
+from bear_hug.widgets import Listener
+
+import numpy as np
+import queue
+import threading
+import sys
+import time
+import traceback
+import wave
+
+
+def load_wav(path):
+    """
+    Decode a 16-bit WAV file.
+
+    :returns: a tuple of (samples, sample rate), where samples is an int16
+    array of shape (frames, channels).
+    """
+    with wave.open(path, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise BearSoundException(f'{path} is not a 16-bit WAV')
+        channels = f.getnchannels()
+        rate = f.getframerate()
+        data = f.readframes(f.getnframes())
+    samples = np.frombuffer(data, dtype='<i2').astype(np.int16)
+    return samples.reshape(-1, channels), rate
+
+
+################################################################################
+# Backends
+################################################################################
+
+
+class NullBackend:
+    """
+    A backend that plays nothing.
+
+    It remembers how many buffers it was asked to play and how long they
+    were, and keeps the latest buffer in ``last``.
+    """
+    def __init__(self):
+        self.plays = 0
+        self.frames = 0
+        self.last = None
+
+    def play(self, samples, sample_rate):
+        self.plays += 1
+        self.frames += len(samples)
+        self.last = samples
+
+    def stop(self):
+        pass
+
+
+class SimpleAudioBackend:
+    """
+    Plays the buffers via simpleaudio. A new buffer stops the previous one.
+    """
+    def __init__(self):
+        import simpleaudio
+        self.simpleaudio = simpleaudio
+        self.play_object = None
+
+    def play(self, samples, sample_rate):
+        self.stop()
+        self.play_object = self.simpleaudio.play_buffer(
+            np.ascontiguousarray(samples), samples.shape[1], 2, sample_rate)
+
+    def stop(self):
+        if self.play_object is not None:
+            self.play_object.stop()
+            self.play_object = None
+
+
+################################################################################
+# Mixer
+################################################################################
+
+
+class Mixer(Listener):
+    """
+    Plays sounds on a background thread.
+
+    Accepts the same events as SoundListener:
+    ``BearEvent(event_type='play_sound', event_value=sound_name)``, and should
+    also be subscribed to 'service'. All sounds requested during a tick are
+    sent to the mixing thread at 'tick_over', each one only once.
+
+    All the sounds should have the same sample rate and number of channels
+    (mono sounds are played on every channel of a stereo mixer).
+
+    ``requests`` is the number of 'play_sound' events received, ``merged``
+    the number of them that were dropped as duplicates within a tick and
+    ``dropped`` the number of voices cut short because of ``max_voices``.
+    ``errors`` is the number of mixes that failed (eg because of a device
+    error). Their tracebacks are printed to stderr, and the thread goes on
+    with the next mix.
+
+    :param sounds: a dict of ``{sound name: path to a .wav file}``
+
+    :param backend: where to send the mixed audio. Defaults to
+    SimpleAudioBackend.
+
+    :param max_voices: maximum number of sounds played at once.
+    """
+    def __init__(self, sounds, backend=None, max_voices=8):
+        super().__init__()
+        self.backend = backend if backend is not None \
+            else SimpleAudioBackend()
+        self.max_voices = max_voices
+        self.sounds = {}
+        self.sample_rate = None
+        self.channels = None
+        for sound_name, path in sounds.items():
+            self.register_sound(path, sound_name)
+        self.pending = set()
+        self.requests = 0
+        self.merged = 0
+        self.dropped = 0
+        self.errors = 0
+        # Everything below is used by the mixing thread only
+        self.voices = []
+        self.started = time.monotonic()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='Mixer')
+        self.thread.start()
+
+    def register_sound(self, path, sound_name):
+        """
+        Decode and register a new sound.
+
+        :param path: path to a .wav file
+
+        :param sound_name: name of this sound.
+        """
+        if sound_name in self.sounds:
+            raise BearSoundException(f'Duplicate sound name "{sound_name}"')
+        samples, rate = load_wav(path)
+        if self.sample_rate is None:
+            self.sample_rate = rate
+            self.channels = samples.shape[1]
+        elif rate != self.sample_rate:
+            raise BearSoundException(
+                f'{path} is {rate} Hz, expected {self.sample_rate}')
+        if samples.shape[1] != self.channels:
+            if samples.shape[1] != 1:
+                raise BearSoundException(
+                    f'{path} has {samples.shape[1]} channels, expected '
+                    f'{self.channels}')
+            samples = np.repeat(samples, self.channels, axis=1)
+        self.sounds[sound_name] = samples
+
+    def play_sound(self, sound_name):
+        """
+        Request a sound, to be played after the current tick is over.
+
+        :param sound_name: A sound to play.
+        """
+        if sound_name not in self.sounds:
+            raise BearSoundException(
+                f'Nonexistent sound {sound_name} requested')
+        self.requests += 1
+        if sound_name in self.pending:
+            self.merged += 1
+        else:
+            self.pending.add(sound_name)
+
+    def on_event(self, event):
+        if event.event_type == 'play_sound':
+            self.play_sound(event.event_value)
+        elif event.event_type == 'service' and \
+                event.event_value == 'tick_over' and self.pending:
+            # Sorted so that the mix doesn't depend on the set order
+            self.queue.put(tuple(sorted(self.pending)))
+            self.pending = set()
+
+    def wait(self):
+        """
+        Block until the mixing thread has processed everything sent so far
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Stop the playback and the mixing thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.backend.stop()
+
+    def _run(self):
+        while True:
+            names = self.queue.get()
+            try:
+                if names is None:
+                    return
+                self._mix(names)
+            except Exception:
+                # The game should go on without sound rather than with a
+                # dead mixer, which would also block wait() forever
+                self.errors += 1
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def _mix(self, names):
+        # Whatever is still playing continues from where it is now
+        now = time.monotonic()
+        elapsed = int((now - self.started) * self.sample_rate)
+        voices = [(samples, offset + elapsed)
+                  for samples, offset in self.voices
+                  if offset + elapsed < len(samples)]
+        voices.extend((self.sounds[name], 0) for name in names)
+        if len(voices) > self.max_voices:
+            self.dropped += len(voices) - self.max_voices
+            voices = voices[-self.max_voices:]
+        length = max(len(samples) - offset for samples, offset in voices)
+        mix = np.zeros((length, self.channels), dtype=np.int32)
+        for samples, offset in voices:
+            mix[:len(samples) - offset] += samples[offset:]
+        np.clip(mix, -32768, 32767, out=mix)
+        self.backend.play(mix.astype(np.int16), self.sample_rate)
+        self.voices = voices
+        self.started = now
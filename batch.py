@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+"""
+Batch runner for headless matches.
+
+Runs lots of independent headless games, with different seeds and AI/spawner
+parameters, across a process pool. EntityTracker is a process-global
+singleton, so there is never more than one game per process: every worker
+loads its own atlas once and then plays its matches one after another, each
+with a fresh dispatcher and tracker.
+
+Results are written to a JSON-lines file as soon as every match finishes, so
+a long batch can be watched (or interrupted) while it runs.
+
+Usage:
+
+``python3 batch.py --seeds 50 --move-delay 0.1 0.2 --enemies 3 6
+--output results.jsonl``
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.widgets import Listener
+
+from itertools import product
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from headless import HeadlessGame, load_atlas
+from tags import EntityIndex, Tag
+
+
+# Parameters that go to enemy controllers; everything else is a build_world
+# kwarg
+CONTROLLER_PARAMS = ('move_delay', 'shoot_delay', 'weight_distance')
+
+# Result keys that are measured, rather than set
+MEASUREMENTS = ('survival_time', 'survived', 'score', 'kills', 'player_shots',
+                'enemy_shots', 'ticks', 'ticks_per_second')
+
+# Keys that the random player can press
+PLAYER_KEYS = ('TK_SPACE', 'TK_W', 'TK_A', 'TK_S', 'TK_D')
+
+
+class MatchStats(Listener):
+    """
+    Counts shots and kills, and notices when the player dies.
+
+    Should be subscribed to 'ecs_create', 'ecs_destroy' and 'tick'. Every
+    bullet, new or taken from the pool, is announced by 'ecs_create', and
+    its side is told by its tags. Should be subscribed after the EntityIndex.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticks = 0
+        self.sim_time = 0
+        self.player_shots = 0
+        self.enemy_shots = 0
+        self.kills = 0
+        # Simulated time of player's death, if any
+        self.death_time = None
+
+    def on_event(self, event):
+        if event.event_type == 'tick':
+            self.ticks += 1
+            self.sim_time += event.event_value
+        elif event.event_type == 'ecs_create':
+            index = EntityIndex()
+            entity_id = event.event_value.id
+            if index.is_a(entity_id, Tag.ENEMY_BULLET):
+                self.enemy_shots += 1
+            elif index.is_a(entity_id, Tag.PLAYER_BULLET):
+                self.player_shots += 1
+        elif event.event_type == 'ecs_destroy':
+            if event.event_value == 'player':
+                self.death_time = self.sim_time
+            elif EntityIndex().is_a(event.event_value, Tag.ENEMY_TANK):
+                self.kills += 1
+
+
+class RandomPlayer:
+    """
+    An input script for HeadlessTerminal that holds random keys.
+
+    Every ``hold`` ticks picks a new key (or none) to hold until the next
+    pick.
+
+    :param seed: seed for its own RNG, so that the game's RNG is unaffected.
+    """
+    def __init__(self, seed, hold=10):
+        self.rng = random.Random(seed)
+        self.hold = hold
+        self.key = None
+
+    def __call__(self, tick):
+        if tick % self.hold == 0:
+            self.key = self.rng.choice(PLAYER_KEYS + (None,))
+        return (self.key,) if self.key else ()
+
+
+################################################################################
+# Workers
+################################################################################
+
+# Each worker process has its own atlas, loaded once
+_atlas = None
+
+
+def _init_worker():
+    global _atlas
+    _atlas = load_atlas()
+
+
+def run_match(match):
+    """
+    Play a single match and return its results.
+
+    :param match: a dict with ``seed`` and any of: ``seconds`` (simulated
+    match length, 300 by default), ``fps``, ``player`` (``'idle'`` or
+    ``'random'``), controller parameters (see CONTROLLER_PARAMS) and
+    ``build_world`` kwargs (eg ``enemies`` or ``spawner_cooldown``).
+
+    :returns: a dict with the match itself plus ``survival_time`` (simulated
+    seconds the player stayed alive, which is the match length if they
+    survived), ``survived``, ``score``, ``kills``, ``player_shots``,
+    ``enemy_shots``, ``ticks`` and ``ticks_per_second`` (wall clock).
+    The match is stopped as soon as the player dies.
+    """
+    global _atlas
+    if _atlas is None:
+        _atlas = load_atlas()
+    params = dict(match)
+    seed = params.pop('seed')
+    seconds = params.pop('seconds', 300)
+    fps = params.pop('fps', 30)
+    player = params.pop('player', 'idle')
+    controller_params = {x: params.pop(x) for x in CONTROLLER_PARAMS
+                         if x in params}
+    input_script = RandomPlayer(seed) if player == 'random' else None
+    game = HeadlessGame(atlas=_atlas, seed=seed, fps=fps,
+                        input_script=input_script,
+                        controller_params=controller_params, **params)
+    stats = MatchStats()
+    game.dispatcher.register_listener(stats,
+                                      ['ecs_create', 'ecs_destroy', 'tick'])
+    ticks = round(seconds * fps)
+    start = time.perf_counter()
+    while game.loop.ticks < ticks and stats.death_time is None:
+        game.loop.step()
+    elapsed = time.perf_counter() - start
+    r = dict(match)
+    survived = stats.death_time is None
+    r.update({'survival_time': game.loop.sim_time if survived
+              else stats.death_time,
+              'survived': survived,
+              'score': game.world.score.score,
+              'kills': stats.kills,
+              'player_shots': stats.player_shots,
+              'enemy_shots': stats.enemy_shots,
+              'ticks': game.loop.ticks,
+              'ticks_per_second': game.loop.ticks / elapsed if elapsed else 0})
+    # Let the next match start with an empty tracker
+    EntityTracker().entities = {}
+    return r
+
+
+################################################################################
+# Batches
+################################################################################
+
+
+def parameter_grid(seeds, **axes):
+    """
+    Build a list of matches for every combination of parameters and seeds.
+
+    :param seeds: an iterable of seeds. Every parameter set is played once
+    per seed.
+
+    :param axes: ``{parameter: list of values}``. Parameters with a single
+    value can be given as is.
+
+    :returns: a list of match dicts for ``run_match``
+    """
+    names = list(axes)
+    values = [x if isinstance(x, (list, tuple)) else [x]
+              for x in axes.values()]
+    return [dict(zip(names, combination), seed=seed)
+            for combination in product(*values) for seed in seeds]
+
+
+def run_batch(matches, output, processes=None):
+    """
+    Play all the matches on a process pool.
+
+    Results are appended to ``output`` (one JSON object per line) in the
+    order the matches finish, and flushed immediately.
+
+    :param matches: an iterable of match dicts, see ``run_match``
+
+    :param output: a path to the results file
+
+    :param processes: number of worker processes. Defaults to CPU count.
+
+    :returns: a list of result dicts
+    """
+    results = []
+    with open(output, 'a') as f, \
+            multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        for r in pool.imap_unordered(run_match, matches):
+            f.write(json.dumps(r) + '\n')
+            f.flush()
+            results.append(r)
+    return results
+
+
+def aggregate(results):
+    """
+    Average the results of every parameter set over its seeds.
+
+    :returns: a list of ``(params, averages)``, where params is a dict of
+    everything in the match but the seed, and averages is a dict of mean
+    results plus ``matches``, the number of seeds.
+    """
+    groups = {}
+    for r in results:
+        params = {x: r[x] for x in r if x not in MEASUREMENTS and x != 'seed'}
+        groups.setdefault(json.dumps(params, sort_keys=True), []).append(r)
+    summary = []
+    for key, runs in sorted(groups.items()):
+        averages = {x: sum(float(run[x]) for run in runs) / len(runs)
+                    for x in MEASUREMENTS}
+        averages['matches'] = len(runs)
+        summary.append((json.loads(key), averages))
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Play lots of headless AsciiCity matches in parallel. '
+                    'Every combination of parameter values is played with '
+                    'every seed')
+    parser.add_argument('--seeds', type=int, default=10,
+                        help='Number of seeds per parameter set')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--seconds', type=float, default=300,
+                        help='Simulated match length')
+    parser.add_argument('--player', choices=('idle', 'random'),
+                        default='idle')
+    parser.add_argument('--move-delay', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--shoot-delay', type=float, nargs='+', default=[1])
+    parser.add_argument('--weight-distance', type=float, nargs='+',
+                        default=[10])
+    parser.add_argument('--cooldown', type=float, nargs='+', default=[5.0],
+                        help='Enemy spawner cooldown')
+    parser.add_argument('--enemies', type=int, nargs='+', default=[3])
+    parser.add_argument('--batched-ai', action='store_true')
+    parser.add_argument('--pathfinding', action='store_true')
+    parser.add_argument('--line-of-sight', action='store_true')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Worker processes. Defaults to CPU count')
+    parser.add_argument('--output', default='batch.jsonl',
+                        help='JSON lines file to append results to')
+    args = parser.parse_args()
+    matches = parameter_grid(
+        range(args.first_seed, args.first_seed + args.seeds),
+        seconds=args.seconds, player=args.player,
+        move_delay=args.move_delay, shoot_delay=args.shoot_delay,
+        weight_distance=args.weight_distance,
+        spawner_cooldown=args.cooldown, enemies=args.enemies,
+        batched_ai=args.batched_ai, pathfinding=args.pathfinding,
+        line_of_sight=args.line_of_sight)
+    start = time.perf_counter()
+    results = run_batch(matches, args.output, processes=args.processes)
+    elapsed = time.perf_counter() - start
+    print(f'{len(results)} matches in {elapsed:.1f} s '
+          f'({sum(x["ticks"] for x in results) / elapsed:.0f} ticks/s total)',
+          file=sys.stderr)
+    for params, averages in aggregate(results):
+        varying = ', '.join(f'{x}={params[x]}' for x in
+                            ('move_delay', 'shoot_delay', 'weight_distance',
+                             'spawner_cooldown', 'enemies'))
+        print(f'{varying}: survival {averages["survival_time"]:.1f} s, '
+              f'survived {averages["survived"]:.0%}, '
+              f'score {averages["score"]:.1f}, '
+              f'shots {averages["player_shots"]:.1f}/'
+              f'{averages["enemy_shots"]:.1f}, '
+              f'{averages["ticks_per_second"]:.0f} ticks/s')
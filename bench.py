@@ -0,0 +1,706 @@
+#! /usr/bin/env python3
+"""
+Benchmark suite.
+
+Builds headless games of increasing size and measures how long every tick
+takes to process. Every scenario is a function that accepts a single size
+parameter and returns a ready HeadlessGame; the suite runs each of them for
+a bunch of sizes and reports per-tick time percentiles, events per tick and
+peak memory as JSON.
+
+Usage:
+
+``python3 bench.py --output before.json``
+
+``python3 bench.py --output after.json --compare before.json``
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.ecs_widgets import ECSLayout
+from bear_hug.widgets import Listener
+
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from entities import create_enemy_tank, create_bullet, create_wall
+from headless import HeadlessGame, load_atlas
+from snapshot import Snapshotter, Snapshot
+from spatial import GridECSLayout
+from world import WALL_ARRAY, TILE_SIZE, MAP_WIDTH, MAP_HEIGHT
+
+
+# Tiles that should never be taken by walls or benchmark tanks: the ones under
+# the player's starting position and the spawner house
+RESERVED_TILES = {(5, 8), (5, 9), (6, 8), (6, 9), (5, 0), (6, 0), (7, 0)}
+GRID_WIDTH = MAP_WIDTH // TILE_SIZE
+GRID_HEIGHT = MAP_HEIGHT // TILE_SIZE
+
+
+################################################################################
+# Helper listeners
+################################################################################
+
+
+class EventCounter(Listener):
+    """
+    Counts all events that pass through the dispatcher.
+
+    Should be subscribed to 'all' after all event types are registered.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = 0
+
+    def on_event(self, event):
+        self.count += 1
+
+
+class PlainSimulationLayout(ECSLayout):
+    """
+    SimulationLayout without the spatial index, to compare against
+    """
+    def _rebuild_self(self):
+        pass
+
+
+class BulletStorm(Listener):
+    """
+    Keeps a given number of bullets in flight.
+
+    Every tick, if there are less than ``bullets`` storm bullets alive, creates
+    new ones at random places, flying in random directions. If ``bullet_pool``
+    is set, bullets are taken from it.
+    """
+    def __init__(self, *args, dispatcher, bullets, rng, bullet_pool=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = dispatcher
+        self.bullet_pool = bullet_pool
+        self.bullets = bullets
+        self.rng = rng
+        self.alive = set()
+        self.counter = 0
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_destroy':
+            self.alive.discard(event.event_value)
+        elif event.event_type == 'tick':
+            while len(self.alive) < self.bullets:
+                direction = self.rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+                bullet_args = (self.rng.randrange(1, MAP_WIDTH - 1),
+                               self.rng.randrange(1, MAP_HEIGHT - 1),
+                               direction[0] * 20, direction[1] * 20)
+                if self.bullet_pool:
+                    bullet_id = self.bullet_pool.fire('storm_bullet',
+                                                      *bullet_args).id
+                else:
+                    bullet_id = f'storm_bullet{self.counter}'
+                    create_bullet(self.dispatcher, bullet_id, *bullet_args)
+                self.alive.add(bullet_id)
+                self.counter += 1
+
+
+class PlayerMover(Listener):
+    """
+    Moves the player to a random free tile every ``interval`` ticks, so that
+    the flow field has to follow them. A player that is actually driving
+    enters a new tile every 6 ticks at best.
+    """
+    def __init__(self, *args, tiles, rng, interval=6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tiles = tiles
+        self.rng = rng
+        self.interval = interval
+        self.ticks = 0
+
+    def on_event(self, event):
+        self.ticks += 1
+        if self.ticks % self.interval == 0:
+            x, y = self.rng.choice(self.tiles)
+            EntityTracker().entities['player'].position.move(x * TILE_SIZE,
+                                                             y * TILE_SIZE)
+
+
+################################################################################
+# Scenarios
+################################################################################
+
+
+def free_tiles(wall_array):
+    return [(x, y) for y in range(GRID_HEIGHT) for x in range(GRID_WIDTH)
+            if not wall_array[y][x] and (x, y) not in RESERVED_TILES]
+
+
+def make_immortal(game):
+    """
+    Process the creation events and give the player a lot of HP, so that the
+    enemies don't stop moving after the player dies.
+    """
+    game.dispatcher.dispatch_events()
+    EntityTracker().entities['player'].health.hitpoints = 10 ** 6
+
+
+def tanks_scenario(n, atlas, seed, wall_array=None, **game_kwargs):
+    """
+    N enemy tanks on an empty map. Spawner keeps replacing the dead ones.
+    """
+    if wall_array is None:
+        wall_array = [[0 for _ in range(GRID_WIDTH)]
+                      for _ in range(GRID_HEIGHT)]
+    game = HeadlessGame(atlas=atlas, seed=seed,
+                        wall_array=wall_array, enemies=n, **game_kwargs)
+    make_immortal(game)
+    tiles = free_tiles(wall_array)
+    random.Random(seed).shuffle(tiles)
+    if n > len(tiles):
+        raise ValueError(f'Cannot place {n} tanks on {len(tiles)} tiles')
+    for i, (x, y) in enumerate(tiles[:n]):
+        create_enemy_tank(game.dispatcher, atlas, f'enemy_bench{i}',
+                          x * TILE_SIZE, y * TILE_SIZE,
+                          ai_system=game.world.ai_system,
+                          bullet_pool=game.world.bullet_pool)
+    game.world.spawner.enemies_current = n
+    return game
+
+
+def chase_scenario(n, atlas, seed, **game_kwargs):
+    """
+    N enemy tanks on the default level, chasing a player who keeps changing
+    tiles. Meant for ``--pathfinding``, where every player's move rebuilds
+    the flow field.
+    """
+    game = tanks_scenario(n, atlas, seed, wall_array=WALL_ARRAY,
+                          **game_kwargs)
+    mover = PlayerMover(tiles=free_tiles(WALL_ARRAY),
+                        rng=random.Random(seed))
+    game.dispatcher.register_listener(mover, 'tick')
+    return game
+
+
+def bullets_scenario(m, atlas, seed, **game_kwargs):
+    """
+    M bullets constantly in flight over the default level.
+    """
+    game = HeadlessGame(atlas=atlas, seed=seed, **game_kwargs)
+    make_immortal(game)
+    storm = BulletStorm(dispatcher=game.dispatcher, bullets=m,
+                        rng=random.Random(seed),
+                        bullet_pool=game.world.bullet_pool)
+    game.dispatcher.register_listener(storm, ['tick', 'ecs_destroy'])
+    return game
+
+
+def walls_scenario(density, atlas, seed, **game_kwargs):
+    """
+    Default enemies on a map where ``density`` fraction of tiles are walls.
+    """
+    rng = random.Random(seed)
+    walls = [[0 for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
+    for x, y in free_tiles(walls):
+        # Spawner needs some space to put tanks
+        if y > 1 and rng.random() < density:
+            walls[y][x] = 1
+    game = HeadlessGame(atlas=atlas, seed=seed,
+                        wall_array=walls, **game_kwargs)
+    make_immortal(game)
+    return game
+
+
+def default_scenario(_, atlas, seed, **game_kwargs):
+    """
+    The game as it is in game.py, with an immortal player
+    """
+    game = HeadlessGame(atlas=atlas, seed=seed,
+                        wall_array=WALL_ARRAY, **game_kwargs)
+    make_immortal(game)
+    return game
+
+
+def chunks_scenario(size, atlas, seed, **game_kwargs):
+    """
+    A random map of size x size tiles with an enemy tank per 100 tiles all
+    over it, and the player jumping around the middle of the map. Only the
+    chunks near the player are simulated, so the tick time shouldn't depend
+    on the map size.
+    """
+    game_kwargs = dict(game_kwargs, chunked=True, map_size=(size, size),
+                       batched_ai=False, pathfinding=False,
+                       array_layout=False)
+    # The layout is always chunked
+    game_kwargs.pop('layout_class', None)
+    game = HeadlessGame(atlas=atlas, seed=seed, **game_kwargs)
+    make_immortal(game)
+    rng = random.Random(seed)
+    walls = game.world.static_walls.tiles
+    player_x, player_y = EntityTracker().entities['player'].position.pos
+    player_x //= TILE_SIZE
+    player_y //= TILE_SIZE
+    # Keeping the start free
+    taken = set(walls) | {(x, y) for x in range(player_x - 4, player_x + 6)
+                          for y in range(player_y - 12, player_y + 3)}
+    tanks = []
+    while len(tanks) < size * size // 100:
+        tile = (rng.randrange(size), rng.randrange(size))
+        if tile not in taken:
+            taken.add(tile)
+            tanks.append(tile)
+    for i, (x, y) in enumerate(tanks):
+        create_enemy_tank(game.dispatcher, atlas, f'enemy_bench{i}',
+                          x * TILE_SIZE, y * TILE_SIZE,
+                          bullet_pool=game.world.bullet_pool)
+    game.world.spawner.enemies_current = len(tanks)
+    tiles = [(x, y) for x in range(player_x - 24, player_x + 24)
+             for y in range(player_y - 24, player_y + 24)
+             if 0 <= x < size and 0 <= y < size and (x, y) not in taken]
+    mover = PlayerMover(tiles=tiles, rng=rng, interval=30)
+    game.dispatcher.register_listener(mover, 'tick')
+    return game
+
+
+# name: (scenario function, sizes)
+SCENARIOS = {'default': (default_scenario, (None,)),
+             'tanks': (tanks_scenario, (5, 20, 50, 100)),
+             'chase': (chase_scenario, (5, 20, 50, 100)),
+             'bullets': (bullets_scenario, (10, 50, 100, 200)),
+             'walls': (walls_scenario, (0.25, 0.5, 0.9)),
+             'chunks': (chunks_scenario, (50, 200, 1000))}
+
+
+################################################################################
+# Measurement
+################################################################################
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def measure(scenario, size, atlas, ticks=300, warmup=30, seed=0,
+            memory_ticks=30, **game_kwargs):
+    """
+    Run a single scenario and return its stats as a dict.
+
+    Tick times are measured with a fresh game; then peak memory is measured
+    on another fresh game with tracemalloc on, because tracing slows
+    everything down a lot.
+
+    All other kwargs are passed to HeadlessGame.
+    """
+    game = scenario(size, atlas, seed, **game_kwargs)
+    counter = EventCounter()
+    game.dispatcher.register_listener(counter, 'all')
+    for _ in range(warmup):
+        game.loop.step()
+    layout = game.world.layout
+    cells = getattr(layout, 'total_cells_redrawn', None)
+    draw_time = getattr(layout, 'draw_time', None)
+    field = game.world.flow_field
+    field_time = field.update_time if field else None
+    times = []
+    events = []
+    for _ in range(ticks):
+        count = counter.count
+        start = time.perf_counter()
+        game.loop.step()
+        times.append(time.perf_counter() - start)
+        events.append(counter.count - count)
+    entities = len(EntityTracker().entities)
+    awake = game.world.chunks.awake if game.world.chunks else None
+    if cells is not None:
+        cells = (layout.total_cells_redrawn - cells) / ticks
+    if draw_time is not None:
+        draw_time = (layout.draw_time - draw_time) / ticks * 1000
+        # What the first frame, a restored snapshot or a layout without
+        # dirty rectangles costs
+        full_times = []
+        for _ in range(10):
+            start = time.perf_counter()
+            layout._rebuild_self()
+            full_times.append(time.perf_counter() - start)
+        full_draw_time = sorted(full_times)[len(full_times) // 2] * 1000
+    else:
+        full_draw_time = None
+    if field_time is not None:
+        field_time = (field.update_time - field_time) / ticks * 1000
+    times.sort()
+    tracemalloc.start()
+    game = scenario(size, atlas, seed, **game_kwargs)
+    for _ in range(memory_ticks):
+        game.loop.step()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'size': size,
+            'ticks': ticks,
+            'entities': entities,
+            'awake_entities': awake,
+            'tick_ms': {'p50': percentile(times, 50) * 1000,
+                        'p95': percentile(times, 95) * 1000,
+                        'p99': percentile(times, 99) * 1000,
+                        'mean': sum(times) / len(times) * 1000,
+                        'max': times[-1] * 1000},
+            'events_per_tick': {'mean': sum(events) / len(events),
+                                'max': max(events)},
+            'cells_per_frame': cells,
+            'draw_ms_per_tick': draw_time,
+            'full_draw_ms': full_draw_time,
+            'flow_field_ms_per_tick': field_time,
+            'peak_memory_kb': peak / 1024}
+
+
+def entity_memory(atlas, count=200, seed=0, **game_kwargs):
+    """
+    Measure the memory taken by a single wall, enemy tank and bullet.
+
+    ``count`` entities of each kind are created on an empty map and added to
+    it; all the memory allocated meanwhile (including EntityTracker and layout
+    records) is divided by ``count``. If the game uses CompactStorage, the
+    array slots taken by these entities are counted as well.
+
+    :returns: a dict of {kind: bytes per entity}
+    """
+    empty = [[0 for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
+    tiles = free_tiles(empty)
+    r = {}
+    for kind in ('wall', 'enemy', 'bullet'):
+        game = HeadlessGame(atlas=atlas, seed=seed, wall_array=empty,
+                            enemies=0, **game_kwargs)
+        game.dispatcher.dispatch_events()
+        storage = game.world.storage
+        tables = (storage.positions, storage.health) if storage else ()
+        for table in tables:
+            # Array growth is accounted for separately
+            table.reserve(count)
+        used = [len(table) for table in tables]
+        gc.collect()
+        tracemalloc.start()
+        for i in range(count):
+            x, y = tiles[i % len(tiles)]
+            x *= TILE_SIZE
+            y *= TILE_SIZE
+            if kind == 'wall':
+                create_wall(game.dispatcher, atlas, f'wall_bench{i}', x, y,
+                            storage=storage)
+            elif kind == 'enemy':
+                create_enemy_tank(game.dispatcher, atlas, f'enemy_bench{i}',
+                                  x, y, bullet_pool=game.world.bullet_pool,
+                                  storage=storage)
+            else:
+                create_bullet(game.dispatcher, f'bench_bullet{i}', x, y, 0, 0,
+                              storage=storage)
+        game.dispatcher.dispatch_events()
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        for table, before in zip(tables, used):
+            allocated += (len(table) - before) * table.slot_size
+        r[kind] = allocated / count
+    return r
+
+
+def snapshot_throughput(atlas, seed=0, tanks=50, walls=75, bullets=100,
+                        ticks=300, **game_kwargs):
+    """
+    Measure how fast a world of about 200 entities (``tanks`` enemy tanks,
+    ``walls`` wall entities and ``bullets`` bullets in flight, plus the
+    player and the spawner house) is captured and restored. Tanks and walls
+    are indestructible, so that the world stays that big.
+
+    Full snapshots are captured and encoded repeatedly in the same state;
+    deltas are captured and encoded once per tick while the game is running;
+    restores alternate between two states a second apart, so that every
+    restore has to move, create and destroy things.
+
+    :returns: a dict of rates (per second) and average sizes (in bytes)
+    """
+    game = tanks_scenario(tanks, atlas, seed, **game_kwargs)
+    tiles = free_tiles([[0 for _ in range(GRID_WIDTH)]
+                        for _ in range(GRID_HEIGHT)])
+    random.Random(seed + 1).shuffle(tiles)
+    taken = {(x // TILE_SIZE, y // TILE_SIZE)
+             for x, y in (e.position.pos
+                          for e in EntityTracker().entities.values())}
+    for i, (x, y) in enumerate([x for x in tiles if x not in taken][:walls]):
+        create_wall(game.dispatcher, atlas, f'wall_bench{i}', x * TILE_SIZE,
+                    y * TILE_SIZE, storage=game.world.storage)
+    game.dispatcher.dispatch_events()
+    # Bullets are still destroyed on impact, but nothing else is
+    for entity in EntityTracker().entities.values():
+        if hasattr(entity, 'health'):
+            entity.health.hitpoints = 10 ** 6
+    storm = BulletStorm(dispatcher=game.dispatcher, bullets=bullets,
+                        rng=random.Random(seed),
+                        bullet_pool=game.world.bullet_pool)
+    game.dispatcher.register_listener(storm, ['tick', 'ecs_destroy'])
+    snapshotter = Snapshotter(game.dispatcher, atlas, game.world)
+    for _ in range(30):
+        game.loop.step()
+    entities = len(EntityTracker().entities)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        data = snapshotter.capture().to_bytes()
+    full_rate = ticks / (time.perf_counter() - start)
+    full_size = len(data)
+    previous = snapshotter.capture()
+    elapsed = 0
+    delta_size = 0
+    for _ in range(ticks):
+        game.loop.step()
+        start = time.perf_counter()
+        snapshot = snapshotter.capture()
+        delta_size += len(previous.diff(snapshot).to_bytes())
+        elapsed += time.perf_counter() - start
+        previous = snapshot
+    delta_rate = ticks / elapsed
+    states = [previous.to_bytes()]
+    for _ in range(game.loop.fps):
+        game.loop.step()
+    states.append(snapshotter.capture().to_bytes())
+    start = time.perf_counter()
+    for i in range(ticks):
+        snapshotter.restore(Snapshot.from_bytes(states[i % 2]))
+    restore_rate = ticks / (time.perf_counter() - start)
+    return {'entities': entities,
+            'full_per_s': full_rate,
+            'full_bytes': full_size,
+            'delta_per_s': delta_rate,
+            'delta_bytes': delta_size / ticks,
+            'restore_per_s': restore_rate}
+
+
+# Builds the game and draws the first frame, with or without the atlas cache
+STARTUP_SCRIPT = """
+import sys
+from headless import HeadlessGame, load_atlas
+game = HeadlessGame(atlas=load_atlas(cache=sys.argv[1] == 'cache'),
+                    render=True)
+game.loop.step()
+print('frame', flush=True)
+"""
+
+
+def startup_time(runs=7):
+    """
+    Measure the cold start: time from launching a new Python process to the
+    first frame of a headless game, with and without the atlas cache, plus
+    the time it takes to load the atlas and decode all of its elements
+    in-process.
+
+    :returns: a dict of median times in ms
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    # Making sure the cache exists and is fresh
+    load_atlas()
+    r = {}
+    for mode in ('no_cache', 'cache'):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, '-c', STARTUP_SCRIPT, mode], cwd=directory,
+                stdout=subprocess.PIPE, text=True)
+            process.stdout.readline()
+            times.append(time.perf_counter() - start)
+            process.wait()
+        times.sort()
+        r[f'first_frame_{mode}'] = percentile(times, 50) * 1000
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            atlas = load_atlas(cache=mode == 'cache')
+            for name in atlas.elements:
+                atlas.get_element(name)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        r[f'atlas_{mode}'] = percentile(times, 50) * 1000
+    return r
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(names=None, ticks=300, seed=0, render=True,
+              spatial_index=True, batched_ai=False, bullet_pool=True,
+              compact_storage=False, static_walls=True, dirty_rects=True,
+              pathfinding=False, batched_damage=False, array_layout=False):
+    atlas = load_atlas()
+    results = {'revision': git_revision(),
+               'python': platform.python_version(),
+               'render': render,
+               'spatial_index': spatial_index,
+               'batched_ai': batched_ai,
+               'bullet_pool': bullet_pool,
+               'compact_storage': compact_storage,
+               'static_walls': static_walls,
+               'dirty_rects': dirty_rects,
+               'pathfinding': pathfinding,
+               'batched_damage': batched_damage,
+               'array_layout': array_layout,
+               'scenarios': {}}
+    game_kwargs = {'render': render, 'batched_ai': batched_ai,
+                   'bullet_pool': bullet_pool,
+                   'compact_storage': compact_storage,
+                   'static_walls': static_walls,
+                   'pathfinding': pathfinding,
+                   'batched_damage': batched_damage,
+                   'array_layout': array_layout}
+    if not spatial_index:
+        game_kwargs['layout_class'] = ECSLayout if render \
+            else PlainSimulationLayout
+    elif render and not dirty_rects:
+        game_kwargs['layout_class'] = GridECSLayout
+    for name in names or SCENARIOS:
+        scenario, sizes = SCENARIOS[name]
+        results['scenarios'][name] = []
+        for size in sizes:
+            r = measure(scenario, size, atlas, ticks=ticks, seed=seed,
+                        **game_kwargs)
+            results['scenarios'][name].append(r)
+            print(f'{name:>8} {str(size):>5}: '
+                  f'p50 {r["tick_ms"]["p50"]:7.2f} ms, '
+                  f'p99 {r["tick_ms"]["p99"]:7.2f} ms, '
+                  f'{r["events_per_tick"]["mean"]:7.1f} events/tick, '
+                  f'{r["peak_memory_kb"]:8.0f} KB peak' +
+                  (f', {r["cells_per_frame"]:6.1f} cells/frame in '
+                   f'{r["draw_ms_per_tick"]:.3f} ms (full redraw '
+                   f'{r["full_draw_ms"]:.2f} ms)'
+                   if r['cells_per_frame'] is not None else '') +
+                  (f', {r["awake_entities"]} of {r["entities"]} entities '
+                   f'awake' if r['awake_entities'] is not None else '') +
+                  (f', {r["flow_field_ms_per_tick"]:.3f} ms/tick in flow '
+                   f'field' if r['flow_field_ms_per_tick'] is not None
+                   else ''),
+                  file=sys.stderr)
+    results['entity_bytes'] = entity_memory(atlas, seed=seed, **game_kwargs)
+    print('Bytes per entity: ' +
+          ', '.join(f'{kind} {size:.0f}'
+                    for kind, size in results['entity_bytes'].items()),
+          file=sys.stderr)
+    results['startup_ms'] = r = startup_time()
+    print(f'Startup: first frame in {r["first_frame_no_cache"]:.0f} ms '
+          f'({r["atlas_no_cache"]:.1f} ms atlas), '
+          f'{r["first_frame_cache"]:.0f} ms with atlas cache '
+          f'({r["atlas_cache"]:.1f} ms atlas)', file=sys.stderr)
+    results['snapshots'] = r = snapshot_throughput(atlas, seed=seed,
+                                                   **game_kwargs)
+    print(f'Snapshots of {r["entities"]} entities: '
+          f'{r["full_per_s"]:.0f}/s full ({r["full_bytes"]} bytes), '
+          f'{r["delta_per_s"]:.0f}/s delta ({r["delta_bytes"]:.0f} bytes), '
+          f'{r["restore_per_s"]:.0f}/s restores', file=sys.stderr)
+    return results
+
+
+def compare(old, new):
+    """
+    Print p50/p99 ratios (new/old) for every scenario present in both runs,
+    and the drawing time ratios if both have them
+    """
+    for name in new['scenarios']:
+        if name not in old['scenarios']:
+            continue
+        old_runs = {str(x['size']): x for x in old['scenarios'][name]}
+        for run in new['scenarios'][name]:
+            previous = old_runs.get(str(run['size']))
+            if not previous:
+                continue
+            ratios = [run['tick_ms'][p] / previous['tick_ms'][p]
+                      for p in ('p50', 'p99')]
+            drawing = ''
+            if run.get('draw_ms_per_tick') and \
+                    previous.get('draw_ms_per_tick'):
+                ratio = run['draw_ms_per_tick'] / previous['draw_ms_per_tick']
+                full_ratio = run['full_draw_ms'] / previous['full_draw_ms']
+                drawing = f', drawing x{ratio:.2f}, full redraw ' \
+                    f'x{full_ratio:.2f}'
+            print(f'{name:>8} {str(run["size"]):>5}: '
+                  f'p50 x{ratios[0]:.2f}, p99 x{ratios[1]:.2f}{drawing}')
+    if 'snapshots' in old and 'snapshots' in new:
+        for key in ('full_per_s', 'delta_per_s', 'restore_per_s'):
+            print(f'{key:>13}: '
+                  f'x{new["snapshots"][key] / old["snapshots"][key]:.2f}')
+    if 'startup_ms' in old and 'startup_ms' in new:
+        for key in ('first_frame_cache', 'atlas_cache'):
+            print(f'{key:>17}: '
+                  f'x{new["startup_ms"][key] / old["startup_ms"][key]:.2f}')
+    for kind, size in new.get('entity_bytes', {}).items():
+        if kind in old.get('entity_bytes', {}):
+            print(f'{kind:>8} bytes: x{size / old["entity_bytes"][kind]:.2f}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='AsciiCity benchmarks')
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'Scenarios to run, any of '
+                             f'{", ".join(SCENARIOS)}. All by default')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-render', action='store_true',
+                        help='Do not composite the map every tick')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Use plain ECSLayout collision detection instead'
+                             ' of the spatial index')
+    parser.add_argument('--batched-ai', action='store_true',
+                        help='Control enemies with NumPy-based EnemyAISystem')
+    parser.add_argument('--no-pool', action='store_true',
+                        help='Create a new entity for every bullet instead of'
+                             ' using BulletPool')
+    parser.add_argument('--compact', action='store_true',
+                        help='Keep positions and hitpoints in CompactStorage')
+    parser.add_argument('--no-static-walls', action='store_true',
+                        help='Create all walls as entities at start')
+    parser.add_argument('--full-redraw', action='store_true',
+                        help='Recomposite the entire map whenever anything'
+                             ' on it changes')
+    parser.add_argument('--pathfinding', action='store_true',
+                        help='Enemies follow a shared flow field')
+    parser.add_argument('--batched-damage', action='store_true',
+                        help='Apply all the hits once per tick')
+    parser.add_argument('--array-layout', action='store_true',
+                        help='Composite the map in NumPy arrays')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write results to. Stdout if unset')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file from an earlier run to compare with')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario {name}')
+    if args.array_layout and (args.no_render or args.no_index or
+                              args.full_redraw):
+        parser.error('--array-layout only works with the default rendering')
+    results = run_suite(args.scenarios, ticks=args.ticks, seed=args.seed,
+                        render=not args.no_render,
+                        spatial_index=not args.no_index,
+                        batched_ai=args.batched_ai,
+                        bullet_pool=not args.no_pool,
+                        compact_storage=args.compact,
+                        static_walls=not args.no_static_walls,
+                        dirty_rects=not args.full_redraw,
+                        pathfinding=args.pathfinding,
+                        batched_damage=args.batched_damage,
+                        array_layout=args.array_layout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
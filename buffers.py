@@ -0,0 +1,347 @@
+"""
+NumPy-backed char buffers.
+
+Widgets and layouts keep their chars and colors as 2-nested lists, so
+compositing the map means walking the child pointers of every dirty cell in
+Python, one cell at a time. CharBuffer keeps the same chars as code points in
+a NumPy array, and the colors as indices into a shared Palette, just like the
+atlas cache stores them. ArrayLayout composites its map into a CharBuffer:
+every child image is converted once, and then putting a tank (or any other
+image) onto the map is a masked slice assignment, whatever its size.
+"""
+
+import numpy as np
+
+from render import DirtyRectLayout
+
+
+# Transparent char
+SPACE = ord(' ')
+# Palette index of None, ie no color
+NO_COLOR = 0
+# Converted child images kept by ArrayLayout. Shared images (see
+# entities.Prototypes) are few, so this only matters for the widgets with
+# images of their own
+IMAGE_CACHE_SIZE = 1024
+# Rectangles of up to this many cells (eg a moving bullet) are recomposited
+# cell by cell, which is faster than slicing for anything smaller than 3x4
+SMALL_RECT = 8
+
+
+class Palette:
+    """
+    Color strings by index and indices by color string.
+
+    Index 0 is None; other colors get the next index when they are first
+    used.
+    """
+    def __init__(self):
+        self.colors = [None]
+        self.indices = {None: NO_COLOR}
+
+    def index(self, color):
+        try:
+            return self.indices[color]
+        except KeyError:
+            if len(self.colors) > np.iinfo(np.uint16).max:
+                raise ValueError('Too many colors in a palette')
+            self.indices[color] = len(self.colors)
+            self.colors.append(color)
+            return self.indices[color]
+
+    def __getitem__(self, index):
+        return self.colors[index]
+
+    def __len__(self):
+        return len(self.colors)
+
+
+class CharBuffer:
+    """
+    Chars and colors of a rectangle, as two arrays of shape (height, width).
+
+    ``chars`` are code points (uint32) and ``colors`` are Palette indices
+    (uint16). ``opaque`` is a mask of non-space chars, ie the cells that
+    cover whatever is below them, and ``solid`` is True if there are no spaces
+    at all. Both are set on creation and by ``load``; anyone who changes the
+    arrays directly should call ``update_mask``.
+
+    :param palette: Palette the colors are from
+    """
+    def __init__(self, chars, colors, palette):
+        if chars.shape != colors.shape:
+            raise ValueError('Chars and colors should be of the same shape')
+        self.chars = chars
+        self.colors = colors
+        self.palette = palette
+        self.update_mask()
+
+    @classmethod
+    def from_lists(cls, chars, colors, palette):
+        """
+        Convert the usual 2-nested lists of chars and colors
+        """
+        index = palette.index
+        return cls(np.array([[ord(x) for x in row] for row in chars],
+                            dtype=np.uint32),
+                   np.array([[index(x) for x in row] for row in colors],
+                            dtype=np.uint16),
+                   palette)
+
+    @property
+    def width(self):
+        return self.chars.shape[1]
+
+    @property
+    def height(self):
+        return self.chars.shape[0]
+
+    def update_mask(self):
+        self.opaque = self.chars != SPACE
+        self.solid = bool(self.opaque.all())
+
+    def load(self, chars, colors, x=0, y=0, width=None, height=None):
+        """
+        Re-read a rectangle from 2-nested lists of the same size as the buffer,
+        eg after someone has drawn on them.
+        """
+        x_end = self.width if width is None else x + width
+        y_end = self.height if height is None else y + height
+        index = self.palette.index
+        self.chars[y:y_end, x:x_end] = [[ord(c) for c in row[x:x_end]]
+                                        for row in chars[y:y_end]]
+        self.colors[y:y_end, x:x_end] = [[index(c) for c in row[x:x_end]]
+                                         for row in colors[y:y_end]]
+        self.opaque[y:y_end, x:x_end] = self.chars[y:y_end, x:x_end] != SPACE
+        self.solid = bool(self.opaque.all())
+
+    def copy_rect(self, other, x, y, x_end, y_end):
+        """
+        Copy a rectangle from another buffer of the same size, spaces included
+        """
+        self.chars[y:y_end, x:x_end] = other.chars[y:y_end, x:x_end]
+        self.colors[y:y_end, x:x_end] = other.colors[y:y_end, x:x_end]
+
+    def blit(self, image, x, y, clip=None):
+        """
+        Draw another buffer over this one, with spaces being transparent.
+
+        :param image: CharBuffer with the same palette
+
+        :param x, y: image position within this buffer
+
+        :param clip: (x, y, x_end, y_end) of the rectangle to draw within.
+        Anything outside of it (or outside this buffer) is left alone.
+        """
+        if clip is None:
+            clip = (0, 0, self.width, self.height)
+        x_start = max(x, clip[0])
+        y_start = max(y, clip[1])
+        x_end = min(x + image.width, clip[2])
+        y_end = min(y + image.height, clip[3])
+        if x_start >= x_end or y_start >= y_end:
+            return
+        source = (slice(y_start - y, y_end - y), slice(x_start - x, x_end - x))
+        target = (slice(y_start, y_end), slice(x_start, x_end))
+        if image.solid:
+            self.chars[target] = image.chars[source]
+            self.colors[target] = image.colors[source]
+        else:
+            mask = image.opaque[source]
+            np.copyto(self.chars[target], image.chars[source], where=mask)
+            np.copyto(self.colors[target], image.colors[source], where=mask)
+
+    def to_lists(self):
+        """
+        :returns: (chars, colors) as 2-nested lists
+        """
+        colors = self.palette.colors
+        return ([[chr(x) for x in row] for row in self.chars.tolist()],
+                [[colors[x] for x in row] for row in self.colors.tolist()])
+
+
+class ArrayLayout(DirtyRectLayout):
+    """
+    A DirtyRectLayout that composites the map into a CharBuffer.
+
+    The map is available as ``buffer``. ``chars`` and ``colors`` stay the
+    background's lists (Layout shares them with its background widget), so
+    anything that draws on the background should call ``background_changed``
+    afterwards. Child images are converted into CharBuffers on first use and
+    looked up by the identity of their chars and colors lists, so that a
+    SwitchingWidget switching back and forth doesn't convert anything. Child
+    images are not supposed to change in place: a widget that wants to draw
+    something else should get new lists.
+
+    Dirty cells are kept as rectangles and recomposited as a whole: the
+    background is copied, and then every child that overlaps the rectangle,
+    as told by the spatial index, is blitted over it in the order the children
+    were placed. This gives the same chars and colors as
+    ``Layout._rebuild_self``. Rectangles of up to SMALL_RECT cells, such as
+    a moving bullet's, are recomposited cell by cell instead.
+
+    Redrawing the entire map (the first frame, or after a snapshot is
+    restored) is many times faster than with lists. Per-tick frames, which
+    only redraw a few dozen cells, are somewhat slower, since every cell is
+    converted on top of being composited: see ``bench.py --array-layout``.
+
+    The terminal gets the dirty rectangles via ``update_rects``, or the whole
+    buffer via ``update_widget``, so it should be a render.RegionTerminal or
+    headless.HeadlessTerminal. Chunked maps are not supported.
+    """
+    def __init__(self, chars, colors, **kwargs):
+        # Placement order of the children. Needed before super().__init__,
+        # which adds the background
+        self._order = {}
+        self._placed = 0
+        super().__init__(chars, colors, **kwargs)
+        self.palette = Palette()
+        self.background_buffer = CharBuffer.from_lists(chars, colors,
+                                                       self.palette)
+        self.buffer = CharBuffer.from_lists(chars, colors, self.palette)
+        # [(x, y, x_end, y_end)]
+        self.dirty_rects = []
+        # {(id(chars), id(colors)): (chars, colors, CharBuffer)}. The lists are
+        # kept so that their IDs are not reused while in the cache
+        self.images = {}
+
+    def add_child(self, child, pos, skip_checks=False):
+        super().add_child(child, pos, skip_checks=skip_checks)
+        # Moving re-adds the child, which puts it on top, just like it does
+        # in the child pointers
+        self._placed += 1
+        self._order[child] = self._placed
+
+    def remove_child(self, child, remove_completely=True):
+        super().remove_child(child, remove_completely=remove_completely)
+        if remove_completely:
+            del self._order[child]
+
+    def background_changed(self, x, y, width, height):
+        """
+        Re-read a part of the background from its lists and redraw it
+        """
+        buffer = self.background_buffer
+        x_end = min(x + width, buffer.width)
+        y_end = min(y + height, buffer.height)
+        x = max(x, 0)
+        y = max(y, 0)
+        if x < x_end and y < y_end:
+            buffer.load(self.background.chars, self.background.colors,
+                        x, y, x_end - x, y_end - y)
+            self.mark_dirty(x, y, x_end - x, y_end - y)
+
+    def mark_dirty(self, x, y, width, height):
+        if self.full_redraw:
+            return
+        x_end = min(x + width, self.buffer.width)
+        y_end = min(y + height, self.buffer.height)
+        x = max(x, 0)
+        y = max(y, 0)
+        if x >= x_end or y >= y_end:
+            return
+        if x == 0 and y == 0 and x_end == self.buffer.width \
+                and y_end == self.buffer.height:
+            self.full_redraw = True
+            return
+        rects = self.dirty_rects
+        if rects:
+            # A widget that moved by a few chars marks two overlapping
+            # rectangles, which are cheaper to redraw as one
+            last_x, last_y, last_x_end, last_y_end = rects[-1]
+            if x <= last_x_end and last_x <= x_end and \
+                    y <= last_y_end and last_y <= y_end:
+                rects[-1] = (min(x, last_x), min(y, last_y),
+                             max(x_end, last_x_end), max(y_end, last_y_end))
+                return
+        rects.append((x, y, x_end, y_end))
+
+    def _image(self, child):
+        key = (id(child.chars), id(child.colors))
+        try:
+            return self.images[key][2]
+        except KeyError:
+            if len(self.images) >= IMAGE_CACHE_SIZE:
+                self.images.clear()
+            image = CharBuffer.from_lists(child.chars, child.colors,
+                                          self.palette)
+            self.images[key] = (child.chars, child.colors, image)
+            return image
+
+    def _redraw(self):
+        if self.full_redraw:
+            self._rebuild_self()
+            self.terminal.update_widget(self)
+            self.dirty_rects = []
+            return self.buffer.width * self.buffer.height
+        rects = self.dirty_rects
+        if not rects:
+            return 0
+        cells = 0
+        small = []
+        for rect in rects:
+            area = (rect[2] - rect[0]) * (rect[3] - rect[1])
+            if area <= SMALL_RECT:
+                small.append(rect)
+            else:
+                self._rebuild_rect(*rect)
+            cells += area
+        if small:
+            self._rebuild_cells(small)
+        self.terminal.update_rects(self, rects)
+        self.dirty_rects = []
+        return cells
+
+    def _rebuild_self(self):
+        buffer = self.buffer
+        buffer.copy_rect(self.background_buffer, 0, 0, buffer.width,
+                         buffer.height)
+        background = self.background
+        locations = self.child_locations
+        for child in sorted(self._order, key=self._order.__getitem__):
+            if child is not background:
+                buffer.blit(self._image(child), *locations[child])
+
+    def _rebuild_rect(self, x, y, x_end, y_end):
+        buffer = self.buffer
+        buffer.copy_rect(self.background_buffer, x, y, x_end, y_end)
+        widgets = self.widgets
+        order = self._order
+        # Freshly materialized walls are in the index, but not on the map yet
+        children = [widgets[entity_id] for entity_id
+                    in self.index.query(x, y, x_end - x, y_end - y)
+                    if entity_id in widgets and widgets[entity_id] in order]
+        children.sort(key=order.__getitem__)
+        locations = self.child_locations
+        clip = (x, y, x_end, y_end)
+        for child in children:
+            buffer.blit(self._image(child), *locations[child], clip=clip)
+
+    def _rebuild_cells(self, rects):
+        # Same as DirtyRectLayout._rebuild_cells, for all the cells of the
+        # given rectangles. They are written into the buffer at once, since
+        # setting array items one by one is a lot slower than with lists
+        cells = []
+        codes = []
+        color_indices = []
+        indices = self.palette.indices
+        index = self.palette.index
+        pointers = self._child_pointers
+        locations = self.child_locations
+        width = self.buffer.width
+        for x, y, x_end, y_end in rects:
+            for line in range(y, y_end):
+                line_pointers = pointers[line]
+                for char in range(x, x_end):
+                    for child in reversed(line_pointers[char]):
+                        child_x, child_y = locations[child]
+                        c = child.chars[line - child_y][char - child_x]
+                        if c != ' ':
+                            break
+                    color = child.colors[line - child_y][char - child_x]
+                    cells.append(line * width + char)
+                    codes.append(ord(c))
+                    color_indices.append(indices[color] if color in indices
+                                         else index(color))
+        self.buffer.chars.reshape(-1)[cells] = codes
+        self.buffer.colors.reshape(-1)[cells] = color_indices
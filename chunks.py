@@ -0,0 +1,391 @@
+"""
+Large maps.
+
+A layout holds a list of chars and a list of child widgets per map cell, so
+a map of 1000x1000 tiles (6000x6000 chars) can't be a regular ECSLayout.
+Besides, every entity on the map ticks, whether anything happens around it
+or not.
+
+ChunkedLayout keeps entities in world coordinates, in the spatial index only,
+and composites just the part of the map that is on screen. The view follows
+the player. Untouched walls are not drawn anywhere: ChunkedWallLayer keeps
+them as a set of tiles, which the layout consults when drawing.
+
+ChunkManager splits the map into square chunks and keeps only those around
+the player (and around the enemies near the player) active. Entities in
+other chunks are put to sleep: their components are unsubscribed from
+'tick', 'service' and 'ecs_collision' until their chunk becomes active again.
+Sleeping entities still occupy space, so awake ones run into them as usual.
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.widgets import Listener
+
+import time
+
+from entities import get_prototypes
+from level import StaticWallLayer, TILE_SIZE
+from render import DirtyRectLayout
+from routing import RoutingDispatcher
+from tags import EntityIndex, Tag
+
+
+class ChunkedLayout(DirtyRectLayout):
+    """
+    A DirtyRectLayout that shows a part of a large map.
+
+    ``chars`` and ``colors`` are the size of the view, not of the map. All
+    positions (in events, ``child_locations``, the spatial index and
+    ``mark_dirty`` calls) are map positions, and the map edges are at
+    ``map_size``. Widgets don't have to fit into the view.
+
+    The view is scrolled to keep the ``focus`` entity at least ``margin``
+    chars away from its edges, and the whole view is redrawn after that.
+
+    :param map_size: map size in chars, (width, height)
+
+    :param focus: ID of the entity to follow
+
+    :param margin: how close to the view edge the focus can get, in chars
+    """
+    def __init__(self, chars, colors, map_size, focus='player', margin=18,
+                 **kwargs):
+        super().__init__(chars, colors, **kwargs)
+        self.map_size = tuple(map_size)
+        self.focus = focus
+        self.margin = margin
+        self.view_pos = (0, 0)
+        self.background_color = colors[0][0]
+
+    @property
+    def view_size(self):
+        return len(self.chars[0]), len(self.chars)
+
+    # Map children are only tracked by position, since there may be lots of
+    # them. The view is composited from the spatial index instead
+    def add_child(self, child, pos, skip_checks=False):
+        if not self.children:
+            # Background
+            return super().add_child(child, pos, skip_checks=skip_checks)
+        self.child_locations[child] = pos
+        child.parent = self
+
+    def remove_child(self, child, remove_completely=True):
+        if remove_completely:
+            del self.child_locations[child]
+            child.parent = None
+
+    def move_child(self, child, new_pos):
+        self.child_locations[child] = new_pos
+
+    def _outside(self, x, y, width, height):
+        return x < 0 or x + width > self.map_size[0] or y < 0 or \
+            y + height > self.map_size[1]
+
+    def mark_dirty(self, x, y, width, height):
+        """
+        Redraw a given rectangle of the map at the end of this tick, if it's
+        in view
+        """
+        super().mark_dirty(x - self.view_pos[0], y - self.view_pos[1],
+                           width, height)
+
+    def scroll_to(self, x, y):
+        """
+        Move the view to a given map position, or as close to it as possible
+        """
+        view_width, view_height = self.view_size
+        pos = (max(0, min(x, self.map_size[0] - view_width)),
+               max(0, min(y, self.map_size[1] - view_height)))
+        if pos != self.view_pos:
+            self.view_pos = pos
+            self.full_redraw = True
+            self.dirty_cells = set()
+
+    def _follow(self, x, y, width, height):
+        view_x, view_y = self.view_pos
+        view_width, view_height = self.view_size
+        margin = self.margin
+        if x < view_x + margin or x + width > view_x + view_width - margin \
+                or y < view_y + margin \
+                or y + height > view_y + view_height - margin:
+            self.scroll_to(x + (width - view_width) // 2,
+                           y + (height - view_height) // 2)
+
+    def on_event(self, event):
+        r = super().on_event(event)
+        if event.event_type in ('ecs_move', 'ecs_add') and \
+                event.event_value[0] == self.focus:
+            widget = self.widgets[self.focus]
+            pos = self.child_locations.get(widget)
+            if pos is not None:
+                self._follow(*pos, *widget.size)
+        return r
+
+    def _compose(self, x, y):
+        # Char and color of a single map cell: the newest entity with a
+        # non-space char there, or the background
+        index = self.index
+        size = index.cell_size
+        top = None
+        for item in index.cells.get((x // size, y // size), ()):
+            item_x, item_y, width, height = index.rects[item]
+            if item_x <= x < item_x + width and \
+                    item_y <= y < item_y + height and item in self.widgets:
+                widget = self.widgets[item]
+                if widget.chars[y - item_y][x - item_x] != ' ' and \
+                        (top is None or self._entity_order[item] >
+                         self._entity_order[top[0]]):
+                    top = (item, widget, item_x, item_y)
+        if top:
+            _, widget, item_x, item_y = top
+            return widget.chars[y - item_y][x - item_x], \
+                widget.colors[y - item_y][x - item_x]
+        walls = self.static_layer
+        if walls:
+            tile = walls.tile_size
+            if (x // tile, y // tile) in walls.tiles:
+                chars, colors = walls.image
+                return chars[y % tile][x % tile], colors[y % tile][x % tile]
+        return ' ', self.background_color
+
+    def _rebuild_self(self):
+        view_width, view_height = self.view_size
+        self._rebuild_cells((x, y) for y in range(view_height)
+                            for x in range(view_width))
+
+    def _rebuild_cells(self, cells):
+        chars = self.chars
+        colors = self.colors
+        view_x, view_y = self.view_pos
+        for x, y in cells:
+            chars[y][x], colors[y][x] = self._compose(view_x + x, view_y + y)
+
+
+class ChunkedWallLayer(StaticWallLayer):
+    """
+    A StaticWallLayer for ChunkedLayout.
+
+    Walls are not drawn onto the layout background (which is only the size of
+    the view); the layout draws the tiles in ``tiles`` itself.
+    """
+    def __init__(self, dispatcher, atlas, layout, walls, **kwargs):
+        self.image = get_prototypes(atlas).get_element('wall_3')
+        super().__init__(dispatcher, atlas, layout, walls, **kwargs)
+
+    def bake(self):
+        # The first frame is drawn in full anyway
+        pass
+
+    def _draw(self, x, y):
+        pass
+
+    def _erase(self, x, y):
+        self.layout.mark_dirty(x * self.tile_size, y * self.tile_size,
+                               self.tile_size, self.tile_size)
+
+
+class ChunkManager(Listener):
+    """
+    Keeps the entities outside the active chunks asleep.
+
+    The map is split into chunks of ``chunk_size`` x ``chunk_size`` tiles.
+    Active chunks are those within ``radius`` chunks from the ``focus``
+    entity, plus those within ``enemy_radius`` chunks from any enemy tank in
+    the former. The set is updated after 'tick_over', along with the
+    entities that have moved into another chunk or were added during the
+    tick: the ones in inactive chunks are put to sleep, and the sleeping ones
+    in active chunks are woken up. If there is no focus entity (eg the player
+    is dead), the active chunks stay the same.
+
+    A sleeping entity's components are unsubscribed from 'tick', 'service'
+    and 'ecs_collision' (routed or not), and subscribed back, in the same
+    order, when it wakes up. If a sleeping entity is destroyed, only its
+    DestructorComponent is subscribed back, so that it can finish the job.
+
+    Entities are put to sleep and woken up in the order they were added to
+    the map, so the game stays reproducible. Should be subscribed to
+    'ecs_add', 'ecs_move', 'ecs_destroy' and 'service', after the
+    EntityIndex.
+
+    ``sleeps`` and ``wakeups`` count the entities put to sleep and woken up,
+    and ``update_time`` is the total time spent on that, in seconds.
+
+    :param dispatcher: the dispatcher the entities are subscribed to
+
+    :param chunk_size: chunk size in tiles
+
+    :param radius: active chunks around the focus, in chunks
+
+    :param enemy_radius: active chunks around the enemies near the focus
+
+    :param focus: ID of the entity the active area follows
+    """
+    def __init__(self, *args, dispatcher, chunk_size=16, radius=1,
+                 enemy_radius=1, focus='player', tile_size=TILE_SIZE,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = dispatcher
+        self.chunk_chars = chunk_size * tile_size
+        self.radius = radius
+        self.enemy_radius = enemy_radius
+        self.focus = focus
+        # {entity ID: chunk}
+        self.entity_chunks = {}
+        # {chunk: set of entity IDs}
+        self.chunks = {}
+        # {entity ID: the order it was added in}
+        self.order = {}
+        self.counter = 0
+        self.active = set()
+        # {entity ID: (entity, [(listener, event_type, address), ...])}
+        self.asleep = {}
+        # Entities that have changed chunks during this tick
+        self.changed = set()
+        self.sleeps = 0
+        self.wakeups = 0
+        self.update_time = 0
+
+    @property
+    def awake(self):
+        """
+        Number of entities on the map that aren't asleep
+        """
+        return len(self.entity_chunks) - len(self.asleep)
+
+    def _place(self, entity_id, x, y):
+        chunk = (x // self.chunk_chars, y // self.chunk_chars)
+        old = self.entity_chunks.get(entity_id)
+        if old == chunk:
+            return
+        if old is not None:
+            self.chunks[old].discard(entity_id)
+        else:
+            self.order[entity_id] = self.counter
+            self.counter += 1
+        self.entity_chunks[entity_id] = chunk
+        self.chunks.setdefault(chunk, set()).add(entity_id)
+        self.changed.add(entity_id)
+
+    def _around(self, chunk, radius):
+        chunk_x, chunk_y = chunk
+        return {(x, y) for x in range(chunk_x - radius, chunk_x + radius + 1)
+                for y in range(chunk_y - radius, chunk_y + radius + 1)}
+
+    def on_event(self, event):
+        if event.event_type in ('ecs_add', 'ecs_move'):
+            self._place(*event.event_value)
+        elif event.event_type == 'ecs_destroy':
+            entity_id = event.event_value
+            chunk = self.entity_chunks.pop(entity_id, None)
+            if chunk is not None:
+                self.chunks[chunk].discard(entity_id)
+            self.changed.discard(entity_id)
+            # Pooled bullets come back with the same ID
+            self.order.pop(entity_id, None)
+            if entity_id in self.asleep:
+                entity, subscriptions = self.asleep.pop(entity_id)
+                destructor = getattr(entity, 'destructor', None)
+                self._subscribe(x for x in subscriptions
+                                if x[0] is destructor)
+        elif event.event_type == 'service' and \
+                event.event_value == 'tick_over':
+            # The dispatcher is still going through the 'service' listeners,
+            # which sleep() and wake() change
+            if isinstance(self.dispatcher, RoutingDispatcher):
+                self.dispatcher.defer(self.update)
+            else:
+                self.update()
+
+    def update(self):
+        """
+        Recalculate active chunks and put to sleep or wake up whoever needs it
+        """
+        start = time.perf_counter()
+        active = self.active
+        focus = self.entity_chunks.get(self.focus)
+        if focus is not None:
+            core = self._around(focus, self.radius)
+            active = set(core)
+            index = EntityIndex()
+            for chunk in core:
+                for entity_id in self.chunks.get(chunk, ()):
+                    if index.is_a(entity_id, Tag.ENEMY_TANK):
+                        active |= self._around(chunk, self.enemy_radius)
+        to_sleep = set()
+        to_wake = set()
+        for chunk in self.active - active:
+            to_sleep.update(self.chunks.get(chunk, ()))
+        for chunk in active - self.active:
+            to_wake.update(self.chunks.get(chunk, ()))
+        for entity_id in self.changed:
+            if self.entity_chunks[entity_id] in active:
+                to_wake.add(entity_id)
+            else:
+                to_sleep.add(entity_id)
+        self.active = active
+        self.changed = set()
+        self.sleep(sorted((x for x in to_sleep if x not in self.asleep),
+                          key=self.order.__getitem__))
+        self.wake(sorted((x for x in to_wake if x in self.asleep),
+                         key=self.order.__getitem__))
+        self.update_time += time.perf_counter() - start
+
+    def sleep(self, entity_ids):
+        """
+        Unsubscribe the components of given entities
+        """
+        if not entity_ids:
+            return
+        entities = EntityTracker().entities
+        dispatcher = self.dispatcher
+        routing = isinstance(dispatcher, RoutingDispatcher)
+        # {id(component): entity ID}. Components may define __eq__
+        owners = {}
+        for entity_id in entity_ids:
+            entity = entities[entity_id]
+            subscriptions = []
+            for name in entity.components:
+                owners[id(entity.__dict__[name])] = entity_id
+            if routing:
+                routed = dispatcher.routed_listeners['ecs_collision']
+                for listener in list(routed.get(entity_id, ())):
+                    dispatcher.unregister_routed_listener(listener,
+                                                          ['ecs_collision'])
+                    subscriptions.append((listener, 'ecs_collision',
+                                          entity_id))
+            self.asleep[entity_id] = (entity, subscriptions)
+        # One pass over every listener list, rather than a remove() per
+        # component
+        event_types = ('tick', 'service') if routing \
+            else ('tick', 'service', 'ecs_collision')
+        for event_type in event_types:
+            listeners = dispatcher.listeners[event_type]
+            kept = []
+            for listener in listeners:
+                entity_id = owners.get(id(listener))
+                if entity_id is None:
+                    kept.append(listener)
+                else:
+                    self.asleep[entity_id][1].append((listener, event_type,
+                                                      None))
+            # A new list, in case the dispatcher is iterating over the old one
+            dispatcher.listeners[event_type] = kept
+        self.sleeps += len(entity_ids)
+
+    def wake(self, entity_ids):
+        """
+        Subscribe the components of given sleeping entities back
+        """
+        for entity_id in entity_ids:
+            _, subscriptions = self.asleep.pop(entity_id)
+            self._subscribe(subscriptions)
+        self.wakeups += len(entity_ids)
+
+    def _subscribe(self, subscriptions):
+        for listener, event_type, address in subscriptions:
+            if address is None:
+                self.dispatcher.register_listener(listener, event_type)
+            else:
+                self.dispatcher.register_routed_listener(listener, event_type,
+                                                         address)
@@ -0,0 +1,82 @@
+"""
+Batched damage resolution.
+
+Normally every hit is resolved on the spot: a bullet emits 'ac_damage', the
+health component of the target sets its hitpoints, which may destroy the
+target, and then 'ecs_destroy' goes to the score label, the spawner and the
+GAME OVER listener, while the HP label is updated by every hit to the player.
+A bullet storm pays for this cascade once per hit.
+
+DamageSystem collects the hits instead and applies them in a single pass at
+the end of the tick: every damaged entity loses all the hitpoints it has lost
+during the tick at once, and a single 'ac_damage_resolved' event tells the
+labels and the spawner what was damaged and destroyed.
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.event import BearEvent
+from bear_hug.widgets import Listener
+
+from tags import EntityIndex
+
+
+class DamageSystem(Listener):
+    """
+    Collects 'ac_damage' hits and applies them once per tick.
+
+    Should be subscribed to 'ac_damage'. Health components should not get the
+    hits themselves: build_world routes 'ac_damage' nowhere for that, so the
+    dispatcher must be a RoutingDispatcher. On the first hit of a tick, the
+    system defers ``resolve`` until the queue is empty, ie until everything
+    else in this tick has happened.
+
+    Hits on entities that have no health, or that have already been destroyed,
+    are ignored. When the hits are applied, 'ac_damage_resolved' is emitted
+    with the value ``(damage, destroyed)``, where ``damage`` is ``{entity ID:
+    total damage}`` and ``destroyed`` is a list of IDs of the entities that
+    this damage has destroyed. The usual 'ecs_destroy' for each of them is
+    emitted before it.
+
+    ``hits`` and ``passes`` count the hits and the resolution passes.
+
+    :param dispatcher: RoutingDispatcher
+    """
+    def __init__(self, *args, dispatcher, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = dispatcher
+        # {entity ID: damage}, in the order of the first hits
+        self.pending = {}
+        self.hits = 0
+        self.passes = 0
+
+    def on_event(self, event):
+        if event.event_type == 'ac_damage':
+            if not self.pending:
+                self.dispatcher.defer(self.resolve)
+            entity_id, damage = event.event_value
+            self.pending[entity_id] = self.pending.get(entity_id, 0) + damage
+            self.hits += 1
+
+    def resolve(self):
+        """
+        Apply all the collected hits and report them
+        """
+        index = EntityIndex()
+        entities = EntityTracker().entities
+        damage = {}
+        destroyed = []
+        for entity_id, amount in self.pending.items():
+            # Destroyed entities are dropped from the index right away
+            if not index.has_component(entity_id, 'health'):
+                continue
+            entity = entities[entity_id]
+            entity.health.hitpoints -= amount
+            damage[entity_id] = amount
+            if hasattr(entity, 'destructor') and \
+                    entity.destructor.is_destroying:
+                destroyed.append(entity_id)
+        self.pending = {}
+        self.passes += 1
+        if damage:
+            self.dispatcher.add_event(BearEvent('ac_damage_resolved',
+                                                (damage, destroyed)))
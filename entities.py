@@ -12,6 +12,13 @@ from bear_hug.widgets import Widget, SwitchingWidget
 from collections import OrderedDict
 from json import dumps, loads
 from random import choice
+from weakref import WeakKeyDictionary
+
+from routing import RoutingDispatcher
+from spatial import GridECSLayout
+from storage import CompactPositionComponent, CompactHealthMixin, \
+    CompactDestructorComponent
+from tags import EntityIndex, Tag
 
 ################################################################################
 # Entity creation functions
@@ -22,29 +29,210 @@ from random import choice
 # dispatcher and whatever else may be useful for multiple entities, etc etc.
 #
 # However, since this is a quick-and-dirty demo with five types of entities,
-# a bunch of functions will suffice
+# a bunch of functions will suffice. The only factory-like part is Prototypes,
+# which makes sure that the images are taken from atlas once per entity type
+# rather than once per entity.
+
+# {archetype: (atlas image names, initial image)}
+ARCHETYPES = {'player': (('player_r', 'player_l', 'player_d', 'player_u'),
+                         'player_r'),
+              'enemy': (('enemy_r', 'enemy_l', 'enemy_d', 'enemy_u'),
+                        'enemy_r'),
+              'wall': (('wall_3', 'wall_2', 'wall_1'), 'wall_3')}
+
+
+class SharedSwitchingWidget(SwitchingWidget):
+    """
+    A SwitchingWidget that trusts its images.
+
+    Skips the shape checks that SwitchingWidget does for every image, because
+    Prototypes have already done them once for the whole archetype. The
+    images are shared with the other widgets of the same archetype and should
+    not be modified.
+
+    Image switches are reported to the parent layout, so that a layout which
+    only redraws what has changed knows about them.
+    """
+    def __init__(self, images_dict, initial_image):
+        Widget.__init__(self, *images_dict[initial_image])
+        self.images = images_dict
+        self.current_image = initial_image
+
+    def switch_to_image(self, image_id):
+        if image_id != self.current_image:
+            super().switch_to_image(image_id)
+            if isinstance(self.parent, GridECSLayout):
+                self.parent.redraw_child(self)
+
+    def __repr__(self):
+        # Serialized as a regular SwitchingWidget, which can validate the
+        # images when deserialized
+        d = loads(super().__repr__())
+        d['class'] = 'SwitchingWidget'
+        return dumps(d)
+
+
+class Prototypes:
+    """
+    A registry of entity archetypes with pre-resolved images.
+
+    Every archetype is declared once with the names of its atlas images. Those
+    are taken from the atlas on the first use and then shared, read-only, by
+    the widgets of all the entities of this archetype. So creating yet another
+    wall only costs its components and the per-instance state (ID, position,
+    hitpoints).
+
+    Atlas elements are cached too, and ``get_element`` can be used in place of
+    ``Atlas.get_element`` for the images that nobody is going to modify.
+
+    :param atlas: an Atlas
+
+    :param archetypes: a dict of ``{name: (image names, initial image)}``.
+    Defaults to ARCHETYPES.
+    """
+    def __init__(self, atlas, archetypes=None):
+        self.atlas = atlas
+        # {element name: (chars, colors)}
+        self.elements = {}
+        # {archetype: (image names, initial image)}
+        self.archetypes = {}
+        # {archetype: images_dict}, filled on first use
+        self.images = {}
+        if archetypes is None:
+            archetypes = ARCHETYPES
+        for name, (image_names, initial_image) in archetypes.items():
+            self.declare(name, image_names, initial_image)
+
+    def declare(self, name, image_names, initial_image=None):
+        """
+        Add (or replace) an archetype.
+
+        :param name: archetype name
 
+        :param image_names: atlas element names of all the archetype's images
+
+        :param initial_image: the image that new entities start with. Defaults
+        to the first of ``image_names``.
+        """
+        if initial_image is None:
+            initial_image = image_names[0]
+        elif initial_image not in image_names:
+            raise BearECSException(
+                f'Initial image {initial_image} not in archetype {name}')
+        self.archetypes[name] = (tuple(image_names), initial_image)
+        self.images.pop(name, None)
+
+    def get_element(self, name):
+        """
+        Return an atlas element as (chars, colors).
+
+        Unlike ``Atlas.get_element``, the same lists are returned every time.
+        """
+        try:
+            return self.elements[name]
+        except KeyError:
+            element = self.atlas.get_element(name)
+            self.elements[name] = element
+            return element
+
+    def get_images(self, name):
+        """
+        Return a shared ``images_dict`` for an archetype
+        """
+        try:
+            return self.images[name]
+        except KeyError:
+            image_names, initial_image = self.archetypes[name]
+            images = {x: self.get_element(x) for x in image_names}
+            # Let SwitchingWidget validate the shapes once for everyone
+            SwitchingWidget(images_dict=images, initial_image=initial_image)
+            self.images[name] = images
+            return images
+
+    def create_widget(self, name):
+        """
+        Create a new widget for an entity of a given archetype
+        """
+        return SharedSwitchingWidget(self.get_images(name),
+                                     self.archetypes[name][1])
+
+
+# {Atlas: Prototypes}, so that every caller with the same atlas shares images
+_prototypes = WeakKeyDictionary()
+
+
+def get_prototypes(atlas):
+    """
+    Return Prototypes for a given atlas.
+
+    Accepts either an Atlas (in which case Prototypes are created once per
+    atlas and reused) or Prototypes themselves.
+    """
+    if isinstance(atlas, Prototypes):
+        return atlas
+    try:
+        return _prototypes[atlas]
+    except KeyError:
+        prototypes = Prototypes(atlas)
+        _prototypes[atlas] = prototypes
+        return prototypes
+
+
+def position_component(dispatcher, *args, storage=None, **kwargs):
+    """
+    Create a PositionComponent, or its compact version if storage is set
+    """
+    if storage:
+        return CompactPositionComponent(dispatcher, *args, storage=storage,
+                                        **kwargs)
+    return PositionComponent(dispatcher, *args, **kwargs)
 
-def create_player_tank(dispatcher, atlas, x, y):
+
+def health_component(health_class, dispatcher, *args, storage=None, **kwargs):
+    """
+    Create a HealthComponent subclass, or its compact version if storage is set
+    """
+    if storage:
+        return COMPACT_HEALTH_CLASSES[health_class](dispatcher, *args,
+                                                    storage=storage, **kwargs)
+    return health_class(dispatcher, *args, **kwargs)
+
+
+def destructor_component(dispatcher, *args, storage=None, **kwargs):
+    """
+    Create a DestructorComponent, or its compact version if storage is set
+    """
+    if storage:
+        return CompactDestructorComponent(dispatcher, *args, **kwargs)
+    return DestructorComponent(dispatcher, *args, **kwargs)
+
+
+def create_player_tank(dispatcher, atlas, x, y, bullet_pool=None,
+                       storage=None, entity_id='player', networked=False):
     # Creating the actual entity, which currently has only a name
-    player = Entity(id='player')
+    player = Entity(id=entity_id)
+    player.tags = Tag.PLAYER_TANK
     # Adding all necessary components, in our case input (which also spawns
     # bullets), two collision-related ones, position, health and a destructor
     # for orderly entity removal.
-    player.add_component(InputComponent(dispatcher))
-    player.add_component(WalkerCollisionComponent(dispatcher))
+    # Networked players take their keys from 'ac_input' rather than the
+    # terminal. Only the first player's bullets are just 'bullet_'
+    bullet_prefix = 'bullet_' if entity_id == 'player' \
+        else f'{entity_id}_bullet_'
+    input_class = NetInputComponent if networked else InputComponent
+    player.add_component(input_class(dispatcher, bullet_pool=bullet_pool,
+                                     bullet_prefix=bullet_prefix))
+    player.add_component(TankCollisionComponent(dispatcher))
     player.add_component(PassingComponent(dispatcher))
-    player.add_component(PositionComponent(dispatcher, x, y))
-    player.add_component(DestructorHealthComponent(dispatcher, hitpoints=5))
-    player.add_component(DestructorComponent(dispatcher))
+    player.add_component(position_component(dispatcher, x, y,
+                                            storage=storage))
+    player.add_component(health_component(DestructorHealthComponent,
+                                          dispatcher, hitpoints=5,
+                                          storage=storage))
+    player.add_component(destructor_component(dispatcher, storage=storage))
     # Also a WidgetComponent, which requires a Widget
-    images_dict = {'player_r': atlas.get_element('player_r'),
-                   'player_l': atlas.get_element('player_l'),
-                   'player_d': atlas.get_element('player_d'),
-                   'player_u': atlas.get_element('player_u')}
-    player.add_component(SwitchWidgetComponent(dispatcher,
-                                               SwitchingWidget(images_dict=images_dict,
-                                                               initial_image='player_r')))
+    player.add_component(SwitchWidgetComponent(
+        dispatcher, get_prototypes(atlas).create_widget('player')))
     dispatcher.add_event(BearEvent('ecs_create', player))
     dispatcher.add_event(BearEvent('ecs_add', (player.id,
                                                player.position.x,
@@ -52,30 +240,38 @@ def create_player_tank(dispatcher, atlas, x, y):
     return player
 
 
-def create_enemy_tank(dispatcher, atlas, entity_id, x, y):
+def create_enemy_tank(dispatcher, atlas, entity_id, x, y, ai_system=None,
+                      bullet_pool=None, storage=None, controller_params=None):
     # ControllerComponent
     # DestructorHealthComponent
     # WalkerCollisionComponent
     # SwitchWidgetComponent
     enemy = Entity(id=entity_id)
+    enemy.tags = Tag.ENEMY_TANK
     # Adding all necessary components, in our case input (which also spawns
     # bullets), two collision-related ones, position, health and a destructor
     # for orderly entity removal.
-    enemy.add_component(WalkerCollisionComponent(dispatcher))
+    enemy.add_component(TankCollisionComponent(dispatcher))
     enemy.add_component(PassingComponent(dispatcher))
-    enemy.add_component(PositionComponent(dispatcher, x, y))
-    enemy.add_component(DestructorHealthComponent(dispatcher, hitpoints=1))
-    enemy.add_component(DestructorComponent(dispatcher))
-    enemy.add_component(ControllerComponent(dispatcher))
+    enemy.add_component(position_component(dispatcher, x, y,
+                                           storage=storage))
+    enemy.add_component(health_component(DestructorHealthComponent,
+                                         dispatcher, hitpoints=1,
+                                         storage=storage))
+    enemy.add_component(destructor_component(dispatcher, storage=storage))
+    # If there is a batched AI system, it provides the controller.
+    # controller_params are AI constants, such as move_delay
+    controller_params = controller_params or {}
+    if ai_system:
+        enemy.add_component(ai_system.create_controller(
+            dispatcher, bullet_pool=bullet_pool, **controller_params))
+    else:
+        enemy.add_component(ControllerComponent(dispatcher,
+                                                bullet_pool=bullet_pool,
+                                                **controller_params))
     # Also a WidgetComponent, which requires a Widget
-    images_dict = {'enemy_r': atlas.get_element('enemy_r'),
-                   'enemy_l': atlas.get_element('enemy_l'),
-                   'enemy_d': atlas.get_element('enemy_d'),
-                   'enemy_u': atlas.get_element('enemy_u')}
-    enemy.add_component(SwitchWidgetComponent(dispatcher,
-                                               SwitchingWidget(
-                                                   images_dict=images_dict,
-                                                   initial_image='enemy_r')))
+    enemy.add_component(SwitchWidgetComponent(
+        dispatcher, get_prototypes(atlas).create_widget('enemy')))
     dispatcher.add_event(BearEvent('ecs_create', enemy))
     dispatcher.add_event(BearEvent('ecs_add', (enemy.id,
                                                enemy.position.x,
@@ -83,39 +279,41 @@ def create_enemy_tank(dispatcher, atlas, entity_id, x, y):
     return enemy
 
 
-def create_wall(dispatcher, atlas, entity_id, x, y):
+def create_wall(dispatcher, atlas, entity_id, x, y, storage=None):
     wall = Entity(entity_id)
-    wall.add_component(PositionComponent(dispatcher, x, y))
-    wall.add_component(CollisionComponent(dispatcher))
+    wall.tags = Tag.WALL
+    wall.add_component(position_component(dispatcher, x, y, storage=storage))
+    wall.add_component(RoutedCollisionComponent(dispatcher))
     wall.add_component(PassingComponent(dispatcher))
-    wall.add_component(DestructorComponent(dispatcher))
-    images_dict = {'wall_3': atlas.get_element('wall_3'),
-                   'wall_2': atlas.get_element('wall_2'),
-                   'wall_1': atlas.get_element('wall_1')}
-    wall.add_component(SwitchWidgetComponent(dispatcher,
-                                             SwitchingWidget(images_dict=images_dict,
-                                                             initial_image='wall_3')))
-    wall.add_component(VisualDamageHealthComponent(dispatcher,
-                                                   hitpoints=3,
-                                                   widgets_dict={3: 'wall_3',
-                                                                 2: 'wall_2',
-                                                                 1: 'wall_1'}))
+    wall.add_component(destructor_component(dispatcher, storage=storage))
+    wall.add_component(SwitchWidgetComponent(
+        dispatcher, get_prototypes(atlas).create_widget('wall')))
+    wall.add_component(health_component(VisualDamageHealthComponent,
+                                        dispatcher,
+                                        hitpoints=3,
+                                        widgets_dict={3: 'wall_3',
+                                                      2: 'wall_2',
+                                                      1: 'wall_1'},
+                                        storage=storage))
 
     dispatcher.add_event(BearEvent('ecs_create', wall))
     dispatcher.add_event(BearEvent('ecs_add', (wall.id,
                                                wall.position.x,
                                                wall.position.y)))
-    pass
+    return wall
 
 
-def create_bullet(dispatcher, entity_id, x, y, vx, vy):
+def create_bullet(dispatcher, entity_id, x, y, vx, vy, storage=None,
+                  tags=Tag.BULLET):
+    # tags tell whose bullet it is, eg Tag.ENEMY_BULLET
     bullet = Entity(entity_id)
+    bullet.tags = tags
     bullet.add_component(WidgetComponent(dispatcher,
                                          Widget([['*']], [['red']])))
-    bullet.add_component(PositionComponent(dispatcher, x, y,
-                                           vx, vy))
+    bullet.add_component(position_component(dispatcher, x, y, vx, vy,
+                                            storage=storage))
     bullet.add_component(ProjectileCollisionComponent(dispatcher, damage=1))
-    bullet.add_component(DestructorComponent(dispatcher))
+    bullet.add_component(destructor_component(dispatcher, storage=storage))
     dispatcher.add_event(BearEvent('ecs_create', bullet))
     dispatcher.add_event(BearEvent('ecs_add', (bullet.id,
                                                bullet.position.x,
@@ -123,30 +321,229 @@ def create_bullet(dispatcher, entity_id, x, y, vx, vy):
     return bullet
 
 
-def create_spawner_house(dispatcher, atlas, x, y):
+class BulletPool:
+    """
+    Recycles bullet entities instead of creating a new one for every shot.
+
+    A destroyed pooled bullet goes through the usual 'ecs_destroy' (so the
+    EntityTracker, layout and labels see it as destroyed), but its Entity,
+    Widget and components are kept and reused by the next shot. IDs are stable:
+    every pooled bullet keeps its ID for life, so a given ID is never used by
+    two live bullets at once.
+
+    IDs are ``prefix`` plus a per-prefix counter. Tags are set anew on every
+    shot, so a bullet can be reused by either side.
+
+    ``hits`` and ``misses`` count the shots that reused a bullet and those that
+    had to create a new one.
+
+    If ``storage`` is set, bullet positions are kept in CompactStorage.
+    """
+    def __init__(self, dispatcher, damage=1, storage=None):
+        self.dispatcher = dispatcher
+        self.damage = damage
+        self.storage = storage
+        # {prefix: [inactive bullets]}
+        self.free = {}
+        # {prefix: number of bullets ever created}
+        self.counters = {}
+        # {bullet_id: prefix}
+        self.prefixes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        """
+        Total number of bullets in the pool, both active and inactive
+        """
+        return sum(self.counters.values())
+
+    @property
+    def available(self):
+        """
+        Number of inactive bullets
+        """
+        return sum(len(x) for x in self.free.values())
+
+    def fire(self, prefix, x, y, vx, vy, bullet_id=None, tags=Tag.BULLET):
+        """
+        Put a bullet on the map, reusing an inactive one if possible.
+
+        :param prefix: bullet ID prefix
+
+        :param bullet_id: if set, this specific bullet is fired (eg when
+        restoring a snapshot). It is taken from the inactive ones if it's
+        there, or created otherwise. It should start with ``prefix``.
+
+        :param tags: bullet tags, eg Tag.ENEMY_BULLET
+
+        :returns: bullet Entity
+        """
+        free = self.free.get(prefix)
+        if bullet_id is not None:
+            bullet = next((x for x in free or () if x.id == bullet_id), None)
+            if bullet:
+                free.remove(bullet)
+        elif free:
+            # The lowest number, rather than the latest released, so that the
+            # choice doesn't depend on the order the bullets were destroyed in
+            # (which a restored snapshot doesn't reproduce)
+            bullet = min(free, key=lambda x: int(x.id[len(prefix):]))
+            free.remove(bullet)
+        else:
+            bullet = None
+        if bullet:
+            self.hits += 1
+            position = bullet.position
+            position.move(x, y, emit_event=False)
+            position.vx = vx
+            position.vy = vy
+            position.x_waited = 0
+            position.y_waited = 0
+            position.last_move = (1, 0)
+            # Destructor has unsubscribed everything, so resubscribing in the
+            # same order the components did it in their __init__
+            self.dispatcher.register_listener(bullet.widget, 'tick')
+            self.dispatcher.register_listener(position, 'tick')
+            bullet.collision.subscribe()
+            self.dispatcher.register_listener(bullet.destructor,
+                                              ['service', 'tick'])
+            bullet.destructor.is_destroying = False
+        else:
+            self.misses += 1
+            number = self.counters.get(prefix, 0)
+            if bullet_id is not None:
+                # Later bullets shouldn't get the same ID
+                number = max(number, int(bullet_id[len(prefix):]))
+            self.counters[prefix] = number + 1
+            bullet = Entity(bullet_id or f'{prefix}{number}')
+            self.prefixes[bullet.id] = prefix
+            bullet.add_component(WidgetComponent(self.dispatcher,
+                                                 Widget([['*']], [['red']])))
+            bullet.add_component(position_component(self.dispatcher, x, y,
+                                                    vx, vy,
+                                                    storage=self.storage))
+            bullet.add_component(ProjectileCollisionComponent(
+                self.dispatcher, damage=self.damage))
+            bullet.add_component(PooledDestructorComponent(self.dispatcher,
+                                                           pool=self))
+        bullet.tags = tags
+        self.dispatcher.add_event(BearEvent('ecs_create', bullet))
+        self.dispatcher.add_event(BearEvent('ecs_add', (bullet.id,
+                                                        bullet.position.x,
+                                                        bullet.position.y)))
+        return bullet
+
+    def release(self, bullet):
+        """
+        Return a destroyed bullet to the pool.
+
+        Called by PooledDestructorComponent at the end of the tick.
+        """
+        self.free.setdefault(self.prefixes[bullet.id], []).append(bullet)
+
+
+def create_spawner_house(dispatcher, atlas, x, y, storage=None):
     house = Entity('house')
-    house.add_component(WidgetComponent(dispatcher,
-                                        Widget(*atlas.get_element('spawner'))))
-    house.add_component(DestructorComponent(dispatcher))
-    house.add_component(PositionComponent(dispatcher, x, y))
+    house.tags = Tag.HOUSE
+    house.add_component(WidgetComponent(
+        dispatcher, Widget(*get_prototypes(atlas).get_element('spawner'))))
+    house.add_component(destructor_component(dispatcher, storage=storage))
+    house.add_component(position_component(dispatcher, x, y,
+                                           storage=storage))
     dispatcher.add_event(BearEvent('ecs_create', house))
     dispatcher.add_event(BearEvent('ecs_add', (house.id,
                                                house.position.x,
                                                house.position.y)))
+    return house
 
 ################################################################################
 # Components
 ################################################################################
 
 
+class RoutedComponent(Component):
+    """
+    A component that wants only those events that are addressed to its owner.
+
+    Event types listed in ``routed_events`` are subscribed to with the owner's
+    ID as an address, if the dispatcher is a RoutingDispatcher. The
+    subscription follows the owner, so it is only active while the component
+    is attached to some Entity. With a regular BearEventDispatcher, these event
+    types are subscribed to as usual.
+
+    Either way, subclasses should still check that the event is about their
+    owner, because some routes have more than one address (eg a collision is
+    sent to both entities involved).
+    """
+    routed_events = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        routing = isinstance(self.dispatcher, RoutingDispatcher)
+        for event_type in self.routed_events:
+            subscribed = self in self.dispatcher.listeners[event_type]
+            if routing and subscribed:
+                # Some bear_hug parent classes subscribe in their __init__
+                self.dispatcher.unregister_listener(self, [event_type])
+                if self.owner:
+                    self.dispatcher.register_routed_listener(
+                        self, event_type, self.owner.id)
+            elif not routing and not subscribed:
+                self.dispatcher.register_listener(self, event_type)
+
+    def subscribe(self):
+        """
+        Subscribe to ``routed_events`` again, eg after the component was
+        unsubscribed from everything by a DestructorComponent
+        """
+        if isinstance(self.dispatcher, RoutingDispatcher):
+            if self.owner is not None:
+                self.dispatcher.register_routed_listener(self,
+                                                         self.routed_events,
+                                                         self.owner.id)
+        else:
+            self.dispatcher.register_listener(self, list(self.routed_events))
+
+    @property
+    def owner(self):
+        return self._owner
+
+    @owner.setter
+    def owner(self, value):
+        routing = isinstance(self.dispatcher, RoutingDispatcher)
+        if routing and getattr(self, '_owner', None) is not None:
+            self.dispatcher.unregister_routed_listener(self,
+                                                       self.routed_events)
+        self._owner = value
+        if routing and value is not None:
+            self.dispatcher.register_routed_listener(self, self.routed_events,
+                                                     value.id)
+
+
+class RoutedCollisionComponent(RoutedComponent, CollisionComponent):
+    """
+    A CollisionComponent that only gets the collisions of its owner
+    """
+    routed_events = ('ecs_collision',)
+
+
 class InputComponent(Component):
     """
     A component that handles input.
+
+    If ``bullet_pool`` is set, shots are taken from it. ``bullet_prefix``
+    starts the IDs of the bullets, so that several players' bullets don't
+    clash.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, bullet_pool=None, bullet_prefix='bullet_',
+                 **kwargs):
         super().__init__(*args, name='controller', **kwargs)
         self.dispatcher.register_listener(self, 'key_down')
+        self.bullet_pool = bullet_pool
+        self.bullet_prefix = bullet_prefix
         self.bullet_count = 0
         self.bullet_offsets = {(1, 0): (7, 2),
                                (-1, 0): (-2, 2),
@@ -162,40 +559,140 @@ class InputComponent(Component):
         else:
             r = []
         if event.event_type == 'key_down':
-            moved = False
-            if event.event_value == 'TK_SPACE':
-                bullet_offset = self.bullet_offsets[self.owner.position.last_move]
-                create_bullet(self.dispatcher, f'bullet_{self.bullet_count}',
-                              self.owner.position.x + bullet_offset[0],
-                              self.owner.position.y + bullet_offset[1],
-                              self.owner.position.last_move[0] * 20,
-                              self.owner.position.last_move[1] * 20)
-                self.bullet_count += 1
-                self.dispatcher.add_event(BearEvent('play_sound', 'shot'))
-            elif event.event_value in ('TK_D', 'TK_RIGHT'):
-                move = (1, 0)
-                self.owner.widget.switch_to_image('player_r')
-                moved = True
-            elif event.event_value in ('TK_A', 'TK_LEFT'):
-                move = (-1, 0)
-                self.owner.widget.switch_to_image('player_l')
-                moved = True
-            elif event.event_value in ('TK_S', 'TK_DOWN'):
-                move = (0, 1)
-                self.owner.widget.switch_to_image('player_d')
-                moved = True
-            elif event.event_value in ('TK_W', 'TK_UP'):
-                move = (0, -1)
-                self.owner.widget.switch_to_image('player_u')
-                moved = True
-            if moved:
-                # Remembered for shots
-                self.direction = move
-                self.owner.position.relative_move(*move)
+            self.press(event.event_value)
         return r
 
+    def press(self, key):
+        """
+        Move or shoot, as told by a key
+        """
+        moved = False
+        if key == 'TK_SPACE':
+            bullet_offset = self.bullet_offsets[self.owner.position.last_move]
+            bullet_args = (self.owner.position.x + bullet_offset[0],
+                           self.owner.position.y + bullet_offset[1],
+                           self.owner.position.last_move[0] * 20,
+                           self.owner.position.last_move[1] * 20)
+            if self.bullet_pool:
+                self.bullet_pool.fire(self.bullet_prefix, *bullet_args,
+                                      tags=Tag.PLAYER_BULLET)
+            else:
+                create_bullet(self.dispatcher,
+                              f'{self.bullet_prefix}{self.bullet_count}',
+                              *bullet_args, tags=Tag.PLAYER_BULLET)
+            self.bullet_count += 1
+            self.dispatcher.add_event(BearEvent('play_sound', 'shot'))
+        elif key in ('TK_D', 'TK_RIGHT'):
+            move = (1, 0)
+            self.owner.widget.switch_to_image('player_r')
+            moved = True
+        elif key in ('TK_A', 'TK_LEFT'):
+            move = (-1, 0)
+            self.owner.widget.switch_to_image('player_l')
+            moved = True
+        elif key in ('TK_S', 'TK_DOWN'):
+            move = (0, 1)
+            self.owner.widget.switch_to_image('player_d')
+            moved = True
+        elif key in ('TK_W', 'TK_UP'):
+            move = (0, -1)
+            self.owner.widget.switch_to_image('player_u')
+            moved = True
+        if moved:
+            # Remembered for shots
+            self.direction = move
+            self.owner.position.relative_move(*move)
+
+
+class NetInputComponent(RoutedComponent, InputComponent):
+    """
+    An InputComponent that takes its keys from 'ac_input' events instead of
+    the terminal.
 
-class ControllerComponent(Component):
+    The value of 'ac_input' is ``(entity_id, key)``, and it is routed to the
+    entity. This way several players can share the map, each pressing their
+    own keys; in lockstep multiplayer (see netplay.py), it is also how the
+    keys are delayed until every player has them.
+    """
+    routed_events = ('ac_input',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher.unregister_listener(self, ['key_down'])
+
+    def on_event(self, event):
+        if event.event_type == 'ac_input' and \
+                event.event_value[0] == self.owner.id:
+            self.press(event.event_value[1])
+
+
+class TankCollisionComponent(RoutedComponent, WalkerCollisionComponent):
+    """
+    A WalkerCollisionComponent that puts the tank back where it was at the
+    end of the previous tick.
+
+    Walker steps back by ``last_move``, which only works for a single move.
+    A player holding two keys moves twice per tick, and the collisions of
+    both moves arrive after the second one, so stepping back by the same
+    ``last_move`` twice would leave the tank inside a wall or off the map.
+    Instead, every collision of a tank that has moved this tick undoes all
+    of its moves. Collisions at the settled position, such as the ones caused
+    by the undo itself, are ignored: otherwise a tank squeezed between the
+    screen edge and another tank would be bounced between them forever. If
+    the undo runs into a tank that has moved into the vacated place during
+    the same tick, it is that tank which is put back.
+    """
+    routed_events = ('ecs_collision',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher.register_listener(self, 'service')
+        # Position at the end of the previous tick
+        self.settled = None
+
+    def on_event(self, event):
+        if event.event_type == 'service' and event.event_value == 'tick_over':
+            self.settle()
+        return super().on_event(event)
+
+    def settle(self):
+        """
+        Remember the current position as the one to go back to.
+
+        Called at every 'tick_over'. Whoever moves the tank between ticks
+        (eg snapshot.Snapshotter) should call it as well.
+        """
+        self.settled = self.owner.position.pos
+
+    def collided_into(self, entity):
+        position = self.owner.position
+        if self.settled is None:
+            # Created this tick. It could only have moved once, if at all
+            self.settled = (position.x - position.last_move[0],
+                            position.y - position.last_move[1])
+        if position.pos == self.settled:
+            return
+        if entity is not None:
+            other = EntityTracker().entities.get(entity)
+            if other is None or 'passability' not in self.owner.__dict__ \
+                    or 'passability' not in other.__dict__:
+                return
+        # Same as Walker, pretend the moves never happened
+        last_move = position.last_move
+        position.move(*self.settled)
+        position.last_move = last_move
+
+    def collided_by(self, entity):
+        # Another tank was put back where it was, but this one has taken the
+        # place in the meantime. It's this one that has to step back
+        other = EntityTracker().entities.get(entity)
+        collision = other.__dict__.get('collision') if other else None
+        if isinstance(collision, TankCollisionComponent) and \
+                other.position.pos == collision.settled:
+            self.collided_into(entity)
+
+
+class ControllerComponent(RoutedComponent):
     """
     Enemy controller component.
 
@@ -203,13 +700,48 @@ class ControllerComponent(Component):
     Otherwise randomly chooses the direction (weighted so that it would be
     mostly towards the player) and keeps moving. If collided into something,
     reconsiders the direction.
+
+    If ``bullet_pool`` is set, shots are taken from it.
+
+    If ``flow_field`` is set, a tank without a line of fire follows it towards
+    the player instead of keeping a random direction. After a collision, it
+    drives a random direction for ``detour`` steps before getting back to the
+    flow field, so that it doesn't keep bumping into the same tank.
+
+    If ``line_of_sight`` is set, a line to the player that is blocked by walls
+    doesn't count as a line of fire: the tank neither turns towards the
+    player nor shoots.
+
+    :param move_delay: seconds between steps
+
+    :param shoot_delay: seconds between shots
+
+    :param weight_distance: when choosing a random direction, every
+    ``weight_distance`` chars to the player along a direction add one more
+    chance of choosing it.
+
+    :param flow_field: pathfinding.FlowField
+
+    :param detour: steps to drive randomly after a collision
+
+    :param line_of_sight: sight.LineOfSight
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.dispatcher.register_listener(self, ['tick', 'ecs_collision'])
-        # Move 5 steps a second, shoot twice a second
-        self.move_delay = 0.1
-        self.shoot_delay = 1
+    routed_events = ('ecs_collision',)
+
+    def __init__(self, *args, bullet_pool=None, move_delay=0.1, shoot_delay=1,
+                 weight_distance=10, flow_field=None, detour=6,
+                 line_of_sight=None, **kwargs):
+        super().__init__(*args, name='controller', **kwargs)
+        self.dispatcher.register_listener(self, 'tick')
+        self.bullet_pool = bullet_pool
+        self.flow_field = flow_field
+        self.detour = detour
+        self.detour_left = 0
+        self.line_of_sight = line_of_sight
+        # Move 10 steps a second, shoot once a second by default
+        self.move_delay = move_delay
+        self.shoot_delay = shoot_delay
+        self.weight_distance = weight_distance
         self.move_cd = self.move_delay
         self.shoot_cd = self.shoot_delay
         # Prevents a bug where two tanks collide into each other (eg when one of
@@ -242,54 +774,105 @@ class ControllerComponent(Component):
                     return
                 dx = player_x - self.owner.position.x
                 dy = player_y - self.owner.position.y
+                vertical, horizontal = self.lines_of_fire(dx, dy)
                 # Turn towards player if has direct line of fire
-                if abs(dx) < 3:
+                if vertical:
                     self.direction = (0, 1 if dy > 0 else -1)
                     self.owner.widget.switch_to_image(
                         self.images[self.direction])
-                if abs(dy) < 3:
+                if horizontal:
                     self.direction = (1 if dx > 0 else -1, 0)
                     self.owner.widget.switch_to_image(
                         self.images[self.direction])
+                elif not vertical and self.flow_field is not None:
+                    self.follow_flow_field()
                 if self.direction is not None:
                     self.owner.position.relative_move(*self.direction)
                     # Shoot if necessary
-                    if self.shoot_cd <= 0 and (abs(dx) < 3 or abs(dy) < 3):
-                        offset = self.bullet_offsets[self.direction]
-                        create_bullet(self.dispatcher,
-                                      f'{self.owner.id}_bullet{self.bullet_count}',
-                                      self.owner.position.x + offset[0],
-                                      self.owner.position.y + offset[1],
-                                      self.direction[0] * 20,
-                                      self.direction[1] * 20)
-                        self.bullet_count += 1
-                        self.shoot_cd = self.shoot_delay
-                        self.dispatcher.add_event(
-                            BearEvent('play_sound', 'shot'))
+                    if self.shoot_cd <= 0 and (vertical or horizontal):
+                        self.shoot()
                 else:
                     directions = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+                    weight = self.weight_distance
                     if dx > 0:
-                        directions.extend([(1, 0)] * int(dx / 10))
+                        directions.extend([(1, 0)] * int(dx / weight))
                     elif dx < 0:
-                        directions.extend([(-1, 0)] * int(dx / -10))
+                        directions.extend([(-1, 0)] * int(dx / -weight))
                     if dy > 0:
-                        directions.extend([(0, 1)] * int(dy / 10))
+                        directions.extend([(0, 1)] * int(dy / weight))
                     elif dy < 0:
-                        directions.extend([(0, -1)] * int(dy / -10))
+                        directions.extend([(0, -1)] * int(dy / -weight))
                     self.direction = choice(directions)
                     self.owner.widget.switch_to_image(self.images[self.direction])
                 self.move_cd = self.move_delay
         elif event.event_type == 'ecs_collision'\
                 and event.event_value[0] == self.owner.id \
                 and not self.rotated_this_tick:
-            if event.event_value[1] is None or hasattr(
-                                EntityTracker().entities[event.event_value[1]],
-                                'collision'):
+            if event.event_value[1] is None or EntityIndex().has_component(
+                                event.event_value[1], 'collision'):
                 self.direction = None
                 self.rotated_this_tick = True
+                self.detour_left = self.detour
+
+    def lines_of_fire(self, dx, dy):
+        """
+        Check whether the player can be shot at.
 
+        :param dx: player's x minus owner's x
+
+        :param dy: player's y minus owner's y
+
+        :returns: a tuple of two bools: vertical and horizontal line of fire.
+        """
+        vertical = abs(dx) < 3
+        horizontal = abs(dy) < 3
+        if self.line_of_sight is not None and (vertical or horizontal):
+            x, y = self.owner.position.pos
+            # Bullets fly along the middle of the tank. Tiles taken by
+            # tanks themselves can't have walls, so checking the tiles from
+            # the owner's corner to the player's one is enough
+            if vertical:
+                vertical = self.line_of_sight.clear_column(x + 2, y, y + dy)
+            if horizontal:
+                horizontal = self.line_of_sight.clear_row(y + 2, x, x + dx)
+        return vertical, horizontal
+
+    def follow_flow_field(self):
+        """
+        Turn towards the player along the flow field, unless on a detour.
+
+        If the field doesn't know the way, the direction is left as it is.
+        """
+        if self.detour_left > 0:
+            self.detour_left -= 1
+            return
+        direction = self.flow_field.direction(*self.owner.position.pos)
+        if direction is not None and direction != self.direction:
+            self.direction = direction
+            self.owner.widget.switch_to_image(self.images[direction])
+
+    def shoot(self):
+        """
+        Fire a bullet in the current direction and reset shooting cooldown
+        """
+        offset = self.bullet_offsets[self.direction]
+        bullet_args = (self.owner.position.x + offset[0],
+                       self.owner.position.y + offset[1],
+                       self.direction[0] * 20,
+                       self.direction[1] * 20)
+        if self.bullet_pool:
+            self.bullet_pool.fire('enemy_bullet_', *bullet_args,
+                                  tags=Tag.ENEMY_BULLET)
+        else:
+            create_bullet(self.dispatcher,
+                          f'{self.owner.id}_bullet{self.bullet_count}',
+                          *bullet_args, tags=Tag.ENEMY_BULLET)
+        self.bullet_count += 1
+        self.shoot_cd = self.shoot_delay
+        self.dispatcher.add_event(BearEvent('play_sound', 'shot'))
 
-class HealthComponent(Component):
+
+class HealthComponent(RoutedComponent):
     """
     A component that monitors owner's health and updates whatever needs updating
 
@@ -299,10 +882,10 @@ class HealthComponent(Component):
 
     This class should be inherited from, overriding `process_hitpoint_update`
     """
+    routed_events = ('ac_damage',)
 
     def __init__(self, *args, hitpoints=3, **kwargs):
         super().__init__(*args, name='health', **kwargs)
-        self.dispatcher.register_listener(self, 'ac_damage')
         self._hitpoints = hitpoints
 
     def on_event(self, event):
@@ -380,7 +963,27 @@ class VisualDamageHealthComponent(HealthComponent):
         return dumps(d)
 
 
-class ProjectileCollisionComponent(CollisionComponent):
+class CompactDestructorHealthComponent(CompactHealthMixin,
+                                      DestructorHealthComponent):
+    """
+    DestructorHealthComponent with hitpoints in CompactStorage
+    """
+
+
+class CompactVisualDamageHealthComponent(CompactHealthMixin,
+                                         VisualDamageHealthComponent):
+    """
+    VisualDamageHealthComponent with hitpoints in CompactStorage
+    """
+
+
+# {HealthComponent subclass: its compact version}
+COMPACT_HEALTH_CLASSES = {
+    DestructorHealthComponent: CompactDestructorHealthComponent,
+    VisualDamageHealthComponent: CompactVisualDamageHealthComponent}
+
+
+class ProjectileCollisionComponent(RoutedCollisionComponent):
     """
     A collision component that damages whatever its owner is collided into
     """
@@ -392,7 +995,7 @@ class ProjectileCollisionComponent(CollisionComponent):
     def collided_into(self, entity):
         if not entity:
             self.owner.destructor.destroy()
-        elif hasattr(EntityTracker().entities[entity], 'collision'):
+        elif EntityIndex().has_component(entity, 'collision'):
             self.dispatcher.add_event(BearEvent(event_type='ac_damage',
                                                 event_value=(
                                                 entity, self.damage)))
@@ -401,4 +1004,32 @@ class ProjectileCollisionComponent(CollisionComponent):
     def __repr__(self):
         d = loads(super().__repr__())
         d['damage'] = self.damage
-        return dumps(d)
\ No newline at end of file
+        return dumps(d)
+
+
+class PooledDestructorComponent(DestructorComponent):
+    """
+    A DestructorComponent that returns its owner to the BulletPool instead of
+    taking it apart.
+
+    Like DestructorComponent, it emits 'ecs_destroy' and unsubscribes the
+    other components immediately, and finishes the job at the end of the tick.
+    """
+    def __init__(self, *args, pool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def on_event(self, event):
+        if self.is_destroying and event.event_type == 'service' \
+                and event.event_value == 'tick_over':
+            self.finish()
+
+    def finish(self):
+        """
+        Return the destroyed owner to the pool right away, without waiting
+        for the end of the tick
+        """
+        if self.is_destroying:
+            self.is_destroying = False
+            self.dispatcher.unregister_listener(self)
+            self.pool.release(self.owner)
@@ -1,30 +1,134 @@
 #! /usr/bin/env python3
 
-from bear_hug.bear_hug import BearTerminal, BearLoop
-from bear_hug.bear_utilities import copy_shape
+from bear_hug.bear_hug import BearLoop
 from bear_hug.ecs import EntityTracker
-from bear_hug.ecs_widgets import ECSLayout
-from bear_hug.event import BearEventDispatcher
-from bear_hug.resources import Atlas, XpLoader
 from bear_hug.sound import SoundListener
-from bear_hug.widgets import Widget, ClosingListener, LoggingListener
+from bear_hug.widgets import ClosingListener, LoggingListener
 
+import argparse
+import os
+import random
 import sys
 
-from entities import *
-from listeners import *
+from atlascache import CachedAtlas
+from netplay import LockstepLoop, host_game, join_game
+from render import RegionTerminal
+try:
+    from audio import Mixer
+except ImportError:
+    # No NumPy. Sounds are played by SoundListener, one at a time
+    Mixer = None
+from profiling import ProfilingDispatcher, ProfileReportListener
+from replay import LogWriter, RecordingLoop, FixedStepRecordingLoop
+from routing import RoutingDispatcher, route_to_first
+from timestep import FixedStepLoop
+from world import build_world
+
+parser = argparse.ArgumentParser(description='AsciiCity')
+parser.add_argument('level', nargs='?', default=None,
+                    help='Level file. Defaults to level1.json')
+parser.add_argument('--record', default=None,
+                    help='Record the session into this file. It can be '
+                         'replayed with replay.py')
+parser.add_argument('--seed', type=int, default=None,
+                    help='Seed for the random number generator')
+parser.add_argument('--profile', action='store_true',
+                    help='Measure time spent per listener and event type. '
+                         'The report is printed on F12 and on exit')
+parser.add_argument('--pathfinding', action='store_true',
+                    help='Enemies find their way to the player')
+parser.add_argument('--line-of-sight', action='store_true',
+                    help='Enemies do not shoot through walls')
+parser.add_argument('--fixed-step', action='store_true',
+                    help='Simulate at a fixed rate, skipping frames if '
+                         'rendering cannot keep up')
+parser.add_argument('--batched-damage', action='store_true',
+                    help='Apply all the hits once per tick')
+parser.add_argument('--chunked', action='store_true',
+                    help='Allow levels larger than the screen. Only the part '
+                         'of the map around the player is simulated')
+parser.add_argument('--map-size', type=int, nargs=2, default=None,
+                    metavar=('WIDTH', 'HEIGHT'),
+                    help='Play on a random map of this many tiles. Implies '
+                         '--chunked')
+parser.add_argument('--array-layout', action='store_true',
+                    help='Composite the map in NumPy arrays')
+parser.add_argument('--host', type=int, default=None, metavar='PORT',
+                    help='Wait for the second player on this port')
+parser.add_argument('--join', default=None, metavar='ADDRESS:PORT',
+                    help='Join the game hosted at this address')
+parser.add_argument('--delay', type=int, default=3,
+                    help='Input delay of a network game, in ticks. Set by '
+                         'the host')
+args = parser.parse_args()
+networked = args.host is not None or args.join is not None
+if args.host is not None and args.join is not None:
+    parser.error('Cannot both host and join a game')
+if networked and (args.record or args.fixed_step or args.chunked or
+                  args.map_size):
+    parser.error('Network games cannot be recorded, run with --fixed-step or '
+                 'played on chunked maps')
+# Enemy AI is random, so the seed is necessary to reproduce a session
+seed = args.seed
+if seed is None and (args.record or args.host is not None):
+    seed = random.getrandbits(64)
+world_kwargs = {'level': args.level, 'pathfinding': args.pathfinding,
+                'line_of_sight': args.line_of_sight,
+                'batched_damage': args.batched_damage,
+                'chunked': args.chunked or bool(args.map_size),
+                'map_size': args.map_size,
+                'array_layout': args.array_layout}
+# In a network game, both sides build the world from the host's seed and
+# settings, and then only exchange the keys (see netplay.py)
+if args.host is not None:
+    net_config = {'seed': seed, 'fps': 30, 'delay': args.delay,
+                  'hash_interval': 30, 'world': world_kwargs}
+    print(f'Waiting for the other player on port {args.host}',
+          file=sys.stderr)
+    connection = host_game(args.host, net_config)
+    slot = 0
+elif args.join is not None:
+    address, port = args.join.rsplit(':', 1)
+    connection, net_config = join_game(address, int(port))
+    seed = net_config['seed']
+    world_kwargs = net_config['world']
+    slot = 1
+if networked:
+    world_kwargs['players'] = 2
+if seed is not None:
+    random.seed(seed)
+# The level path is relative to the current directory on both sides
+if world_kwargs['level']:
+    world_kwargs['level'] = os.path.abspath(world_kwargs['level'])
 
 ################################################################################
 # bear_hug boilerplate
 ################################################################################
 
-# Launching the terminal. All kwargs are bearlibterminal terminal settings
-terminal = BearTerminal(font_path='cp437_12x12.png',
-                        size='91x60', title='AsciiCity',
-                        filter=['keyboard', 'mouse'])
-# Setting up the event loop
-dispatcher = BearEventDispatcher()
-loop = BearLoop(terminal, dispatcher)
+# Launching the terminal. All kwargs are bearlibterminal terminal settings.
+# RegionTerminal lets the map put on screen only the chars that have changed
+terminal = RegionTerminal(font_path='cp437_12x12.png',
+                          size='91x60', title='AsciiCity',
+                          filter=['keyboard', 'mouse'])
+# Setting up the event loop. Routing dispatcher lets components get only the
+# damage and collision events addressed to their owners. Profiling dispatcher
+# is the same, plus it times every listener
+dispatcher = ProfilingDispatcher() if args.profile else RoutingDispatcher()
+# Fixed step loop keeps ticks at exactly 1/30 s, drawing the map less often if
+# it has to
+if args.record:
+    # Also writes down the tick timing and every key pressed
+    loop_class = FixedStepRecordingLoop if args.fixed_step else RecordingLoop
+    loop = loop_class(terminal, dispatcher,
+                      LogWriter(args.record, seed, world_kwargs=world_kwargs))
+elif networked:
+    # Runs in lockstep with the other player's game
+    loop = LockstepLoop(terminal, dispatcher, connection, slot,
+                        delay=net_config['delay'], fps=net_config['fps'],
+                        hash_interval=net_config['hash_interval'])
+else:
+    loop_class = FixedStepLoop if args.fixed_step else BearLoop
+    loop = loop_class(terminal, dispatcher)
 
 ################################################################################
 # Listeners
@@ -34,86 +138,59 @@ loop = BearLoop(terminal, dispatcher)
 dispatcher.register_listener(ClosingListener(), ['misc_input', 'tick'])
 # If not subscribed, EntityTracker won't update its entity list correctly
 dispatcher.register_listener(EntityTracker(), ['ecs_create', 'ecs_destroy'])
-# Sound system
-jukebox = SoundListener({'shot': 'shot.wav',
-                         'explosion': 'explosion.wav'})
+# Sound system. Mixer decodes sounds once and plays them on its own thread
+sounds = {'shot': 'shot.wav',
+          'explosion': 'explosion.wav'}
 # https://freesound.org/people/EMSIarma/sounds/108852/
 # https://freesound.org/people/FlashTrauma/sounds/398283/
-dispatcher.register_listener(jukebox, 'play_sound')
+if Mixer:
+    jukebox = Mixer(sounds)
+    dispatcher.register_listener(jukebox, ['play_sound', 'service'])
+else:
+    jukebox = SoundListener(sounds)
+    dispatcher.register_listener(jukebox, 'play_sound')
 # Damage event type. Value set to (entity_id, damage)
 # This event type is prefixed with 'ac' (for AsciiCity) to separate it from
-# other event types
-dispatcher.register_event_type('ac_damage')
+# other event types. It is routed to the damaged entity
+dispatcher.register_event_type('ac_damage', route=route_to_first)
+# Keys of the networked players, routed to their tanks. Value set to
+# (entity_id, key)
+dispatcher.register_event_type('ac_input', route=route_to_first)
 # Setting up logging for this kind of event, just in case
 logger = LoggingListener(sys.stderr)
 dispatcher.register_listener(logger, ['ac_damage', 'play_sound'])
+if args.profile:
+    dispatcher.register_listener(ProfileReportListener(dispatcher=dispatcher),
+                                 ['key_down', 'key_up'])
 
 ################################################################################
-# Layout
+# Game world
 ################################################################################
 
-# Setting the level layout and its background.
-# Note that it's 80x60, while the window is 85x60. Rightmost 5 columns will be
-# used for score.
-
-chars = [[' ' for x in range(84)] for y in range(60)]
-colors = copy_shape(chars, 'gray')
-layout = ECSLayout(chars, colors)
-# Subscribing the layout to all events that have 'ecs' as a part of their
-# event_type
-dispatcher.register_listener(layout, 'all')
-
-################################################################################
-# Creating game entities
-################################################################################
-
-# Loading image atlas
-atlas = Atlas(XpLoader('battlecity.xp'),
-              'battlecity.json')
-
-# Creating in-game entities
-create_player_tank(dispatcher, atlas, 30, 50)
-wall_array = [[0 for _ in range(14)],
-              [0 for _ in range(14)],
-              [1, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0],
-              [1, 0, 1, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0],
-              [1, 1, 1, 0, 1, 0, 1, 0, 0, 1, 1, 0, 1, 1],
-              [1, 0, 1, 0, 1, 1, 1, 0, 0, 1, 1, 0, 1, 0],
-              [1, 0, 1, 0, 1, 0, 1, 0, 0, 1, 1, 0, 1, 0],
-              [0 for _ in range(14)],
-              [0 for _ in range(14)],
-              [0 for _ in range(14)]
-              ]
-for y in range(10):
-    for x in range(14):
-        if wall_array[y][x] == 1:
-            create_wall(dispatcher, atlas, f'wall{x}{y}', x*6, y*6)
-# Spawner house is just an image. It doesn't even collide.
-create_spawner_house(dispatcher, atlas, 35, 0)
-# Actual spawning is done by this invisible listener:
-spawner = SpawnerListener(dispatcher=dispatcher,
-                          atlas=atlas,
-                          x=36, y=1,
-                          cooldown=5.0,
-                          enemies=3)
-dispatcher.register_listener(spawner, ['tick', 'ecs_destroy'])
-# These two are sidebar widgets, which can accept the events but are outside the
-# ECSLayout (ie game map)
-score = ScoreLabel(terminal)
-dispatcher.register_listener(score, 'ecs_destroy')
-hp = HPLabel(terminal)
-dispatcher.register_listener(hp, 'ac_damage')
-# And this listener should display the GAME OVER widget
-gameover_widget = Widget(*atlas.get_element('game_over'))
-gameover_listener = GameOverListener(terminal, widget=gameover_widget)
-dispatcher.register_listener(gameover_listener, 'ecs_destroy')
+# Loading image atlas. The images are decoded only on the first launch and
+# then taken from battlecity.atlascache, until battlecity.xp or .json change
+atlas = CachedAtlas('battlecity.xp', 'battlecity.json')
+# The layout, all the entities, the enemy spawner and the sidebar labels are
+# set up in world.py, so that the headless runner could build the same world.
+world = build_world(dispatcher, atlas, terminal, **world_kwargs)
+if args.record or networked:
+    loop.world = world
+if args.fixed_step:
+    # The map is drawn only when the loop decides to render a frame
+    loop.add_layout(world.layout)
 
 ################################################################################
 # Launching
 ################################################################################
 
 terminal.start()
-terminal.add_widget(layout)
-terminal.add_widget(score, pos=(85, 10))
-terminal.add_widget(hp, pos=(85, 15))
-loop.run()
\ No newline at end of file
+world.add_widgets(terminal)
+loop.run()
+if Mixer:
+    jukebox.close()
+if args.record:
+    loop.finish()
+if args.profile:
+    dispatcher.dump()
+if args.fixed_step or networked:
+    loop.dump()
@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+"""
+Headless simulation mode.
+
+Builds the same world as game.py, but without opening a window, and drives
+the dispatcher with fixed-timestep 'tick' events as fast as the CPU allows.
+Input is either absent or scripted. This is meant for soak-testing AI and
+collisions, and for all kinds of benchmarking.
+
+Can also be launched as a script:
+``python3 headless.py --seconds 600 --seed 42``
+"""
+
+from bear_hug.bear_hug import BearTerminal, BearLoop, WidgetLocation
+from bear_hug.bear_utilities import BearException
+from bear_hug.ecs import EntityTracker
+from bear_hug.event import BearEvent
+from bear_hug.resources import Atlas, XpLoader
+
+import os
+import random
+import sys
+import time
+
+from atlascache import CachedAtlas
+from chunks import ChunkedLayout
+from profiling import ProfilingDispatcher
+from routing import RoutingDispatcher, route_to_first
+from spatial import GridECSLayout
+from world import build_world
+
+
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+SOUNDS = {'shot': os.path.join(ASSET_DIR, 'shot.wav'),
+          'explosion': os.path.join(ASSET_DIR, 'explosion.wav')}
+
+
+def load_atlas(cache=True):
+    """
+    Load the battlecity image atlas, regardless of the current directory
+
+    :param cache: if True, the images are decoded once and cached in
+    battlecity.atlascache (see atlascache.py).
+    """
+    xp_path = os.path.join(ASSET_DIR, 'battlecity.xp')
+    json_path = os.path.join(ASSET_DIR, 'battlecity.json')
+    if cache:
+        return CachedAtlas(xp_path, json_path)
+    return Atlas(XpLoader(xp_path), json_path)
+
+
+class HeadlessTerminal(BearTerminal):
+    """
+    A BearTerminal that never opens a window.
+
+    It keeps track of widget locations, so that widgets and listeners which
+    call ``terminal.update_widget`` work unchanged, but never draws anything.
+    Instead it counts widget updates, and cells updated via ``update_cells``
+    or ``update_rects``.
+
+    Input is taken from ``input_script``, which is either None (no input at
+    all), a dict of ``{tick_number: [key, ...]}`` or a callable that accepts a
+    tick number and returns an iterable of keys. Every key returned for a
+    given tick is emitted as a 'key_down' event, the same way BearTerminal
+    emits keys that are held down.
+    """
+    def __init__(self, input_script=None):
+        super().__init__(font_path=None)
+        self.input_script = input_script
+        self.tick_count = 0
+        self.widget_updates = 0
+        self.cell_updates = 0
+
+    def start(self):
+        pass
+
+    def clear(self):
+        for widget in list(self.widget_locations):
+            self.remove_widget(widget)
+
+    def refresh(self):
+        pass
+
+    def close(self):
+        pass
+
+    def add_widget(self, widget, pos=(0, 0), layer=0, refresh=False):
+        if widget in self.widget_locations:
+            raise BearException('Cannot add the same widget twice')
+        widget.terminal = self
+        widget.parent = self
+        self.widget_locations[widget] = WidgetLocation(pos=pos, layer=layer)
+        self.update_widget(widget, refresh)
+
+    def remove_widget(self, widget, refresh=False):
+        del self.widget_locations[widget]
+        widget.terminal = None
+        widget.parent = None
+
+    def update_widget(self, widget, refresh=False):
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        self.widget_updates += 1
+
+    def update_cells(self, widget, cells, refresh=False):
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        self.cell_updates += len(cells)
+
+    def update_rects(self, widget, rects, refresh=False):
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        self.cell_updates += sum((x_end - x) * (y_end - y)
+                                 for x, y, x_end, y_end in rects)
+
+    def check_input(self):
+        if self.input_script is None:
+            keys = ()
+        elif callable(self.input_script):
+            keys = self.input_script(self.tick_count) or ()
+        else:
+            keys = self.input_script.get(self.tick_count, ())
+        self.tick_count += 1
+        for key in keys:
+            yield BearEvent('key_down', key)
+
+
+class SimulationLayout(GridECSLayout):
+    """
+    A GridECSLayout that detects collisions as usual, but never composites its
+    chars and colors.
+
+    Nobody is going to look at them anyway, and rebuilding an 84x60 image every
+    tick takes most of the headless tick time.
+    """
+    def _rebuild_self(self):
+        pass
+
+
+class ChunkedSimulationLayout(ChunkedLayout):
+    """
+    SimulationLayout for chunked maps
+    """
+    def _rebuild_cells(self, cells):
+        pass
+
+
+class HeadlessLoop(BearLoop):
+    """
+    A BearLoop that runs with a fixed timestep and never sleeps.
+
+    Every tick reports exactly ``1/fps`` seconds as its duration, no matter how
+    long it actually took to process. ``sim_time`` is the simulated time since
+    the loop start, in seconds.
+    """
+    def __init__(self, terminal, queue, fps=30):
+        super().__init__(terminal, queue, fps=fps)
+        self.ticks = 0
+        self.sim_time = 0
+
+    def run(self, ticks=None):
+        """
+        Run the simulation.
+
+        It would run until stopped by a 'shutdown' service event or
+        ``self.stop()``, or until ``ticks`` ticks have passed.
+
+        :param ticks: number of ticks to run. If None, runs until stopped.
+        """
+        self.stopped = False
+        target = None if ticks is None else self.ticks + ticks
+        while not self.stopped and (target is None or self.ticks < target):
+            self.step()
+
+    def step(self, dt=None):
+        """
+        Run a single tick, including the 'tick_over' processing
+
+        :param dt: time delta to report for this tick. Defaults to ``1/fps``.
+        """
+        if dt is None:
+            dt = self.frame_time
+        self._run_iteration(dt)
+        self.ticks += 1
+        self.sim_time += dt
+
+    def run_for(self, seconds):
+        """
+        Run the simulation for a given amount of simulated seconds.
+        """
+        self.run(ticks=round(seconds / self.frame_time))
+
+
+class HeadlessGame:
+    """
+    The entire game, minus the window. Sound is optional and never audible.
+
+    Since EntityTracker is a process-global singleton, creating a HeadlessGame
+    forgets all the entities that the tracker knew about. Thus only one game
+    per process can be running at any given time.
+
+    :param atlas: an Atlas. If not set, battlecity atlas is loaded.
+
+    :param input_script: passed to HeadlessTerminal.
+
+    :param seed: if set, the global RNG (used by enemy AI) is seeded with it.
+
+    :param fps: simulation ticks per simulated second.
+
+    :param render: if True, the map is composited every tick as it would be in
+    the game. Otherwise, SimulationLayout (or ChunkedSimulationLayout) is used,
+    and ``array_layout`` is ignored.
+
+    :param profile: if True, events are dispatched by ProfilingDispatcher.
+
+    :param sound: if True, 'play_sound' events go to an audio.Mixer with
+    NullBackend, available as ``mixer``. Requires NumPy.
+
+    All other kwargs are passed to ``world.build_world``
+    """
+    def __init__(self, atlas=None, input_script=None, seed=None, fps=30,
+                 render=False, profile=False, sound=False, **world_kwargs):
+        if seed is not None:
+            random.seed(seed)
+        self.atlas = atlas or load_atlas()
+        self.terminal = HeadlessTerminal(input_script=input_script)
+        self.dispatcher = ProfilingDispatcher() if profile \
+            else RoutingDispatcher()
+        self.loop = HeadlessLoop(self.terminal, self.dispatcher, fps=fps)
+        tracker = EntityTracker()
+        tracker.entities = {}
+        self.dispatcher.register_listener(tracker,
+                                          ['ecs_create', 'ecs_destroy'])
+        self.dispatcher.register_event_type('ac_damage',
+                                            route=route_to_first)
+        # Keys of networked players, see netplay.py
+        self.dispatcher.register_event_type('ac_input', route=route_to_first)
+        if sound:
+            from audio import Mixer, NullBackend
+            self.mixer = Mixer(SOUNDS, backend=NullBackend())
+            self.dispatcher.register_listener(self.mixer,
+                                              ['play_sound', 'service'])
+        else:
+            self.mixer = None
+        if not render:
+            # Nothing is composited anyway
+            world_kwargs['array_layout'] = False
+            world_kwargs.setdefault('layout_class',
+                                    ChunkedSimulationLayout
+                                    if world_kwargs.get('chunked')
+                                    else SimulationLayout)
+        self.world = build_world(self.dispatcher, self.atlas, self.terminal,
+                                 **world_kwargs)
+        self.terminal.start()
+        self.world.add_widgets(self.terminal)
+
+    @property
+    def player_alive(self):
+        return 'player' in EntityTracker().entities
+
+    def run(self, ticks=None):
+        self.loop.run(ticks=ticks)
+
+    def run_for(self, seconds):
+        self.loop.run_for(seconds)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run AsciiCity simulation without a window')
+    parser.add_argument('--seconds', type=float, default=600,
+                        help='Simulated seconds to run')
+    parser.add_argument('--fps', type=int, default=30,
+                        help='Simulation ticks per simulated second')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--enemies', type=int, default=3)
+    parser.add_argument('--render', action='store_true',
+                        help='Composite the map every tick')
+    parser.add_argument('--array-layout', action='store_true',
+                        help='Composite the map in NumPy arrays. Implies '
+                             '--render')
+    parser.add_argument('--batched-ai', action='store_true',
+                        help='Use NumPy-based EnemyAISystem')
+    parser.add_argument('--compact', action='store_true',
+                        help='Keep positions and hitpoints in CompactStorage')
+    parser.add_argument('--pathfinding', action='store_true',
+                        help='Enemies follow a flow field to the player')
+    parser.add_argument('--line-of-sight', action='store_true',
+                        help='Enemies do not shoot through walls')
+    parser.add_argument('--level', default=None,
+                        help='Level file. Defaults to level1.json')
+    parser.add_argument('--chunked', action='store_true',
+                        help='Simulate only the part of the map around the '
+                             'player')
+    parser.add_argument('--map-size', type=int, nargs=2, default=None,
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='Play on a random map of this many tiles. '
+                             'Implies --chunked')
+    parser.add_argument('--batched-damage', action='store_true',
+                        help='Apply all the hits once per tick')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report time spent per listener and event type')
+    parser.add_argument('--sound', action='store_true',
+                        help='Mix the sounds, without playing them')
+    args = parser.parse_args()
+    game = HeadlessGame(seed=args.seed, fps=args.fps, enemies=args.enemies,
+                        render=args.render or args.array_layout,
+                        array_layout=args.array_layout,
+                        batched_ai=args.batched_ai,
+                        compact_storage=args.compact, level=args.level,
+                        pathfinding=args.pathfinding,
+                        line_of_sight=args.line_of_sight, profile=args.profile,
+                        sound=args.sound,
+                        chunked=args.chunked or bool(args.map_size),
+                        map_size=args.map_size,
+                        batched_damage=args.batched_damage)
+    start = time.perf_counter()
+    game.run_for(args.seconds)
+    elapsed = time.perf_counter() - start
+    print(f'Simulated {game.loop.sim_time:.1f} s ({game.loop.ticks} ticks) '
+          f'in {elapsed:.2f} s: {game.loop.ticks/elapsed:.0f} ticks/s, '
+          f'{game.loop.sim_time/elapsed:.1f} simulated s per second')
+    print(f'Score: {game.world.score.score}, HP: {game.world.hp.hp}, '
+          f'entities: {len(EntityTracker().entities)}')
+    if hasattr(game.world.layout, 'total_cells_redrawn'):
+        layout = game.world.layout
+        print(f'Cells redrawn: '
+              f'{layout.total_cells_redrawn / layout.frames:.1f} per frame')
+    if game.world.chunks:
+        chunks = game.world.chunks
+        print(f'Chunks: {len(chunks.active)} active, {chunks.awake} entities '
+              f'awake, {chunks.sleeps} put to sleep, {chunks.wakeups} woken '
+              f'up, {chunks.update_time * 1000:.1f} ms total')
+    if game.world.damage_system:
+        damage = game.world.damage_system
+        print(f'Damage: {damage.hits} hits in {damage.passes} passes')
+    if game.world.flow_field:
+        field = game.world.flow_field
+        print(f'Flow field: {field.rebuilds} rebuilds, {field.patches} '
+              f'patches, {field.update_time * 1000:.1f} ms total')
+    if game.mixer:
+        game.mixer.wait()
+        print(f'Sounds: {game.mixer.requests} requested, '
+              f'{game.mixer.merged} merged, {game.mixer.backend.plays} mixes,'
+              f' {game.mixer.dropped} voices dropped')
+    if args.profile:
+        game.dispatcher.dump(sys.stdout)
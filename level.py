@@ -0,0 +1,239 @@
+"""
+Level files and the static wall layer.
+
+A level is a JSON file like this:
+
+.. code-block:: json
+
+    {"player": [30, 50],
+     "spawner": [35, 0],
+     "walls": ["..#...",
+               "..#..#"]}
+
+``walls`` is the map, one string per row of 6x6 tiles: '#' is a wall and '.'
+is nothing. All rows should be of the same length. ``player`` (the player's
+starting position) and ``spawner`` (the position of enemy spawner house) are in
+chars and are optional.
+
+Walls of a level don't have to be entities. StaticWallLayer draws all of them
+onto the layout background at once, and turns a wall into a regular entity
+only when something runs into it. Until then, a wall costs no listeners, no
+events and no per-tick work.
+"""
+
+import json
+import os
+import random
+
+from entities import create_wall, get_prototypes
+
+
+TILE_SIZE = 6
+WALL = '#'
+EMPTY = '.'
+
+DEFAULT_LEVEL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'level1.json')
+
+
+class Level:
+    """
+    A level: the wall map and a few positions.
+
+    :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+
+    :param player_pos: player's starting position, in chars
+
+    :param spawner_pos: spawner house position, in chars. Enemies are spawned
+    one char to the right and down of it.
+    """
+    def __init__(self, walls, player_pos=(30, 50), spawner_pos=(35, 0)):
+        if not walls or any(len(row) != len(walls[0]) for row in walls):
+            raise ValueError('Level rows should be non-empty and equal')
+        self.walls = walls
+        self.player_pos = tuple(player_pos)
+        self.spawner_pos = tuple(spawner_pos)
+
+    @property
+    def width(self):
+        """
+        Width in tiles
+        """
+        return len(self.walls[0])
+
+    @property
+    def height(self):
+        """
+        Height in tiles
+        """
+        return len(self.walls)
+
+
+def load_level(path=DEFAULT_LEVEL):
+    """
+    Load a level from the JSON file.
+
+    :returns: Level
+    """
+    with open(path) as f:
+        d = json.load(f)
+    walls = []
+    for row in d['walls']:
+        for char in row:
+            if char not in (WALL, EMPTY):
+                raise ValueError(f'Unknown tile {char} in level {path}')
+        walls.append([1 if char == WALL else 0 for char in row])
+    kwargs = {}
+    if 'player' in d:
+        kwargs['player_pos'] = d['player']
+    if 'spawner' in d:
+        kwargs['spawner_pos'] = d['spawner']
+    return Level(walls, **kwargs)
+
+
+def random_level(width, height, density=0.15, rng=random):
+    """
+    Generate a level with randomly placed walls.
+
+    The player starts in the middle of the map, with the spawner house eight
+    tiles above, and the tiles around both are kept free.
+
+    :param width: width in tiles, at least 10
+
+    :param height: height in tiles, at least 18
+
+    :param density: the fraction of tiles that are walls
+
+    :param rng: random.Random, or the random module itself
+
+    :returns: Level
+    """
+    if width < 10 or height < 18:
+        raise ValueError('Random level should be at least 10x18 tiles')
+    x0 = width // 2 - 1
+    y0 = height // 2 + 3
+    walls = [[1 if rng.random() < density else 0 for x in range(width)]
+             for y in range(height)]
+    for y in range(y0 - 12, y0 + 2):
+        walls[y][x0 - 3:x0 + 6] = [0] * 9
+    return Level(walls, player_pos=(x0 * TILE_SIZE, y0 * TILE_SIZE),
+                 spawner_pos=(x0 * TILE_SIZE, (y0 - 8) * TILE_SIZE))
+
+
+def wall_id(x, y):
+    """
+    Entity ID of a wall in a given tile
+    """
+    return f'wall{x}_{y}'
+
+
+class StaticWallLayer:
+    """
+    All the walls that nobody has touched yet, drawn onto layout background.
+
+    GridECSLayout calls ``materialize`` after every move. If the moved entity
+    overlaps some of the layer's walls, those are erased from the background
+    and created as regular entities via ``create_wall``, so that the collision
+    (and everything after it) goes exactly as with any other wall.
+
+    :param dispatcher: BearEventDispatcher
+
+    :param atlas: Atlas or Prototypes
+
+    :param layout: GridECSLayout whose background the walls are drawn onto
+
+    :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+
+    :param storage: CompactStorage for materialized walls, if any
+    """
+    def __init__(self, dispatcher, atlas, layout, walls, storage=None,
+                 tile_size=TILE_SIZE):
+        self.dispatcher = dispatcher
+        self.atlas = atlas
+        self.layout = layout
+        self.storage = storage
+        self.tile_size = tile_size
+        self.tiles = {(x, y) for y in range(len(walls))
+                      for x in range(len(walls[y])) if walls[y][x] == 1}
+        self.materialized = 0
+        self.bake()
+
+    def bake(self):
+        """
+        Draw all the walls onto the layout background
+        """
+        for x, y in self.tiles:
+            self._draw(x, y)
+        background = self.layout.background
+        self.layout.background_changed(0, 0, len(background.chars[0]),
+                                       len(background.chars))
+
+    def _draw(self, x, y):
+        chars, colors = get_prototypes(self.atlas).get_element('wall_3')
+        background = self.layout.background
+        for dy in range(len(chars)):
+            line = y * self.tile_size + dy
+            for dx in range(len(chars[0])):
+                background.chars[line][x * self.tile_size + dx] = \
+                    chars[dy][dx]
+                background.colors[line][x * self.tile_size + dx] = \
+                    colors[dy][dx]
+
+    def _erase(self, x, y):
+        background = self.layout.background
+        for line in range(y * self.tile_size, (y + 1) * self.tile_size):
+            for char in range(x * self.tile_size, (x + 1) * self.tile_size):
+                background.chars[line][char] = ' '
+        self.layout.background_changed(x * self.tile_size, y * self.tile_size,
+                                       self.tile_size, self.tile_size)
+
+    def add_tile(self, x, y):
+        """
+        Put an untouched wall back into a tile, eg when restoring a snapshot.
+
+        Whatever wall entity was in that tile should be removed separately.
+        """
+        if (x, y) not in self.tiles:
+            self.tiles.add((x, y))
+            self._draw(x, y)
+            self.layout.background_changed(x * self.tile_size,
+                                           y * self.tile_size,
+                                           self.tile_size, self.tile_size)
+
+    def remove_tile(self, x, y):
+        """
+        Erase a wall from a tile without creating an entity for it
+        """
+        if (x, y) in self.tiles:
+            self.tiles.remove((x, y))
+            self._erase(x, y)
+
+    def materialize(self, x, y, width, height):
+        """
+        Turn all the walls that overlap a given rectangle into entities.
+
+        The entities are created the usual way, so they aren't in the layout
+        until their 'ecs_create' and 'ecs_add' are processed.
+
+        :returns: a list of ``(entity_id, (x, y, width, height))``
+        """
+        r = []
+        if not self.tiles:
+            return r
+        size = self.tile_size
+        for tile_y in range(y // size, (y + height - 1) // size + 1):
+            for tile_x in range(x // size, (x + width - 1) // size + 1):
+                if (tile_x, tile_y) in self.tiles:
+                    self.tiles.remove((tile_x, tile_y))
+                    self._erase(tile_x, tile_y)
+                    entity_id = wall_id(tile_x, tile_y)
+                    create_wall(self.dispatcher, self.atlas, entity_id,
+                                tile_x * size, tile_y * size,
+                                storage=self.storage)
+                    self.materialized += 1
+                    r.append((entity_id, (tile_x * size, tile_y * size,
+                                          size, size)))
+        return r
+
+    def __len__(self):
+        return len(self.tiles)
@@ -4,44 +4,102 @@ A few listeners/widgets
 
 from bear_hug.widgets import Widget, Label, Listener
 from entities import create_enemy_tank
+from tags import EntityIndex, Tag
 
 
-class ScoreLabel(Label):
+class TickLabel(Label):
+    """
+    A Label that is redrawn at most once per tick.
+
+    Child classes set ``self.changed`` instead of updating the terminal, and
+    the text (as returned by ``get_text``) is set and drawn at 'tick_over'.
+    Should be subscribed to 'service' events.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = False
+
+    def get_text(self):
+        raise NotImplementedError('Label text should be overridden')
+
+    def on_event(self, event):
+        if event.event_type == 'service' and event.event_value == 'tick_over'\
+                and self.changed:
+            self.text = self.get_text()
+            self.terminal.update_widget(self)
+            self.changed = False
+
+
+class ScoreLabel(TickLabel):
     """
     Scores for the destroyed enemy tanks
+
+    Should be subscribed either to 'ecs_destroy' or, if damage is resolved by a
+    DamageSystem, to 'ac_damage_resolved'.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(text='Score:\n0')
         self.score = 0
 
+    def get_text(self):
+        return f'Score:\n{self.score}'
+
     def on_event(self, event):
-        if event.event_type == 'ecs_destroy' and 'enemy' in event.event_value and 'bullet' not in event.event_value:
+        if event.event_type == 'ecs_destroy' and \
+                EntityIndex().is_a(event.event_value, Tag.ENEMY_TANK):
             self.score += 10
-            self.text = f'Score:\n{self.score}'
-            self.terminal.update_widget(self)
+            self.changed = True
+        elif event.event_type == 'ac_damage_resolved':
+            index = EntityIndex()
+            kills = sum(index.is_a(x, Tag.ENEMY_TANK)
+                        for x in event.event_value[1])
+            if kills:
+                self.score += 10 * kills
+                self.changed = True
+        super().on_event(event)
 
 
-class HPLabel(Label):
+class HPLabel(TickLabel):
     """
     Player HP
+
+    Should be subscribed either to 'ac_damage' or, if damage is resolved by a
+    DamageSystem, to 'ac_damage_resolved'.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(text='HP:\n5')
         self.hp = 5
 
+    def get_text(self):
+        return f'HP:\n{self.hp}'
+
     def on_event(self, event):
         if event.event_type == 'ac_damage' and event.event_value[0] == 'player':
             self.hp -= event.event_value[1]
-            self.text = f'HP:\n{self.hp}'
-            self.terminal.update_widget(self)
+            self.changed = True
+        elif event.event_type == 'ac_damage_resolved' and \
+                'player' in event.event_value[0]:
+            self.hp -= event.event_value[0]['player']
+            self.changed = True
+        super().on_event(event)
 
 
 class SpawnerListener(Listener):
     """
     Spawns enemy tanks on cooldown, until there are enough of them
+
+    If ``ai_system`` is set, enemies are controlled by it instead of having
+    their own ControllerComponents. If ``bullet_pool`` is set, enemies take
+    their bullets from it. If ``storage`` is set, enemies keep their positions
+    and hitpoints in it. ``controller_params`` are passed to every enemy's
+    controller.
+
+    Destroyed enemies are counted either by 'ecs_destroy' or, if damage is
+    resolved by a DamageSystem, by 'ac_damage_resolved'.
     """
     def __init__(self, *args, dispatcher, atlas, x, y,
-                 cooldown=2.0, enemies=3, **kwargs):
+                 cooldown=2.0, enemies=3, ai_system=None, bullet_pool=None,
+                 storage=None, controller_params=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.cooldown = cooldown
         # Set to zero to spawn first enemy immediately
@@ -56,16 +114,29 @@ class SpawnerListener(Listener):
         self.atlas = atlas
         self.x = x
         self.y = y
+        self.ai_system = ai_system
+        self.bullet_pool = bullet_pool
+        self.storage = storage
+        self.controller_params = controller_params
 
     def on_event(self, event):
-        if event.event_type == 'ecs_destroy' and 'enemy' in event.event_value:
+        if event.event_type == 'ecs_destroy' and \
+                EntityIndex().is_a(event.event_value, Tag.ENEMY_TANK):
             self.enemies_current -= 1
+        elif event.event_type == 'ac_damage_resolved':
+            index = EntityIndex()
+            self.enemies_current -= sum(index.is_a(x, Tag.ENEMY_TANK)
+                                        for x in event.event_value[1])
         if event.event_type == 'tick':
             self.spawn_cd -= event.event_value
             if self.spawn_cd <= 0 and self.enemies_current < self.enemies:
                 create_enemy_tank(self.dispatcher, self.atlas,
                                   f'enemy_{self.counter}',
-                                  self.x, self.y)
+                                  self.x, self.y,
+                                  ai_system=self.ai_system,
+                                  bullet_pool=self.bullet_pool,
+                                  storage=self.storage,
+                                  controller_params=self.controller_params)
                 self.spawn_cd = self.cooldown
                 self.enemies_current += 1
                 self.counter += 1
@@ -74,14 +145,22 @@ class SpawnerListener(Listener):
 class GameOverListener(Listener):
     """
     Produces a GAME OVER widget
+
+    Should be subscribed either to 'ecs_destroy' or, if damage is resolved by a
+    DamageSystem, to 'ac_damage_resolved'.
     """
     def __init__(self, *args, widget=None, **kwargs):
-        print (args)
         super().__init__(*args, *kwargs)
         self.widget = widget
 
     def on_event(self, event):
-        if event.event_type == 'ecs_destroy' and event.event_value == 'player':
+        if event.event_type == 'ecs_destroy':
+            player_died = event.event_value == 'player'
+        elif event.event_type == 'ac_damage_resolved':
+            player_died = 'player' in event.event_value[1]
+        else:
+            player_died = False
+        if player_died:
             self.terminal.add_widget(self.widget,
                                      pos=(20, 20),
                                      layer=5)
\ No newline at end of file
@@ -0,0 +1,530 @@
+#! /usr/bin/env python3
+"""
+Lockstep multiplayer.
+
+Two players share the same map, and each of them runs the entire game on
+their own machine. Since the simulation is deterministic (see replay.py), the
+only thing the peers have to exchange is the keys pressed every tick: as
+long as both games get the same keys on the same ticks, they stay in the same
+state, no matter how many bullets are flying. A tick costs a few bytes each
+way.
+
+The keys pressed during tick ``t`` are sent to the other peer right away, but
+only take effect on tick ``t + delay``, so that they have time to arrive. If
+the other peer's keys for the next tick are not there yet, the game waits for
+them. Every ``hash_interval`` ticks both peers send the hash of their state
+(``replay.state_hash``), and a mismatch stops the game with DesyncError.
+
+Protocol: a single TCP connection, run by asyncio. All numbers are
+little-endian. Once the guest connects, the host sends ``b'ACNP'``, version
+(uint8), config length (uint32) and the config itself, a JSON dict of
+``{'seed': seed, 'fps': fps, 'delay': delay, 'hash_interval': interval,
+'world': build_world kwargs}``. The host plays 'player' and the guest plays
+'player2'. Then both peers send messages, each starting with a type byte:
+
+* ``b'I'``: keys: tick (uint32) and a bitmask of GAME_KEYS (uint16).
+* ``b'H'``: state hash: tick count (uint32) and the hash (8 bytes).
+* ``b'P'``: ping: the sender's clock (double). Answered with ``b'Q'`` and the
+  same value, so that the sender can measure the round trip time.
+* ``b'B'``: bye, the peer is leaving.
+
+Can also be launched as a script, which plays a headless game with random
+input against another such script. Eg ``python3 netplay.py host`` in one
+terminal and ``python3 netplay.py join localhost`` in another.
+"""
+
+from bear_hug.bear_hug import BearLoop
+from bear_hug.event import BearEvent
+
+import asyncio
+import json
+import struct
+import sys
+import time
+
+from replay import DesyncError, HASH_SIZE, state_hash
+
+
+MAGIC = b'ACNP'
+VERSION = 1
+PORT = 7777
+
+# Keys that change the game state. Other keys are not sent
+GAME_KEYS = ('TK_SPACE', 'TK_W', 'TK_A', 'TK_S', 'TK_D',
+             'TK_UP', 'TK_LEFT', 'TK_DOWN', 'TK_RIGHT')
+KEY_BITS = {key: 1 << bit for bit, key in enumerate(GAME_KEYS)}
+# Player entity IDs, host's first
+PLAYER_IDS = ('player', 'player2')
+
+_HEADER = struct.Struct('<BI')
+_INPUT = struct.Struct('<IH')
+_HASH = struct.Struct('<I')
+_PING = struct.Struct('<d')
+
+
+def encode_keys(keys):
+    """
+    :returns: bitmask of GAME_KEYS among ``keys``. Other keys are ignored.
+    """
+    mask = 0
+    for key in keys:
+        mask |= KEY_BITS.get(key, 0)
+    return mask
+
+
+def decode_keys(mask):
+    """
+    :returns: a tuple of keys in a bitmask, always in GAME_KEYS order
+    """
+    return tuple(key for key in GAME_KEYS if mask & KEY_BITS[key])
+
+
+################################################################################
+# Connection
+################################################################################
+
+
+class Connection:
+    """
+    A link to the other peer.
+
+    Messages are written to the stream as soon as they are sent. Incoming
+    ones are read by a background task, which is started by ``start`` and
+    keeps them until the loop asks for them. Pings are answered right away.
+
+    Should be created by ``host`` or ``join`` (or ``host_game`` and
+    ``join_game``), and used on the same asyncio event loop, available as
+    ``loop``.
+
+    ``bytes_sent`` and ``bytes_received`` count the payload, without the TCP
+    and IP headers. ``rtt`` is the latest round trip time in seconds, and
+    ``rtt_max`` and ``rtt_mean`` are over all the pings so far. ``closed`` is
+    set when the other peer is gone.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        # {tick: key mask}
+        self.inputs = {}
+        # {tick count: state hash}
+        self.hashes = {}
+        self.arrived = asyncio.Event()
+        self.closed = False
+        self.task = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.pongs = 0
+        self.rtt = None
+        self.rtt_max = 0
+        self.rtt_total = 0
+
+    @property
+    def rtt_mean(self):
+        return self.rtt_total / self.pongs if self.pongs else None
+
+    def start(self):
+        """
+        Start reading the messages. Should be called on the running loop
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self._receive())
+
+    async def _receive(self):
+        read = self.reader.readexactly
+        try:
+            while True:
+                kind = await read(1)
+                if kind == b'I':
+                    tick, mask = _INPUT.unpack(await read(_INPUT.size))
+                    self.inputs[tick] = mask
+                    self.arrived.set()
+                    size = _INPUT.size
+                elif kind == b'H':
+                    data = await read(_HASH.size + HASH_SIZE)
+                    ticks, = _HASH.unpack_from(data)
+                    self.hashes[ticks] = data[_HASH.size:]
+                    size = len(data)
+                elif kind in (b'P', b'Q'):
+                    data = await read(_PING.size)
+                    if kind == b'P':
+                        self._write(b'Q' + data)
+                    else:
+                        self._pong(_PING.unpack(data)[0])
+                    size = _PING.size
+                elif kind == b'B':
+                    self.bytes_received += 1
+                    break
+                else:
+                    raise ConnectionError(f'Unknown message {kind}')
+                self.bytes_received += 1 + size
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            self.arrived.set()
+
+    def _pong(self, sent):
+        self.rtt = time.perf_counter() - sent
+        self.rtt_max = max(self.rtt_max, self.rtt)
+        self.rtt_total += self.rtt
+        self.pongs += 1
+
+    def _write(self, data):
+        if not self.closed:
+            self.writer.write(data)
+            self.bytes_sent += len(data)
+
+    def send_input(self, tick, mask):
+        """
+        Send the local player's keys for a given tick
+        """
+        self._write(b'I' + _INPUT.pack(tick, mask))
+
+    def send_hash(self, ticks, digest):
+        """
+        Send the state hash after a given number of ticks
+        """
+        self._write(b'H' + _HASH.pack(ticks) + digest)
+
+    def send_ping(self):
+        self._write(b'P' + _PING.pack(time.perf_counter()))
+
+    async def flush(self):
+        """
+        Wait until the messages sent so far are handed over to the OS
+        """
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+
+    async def wait_input(self, tick):
+        """
+        Wait for the other peer's keys for a given tick.
+
+        :returns: key mask, or None if the peer is gone
+        """
+        while tick not in self.inputs:
+            if self.closed:
+                return None
+            self.arrived.clear()
+            await self.arrived.wait()
+        return self.inputs.pop(tick)
+
+    async def close(self):
+        """
+        Say bye and close the connection
+        """
+        self._write(b'B')
+        await self.flush()
+        self.closed = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self.task:
+            self.task.cancel()
+
+
+async def host(port=PORT, config=None, address=None):
+    """
+    Wait for the other player to connect, and send them the config.
+
+    :param port: TCP port to listen on
+
+    :param config: a JSON-serializable dict, see the module docstring
+
+    :param address: address to listen on. All interfaces by default.
+
+    :returns: Connection
+    """
+    accepted = asyncio.get_running_loop().create_future()
+
+    def accept(reader, writer):
+        if accepted.done():
+            # Somebody else has been faster
+            writer.close()
+        else:
+            accepted.set_result((reader, writer))
+
+    server = await asyncio.start_server(accept, address, port)
+    try:
+        reader, writer = await accepted
+    finally:
+        server.close()
+    connection = Connection(reader, writer)
+    metadata = json.dumps(config or {}).encode()
+    connection._write(MAGIC + _HEADER.pack(VERSION, len(metadata)) +
+                      metadata)
+    await connection.flush()
+    return connection
+
+
+async def join(address, port=PORT):
+    """
+    Connect to the host and get the config from it.
+
+    :returns: (Connection, config dict)
+    """
+    reader, writer = await asyncio.open_connection(address, port)
+    header = await reader.readexactly(len(MAGIC) + _HEADER.size)
+    if header[:len(MAGIC)] != MAGIC:
+        writer.close()
+        raise ValueError(f'{address}:{port} is not an AsciiCity host')
+    version, length = _HEADER.unpack_from(header, len(MAGIC))
+    if version != VERSION:
+        writer.close()
+        raise ValueError(f'Unsupported protocol version {version}')
+    config = json.loads(await reader.readexactly(length))
+    connection = Connection(reader, writer)
+    connection.bytes_received += len(header) + length
+    return connection, config
+
+
+def host_game(port=PORT, config=None, address=None):
+    """
+    ``host`` for the code that doesn't run asyncio itself.
+
+    The connection gets its own event loop, which LockstepLoop then runs on.
+    """
+    return asyncio.new_event_loop().run_until_complete(
+        host(port, config, address))
+
+
+def join_game(address, port=PORT):
+    """
+    ``join`` for the code that doesn't run asyncio itself.
+
+    The connection gets its own event loop, which LockstepLoop then runs on.
+    """
+    return asyncio.new_event_loop().run_until_complete(join(address, port))
+
+
+################################################################################
+# Lockstep loop
+################################################################################
+
+
+class LockstepLoop(BearLoop):
+    """
+    A BearLoop that runs in lockstep with the other peer's one.
+
+    Every tick is exactly ``1/fps`` seconds long. The keys the local player
+    presses ('key_down' events from the terminal that are in GAME_KEYS) are
+    sent to the other peer, and both players' keys become 'ac_input' events
+    ``delay`` ticks later, in the same order on both sides. Other terminal
+    events (eg closing the window) are passed on right away, since they
+    don't change the game state.
+
+    The world should be built with ``players=2``, so that the tanks take
+    their keys from 'ac_input', and with the same seed and kwargs on both
+    sides.
+
+    Telemetry: ``ticks``; ``stalls``, the ticks that had to wait for the
+    other peer's keys, and ``stall_time`` (in seconds) spent waiting;
+    ``hashes_checked``; ``peer_left`` is set if the other peer has left
+    first. Bandwidth and latency are counted by the connection.
+
+    :param connection: Connection
+
+    :param slot: 0 for the host, who plays 'player', or 1 for the guest, who
+    plays 'player2'
+
+    :param delay: input delay, in ticks
+
+    :param world: World to hash. Can be set later, but before running.
+
+    :param hash_interval: ticks between state hashes
+
+    :param realtime: if False, the loop never sleeps and runs as fast as both
+    peers can, eg for headless games.
+    """
+    def __init__(self, terminal, queue, connection, slot, delay=3,
+                 world=None, fps=30, hash_interval=30, realtime=True):
+        super().__init__(terminal, queue, fps=fps)
+        self.connection = connection
+        self.slot = slot
+        self.delay = delay
+        self.world = world
+        self.hash_interval = hash_interval
+        self.realtime = realtime
+        # {tick: key mask} of the local player. Nobody presses anything
+        # during the first ``delay`` ticks
+        self.local_inputs = {x: 0 for x in range(delay)}
+        # {tick count: state hash} not yet checked against the other peer's
+        self.hashes = {}
+        self.ticks = 0
+        self.stalls = 0
+        self.stall_time = 0
+        self.hashes_checked = 0
+        self.peer_left = False
+
+    def run(self, ticks=None):
+        """
+        Run until stopped, until the other peer leaves, or for ``ticks``
+        ticks, then close the connection.
+
+        Raises DesyncError as soon as the peers' states differ.
+        """
+        loop = self.connection.loop
+        try:
+            loop.run_until_complete(self.play(ticks))
+        finally:
+            loop.run_until_complete(self.connection.close())
+            loop.close()
+            self.terminal.close()
+
+    async def play(self, ticks=None):
+        """
+        Same as ``run``, but on a running event loop, which should be the
+        connection's one. Leaves the connection open.
+        """
+        self.connection.start()
+        target = None if ticks is None else self.ticks + ticks
+        next_time = time.perf_counter()
+        while not self.stopped and (target is None or self.ticks < target):
+            tick = self.ticks
+            keys = []
+            for event in self.terminal.check_input():
+                if event.event_type == 'key_down' and \
+                        event.event_value in KEY_BITS:
+                    keys.append(event.event_value)
+                else:
+                    self.queue.add_event(event)
+            mask = encode_keys(keys)
+            self.local_inputs[tick + self.delay] = mask
+            self.connection.send_input(tick + self.delay, mask)
+            if tick % self.fps == 0:
+                self.connection.send_ping()
+            await self.connection.flush()
+            if tick < self.delay:
+                remote = 0
+            elif tick in self.connection.inputs:
+                remote = self.connection.inputs.pop(tick)
+            else:
+                start = time.perf_counter()
+                remote = await self.connection.wait_input(tick)
+                self.stalls += 1
+                self.stall_time += time.perf_counter() - start
+                if remote is None:
+                    self.peer_left = True
+                    break
+            masks = [remote, remote]
+            masks[self.slot] = self.local_inputs.pop(tick)
+            for player_id, player_mask in zip(PLAYER_IDS, masks):
+                for key in decode_keys(player_mask):
+                    self.queue.add_event(BearEvent('ac_input',
+                                                   (player_id, key)))
+            self._step()
+            self.ticks += 1
+            if self.ticks % self.hash_interval == 0:
+                digest = state_hash(self.world)
+                self.hashes[self.ticks] = digest
+                self.connection.send_hash(self.ticks, digest)
+            if self.hashes:
+                self._check_hashes()
+            if self.realtime:
+                next_time += self.frame_time
+                sleep_time = next_time - time.perf_counter()
+                if sleep_time < 0:
+                    # Waiting for the other peer doesn't need to be made up
+                    next_time = time.perf_counter()
+                    sleep_time = 0
+                await asyncio.sleep(sleep_time)
+            else:
+                # Let the connection read what has arrived
+                await asyncio.sleep(0)
+
+    def _step(self):
+        # Same as BearLoop._run_iteration, minus the input
+        self.queue.add_event(BearEvent(event_type='tick',
+                                       event_value=self.frame_time))
+        self.queue.dispatch_events()
+        self.queue.add_event(BearEvent(event_type='service',
+                                       event_value='tick_over'))
+        self.queue.dispatch_events()
+        self.terminal.refresh()
+
+    def _check_hashes(self):
+        remote = self.connection.hashes
+        for ticks in [x for x in self.hashes if x in remote]:
+            expected = remote.pop(ticks)
+            actual = self.hashes.pop(ticks)
+            if expected != actual:
+                raise DesyncError(ticks, expected, actual)
+            self.hashes_checked += 1
+
+    def dump(self, file=sys.stderr):
+        """
+        Print the lockstep and network telemetry
+        """
+        connection = self.connection
+        seconds = self.ticks * self.frame_time
+        print(f'Lockstep: {self.ticks} ticks, {self.stalls} stalls '
+              f'({self.stall_time * 1000:.0f} ms), {self.hashes_checked} '
+              f'hashes checked' +
+              (', the other player has left' if self.peer_left else ''),
+              file=file)
+        if seconds:
+            print(f'Network: {connection.bytes_sent / seconds:.0f} B/s sent, '
+                  f'{connection.bytes_received / seconds:.0f} B/s received '
+                  f'per game second', file=file)
+        if connection.pongs:
+            print(f'Round trip: {connection.rtt_mean * 1000:.1f} ms mean, '
+                  f'{connection.rtt_max * 1000:.1f} ms max, input delay '
+                  f'{self.delay * self.frame_time * 1000:.0f} ms', file=file)
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    from batch import RandomPlayer
+    from headless import HeadlessGame
+    parser = argparse.ArgumentParser(
+        description='Play a headless AsciiCity game with random input against '
+                    'another netplay.py')
+    parser.add_argument('role', choices=('host', 'join'))
+    parser.add_argument('address', nargs='?', default='localhost',
+                        help='Host to join')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--seconds', type=float, default=60,
+                        help='Game seconds to play')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Play at the game speed instead of as fast as '
+                             'possible')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='RNG seed. Set by the host')
+    parser.add_argument('--delay', type=int, default=3,
+                        help='Input delay in ticks. Set by the host')
+    parser.add_argument('--enemies', type=int, default=3,
+                        help='Set by the host')
+    args = parser.parse_args()
+    if args.role == 'host':
+        seed = args.seed if args.seed is not None else random.getrandbits(64)
+        config = {'seed': seed, 'fps': 30, 'delay': args.delay,
+                  'hash_interval': 30, 'world': {'enemies': args.enemies}}
+        print(f'Waiting for the other player on port {args.port}',
+              file=sys.stderr)
+        connection = host_game(args.port, config)
+        slot = 0
+    else:
+        connection, config = join_game(args.address, args.port)
+        slot = 1
+    game = HeadlessGame(seed=config['seed'], fps=config['fps'],
+                        input_script=RandomPlayer(config['seed'] * 2 + slot),
+                        players=2, **config['world'])
+    loop = LockstepLoop(game.terminal, game.dispatcher, connection, slot,
+                        delay=config['delay'], world=game.world,
+                        fps=config['fps'],
+                        hash_interval=config['hash_interval'],
+                        realtime=args.realtime)
+    start = time.perf_counter()
+    loop.run(round(args.seconds * config['fps']))
+    elapsed = time.perf_counter() - start
+    print(f'Played {loop.ticks} ticks as {PLAYER_IDS[slot]} in '
+          f'{elapsed:.2f} s')
+    print(f'Score: {game.world.score.score}, HP: {game.world.hp.hp}, '
+          f'state: {state_hash(game.world).hex()}')
+    loop.dump(sys.stdout)
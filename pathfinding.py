@@ -0,0 +1,221 @@
+"""
+Flow field pathfinding.
+
+Left to themselves, enemy controllers drive in a random direction until they
+hit something. FlowField is a single breadth-first distance field from the
+player over every position a tank could take on the map; a controller that
+has it just steps towards the neighbouring position that is closer to the
+player, which is an O(1) lookup no matter how many tanks are there.
+
+The field is rebuilt from scratch (O(map)) only when the player enters
+another tile, and patched locally when a wall is destroyed.
+"""
+
+from bear_hug.widgets import Listener
+
+from collections import deque
+import time
+
+from level import TILE_SIZE, wall_id
+
+
+# Same order as in ControllerComponent's direction list. When several
+# directions are equally good, the first of them is taken
+DIRECTIONS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+UNREACHABLE = -1
+
+
+class FlowField(Listener):
+    """
+    Distances from the player to every position on the map.
+
+    A position is a top left corner of a ``agent_size`` x ``agent_size``
+    tank. It is passable if such a tank would fit there without touching
+    any of the walls. Other tanks, bullets and the player themselves are not
+    obstacles.
+
+    Should be subscribed to 'ecs_move' and 'ecs_destroy'. It follows the
+    player's moves, and removes the walls whose entities are destroyed (walls
+    are recognized by their ``level.wall_id``).
+
+    :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+
+    :param target: the player's position. Until it's set (here or by the
+    player's move), the field is empty.
+
+    :param tile_size: size of a map tile in chars
+
+    :param agent_size: size of a tank in chars
+    """
+    def __init__(self, *args, walls, target=None, tile_size=TILE_SIZE,
+                 agent_size=6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tile_size = tile_size
+        self.agent_size = agent_size
+        self.width = len(walls[0]) * tile_size
+        self.height = len(walls) * tile_size
+        # Statistics, to make sure this does not cost too much
+        self.rebuilds = 0
+        self.patches = 0
+        self.update_time = 0.0
+        self.reset(walls, target)
+
+    def reset(self, walls, target=None):
+        """
+        Replace all the walls and rebuild the field.
+
+        :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+
+        :param target: the player's position, or None if there's no player.
+        """
+        self.walls = {(x, y) for y in range(len(walls))
+                      for x in range(len(walls[0])) if walls[y][x]}
+        # {entity ID: tile}
+        self.wall_ids = {wall_id(*tile): tile for tile in self.walls}
+        # Flat lists, one item per position
+        self.passable = bytearray(self.width * self.height)
+        for y in range(self.height):
+            for x in range(self.width):
+                self.passable[y * self.width + x] = self._fits(x, y)
+        if target is not None:
+            self.set_target(*target)
+        else:
+            self.clear()
+
+    def _fits(self, x, y):
+        size = self.agent_size
+        if x < 0 or y < 0 or x + size > self.width or y + size > self.height:
+            return False
+        tile = self.tile_size
+        for tile_y in range(y // tile, (y + size - 1) // tile + 1):
+            for tile_x in range(x // tile, (x + size - 1) // tile + 1):
+                if (tile_x, tile_y) in self.walls:
+                    return False
+        return True
+
+    def _neighbours(self, index):
+        # Indices of the positions one step away, in DIRECTIONS order. None
+        # for those outside the map
+        width = self.width
+        x = index % width
+        return (index + width if index + width < len(self.distance) else None,
+                index - width if index >= width else None,
+                index + 1 if x < width - 1 else None,
+                index - 1 if x > 0 else None)
+
+    def set_target(self, x, y):
+        """
+        Rebuild the field for a new player position
+        """
+        start = time.perf_counter()
+        self.target = (x, y)
+        self.target_tile = (x // self.tile_size, y // self.tile_size)
+        distance = [UNREACHABLE] * (self.width * self.height)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            source = y * self.width + x
+            distance[source] = 0
+            queue = deque((source,))
+            passable = self.passable
+            width = self.width
+            size = len(distance)
+            # Same as _neighbours, inlined: this is the hot loop
+            while queue:
+                index = queue.popleft()
+                d = distance[index] + 1
+                x = index % width
+                for other in (index + width if index + width < size else -1,
+                              index - width,
+                              index + 1 if x < width - 1 else -1,
+                              index - 1 if x > 0 else -1):
+                    if other >= 0 and distance[other] == UNREACHABLE \
+                            and passable[other]:
+                        distance[other] = d
+                        queue.append(other)
+        self.distance = distance
+        self.rebuilds += 1
+        self.update_time += time.perf_counter() - start
+
+    def clear(self):
+        """
+        Forget the target. All positions become unreachable.
+        """
+        self.target = None
+        self.target_tile = None
+        self.distance = [UNREACHABLE] * (self.width * self.height)
+
+    def remove_wall(self, tile_x, tile_y):
+        """
+        Make a tile passable and update the distances around it.
+
+        Removing a wall can only make paths shorter, so only the positions that
+        get closer to the player are updated.
+        """
+        if (tile_x, tile_y) not in self.walls:
+            return
+        start = time.perf_counter()
+        self.walls.remove((tile_x, tile_y))
+        tile = self.tile_size
+        distance = self.distance
+        queue = deque()
+        for y in range(max(tile_y * tile - self.agent_size + 1, 0),
+                       min((tile_y + 1) * tile, self.height)):
+            for x in range(max(tile_x * tile - self.agent_size + 1, 0),
+                           min((tile_x + 1) * tile, self.width)):
+                index = y * self.width + x
+                if not self.passable[index] and self._fits(x, y):
+                    self.passable[index] = 1
+                    queue.append(index)
+        if self.target is not None:
+            # Newly passable positions take distances from their neighbours,
+            # then whatever got closer passes it on
+            while queue:
+                index = queue.popleft()
+                neighbours = [x for x in self._neighbours(index)
+                              if x is not None and self.passable[x]]
+                for other in neighbours:
+                    if distance[other] != UNREACHABLE and \
+                            (distance[index] == UNREACHABLE or
+                             distance[other] + 1 < distance[index]):
+                        distance[index] = distance[other] + 1
+                if distance[index] == UNREACHABLE:
+                    continue
+                for other in neighbours:
+                    if distance[other] == UNREACHABLE or \
+                            distance[other] > distance[index] + 1:
+                        distance[other] = distance[index] + 1
+                        queue.append(other)
+        self.patches += 1
+        self.update_time += time.perf_counter() - start
+
+    def direction(self, x, y):
+        """
+        Return the direction to step from a given position to get closer to
+        the player.
+
+        :returns: one of DIRECTIONS, or None if the position is unreachable
+        (or is the player's).
+        """
+        if not 0 <= x < self.width or not 0 <= y < self.height:
+            return None
+        index = y * self.width + x
+        d = self.distance[index]
+        if d <= 0:
+            return None
+        for direction, other in zip(DIRECTIONS, self._neighbours(index)):
+            if other is not None and self.distance[other] == d - 1:
+                return direction
+        return None
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_move':
+            entity_id, x, y = event.event_value
+            if entity_id == 'player' and \
+                    (x // self.tile_size, y // self.tile_size) != \
+                    self.target_tile:
+                self.set_target(x, y)
+        elif event.event_type == 'ecs_destroy':
+            if event.event_value == 'player':
+                self.clear()
+            elif event.event_value in self.wall_ids:
+                self.remove_wall(*self.wall_ids.pop(event.event_value))
@@ -0,0 +1,199 @@
+"""
+Event dispatch profiling.
+
+ProfilingDispatcher is a RoutingDispatcher that measures how long every
+``on_event`` call takes. Time is summed per listener class (so that dozens
+of ControllerComponents show up as a single line) and per event type. It also
+counts events per tick and watches the queue depth.
+
+It is opt-in: ``game.py --profile`` or ``headless.py --profile``. A regular
+RoutingDispatcher doesn't pay anything for it, and a ProfilingDispatcher with
+``enabled`` set to False only pays for a single attribute check per
+``dispatch_events`` call.
+"""
+
+from bear_hug.widgets import Listener
+
+import sys
+import time
+
+from routing import RoutingDispatcher
+
+
+class DispatchStats:
+    """
+    Call count, total and maximum time of something
+    """
+    __slots__ = ('calls', 'total', 'max')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+
+class ProfilingDispatcher(RoutingDispatcher):
+    """
+    A RoutingDispatcher that records how long it takes to process events.
+
+    ``listener_stats`` is a dict of ``{listener class name: DispatchStats}``
+    for individual ``on_event`` calls; ``event_stats`` is the same for event
+    types, where a single call is the delivery of one event to all of its
+    listeners (both regular and routed). Events emitted by a listener are not
+    included in its time, as they are processed later.
+
+    Ticks are counted by 'tick' events. For every tick, the number of events
+    dispatched since the previous one is recorded, as is the largest queue
+    length seen.
+
+    :param enabled: whether to collect the data. Can be toggled at any time.
+    """
+    def __init__(self, enabled=True):
+        super().__init__()
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all the data collected so far
+        """
+        self.listener_stats = {}
+        self.event_stats = {}
+        self.ticks = 0
+        self.events_this_tick = 0
+        self.max_events_per_tick = 0
+        self.total_events = 0
+        self.max_queue_depth = 0
+        self.started = time.perf_counter()
+
+    def _dispatch_queue(self):
+        # Same as RoutingDispatcher._dispatch_queue, so that the events are
+        # processed in exactly the same order, only timed
+        if not self.enabled:
+            return super()._dispatch_queue()
+        clock = time.perf_counter
+        while len(self.deque) > 0:
+            if len(self.deque) > self.max_queue_depth:
+                self.max_queue_depth = len(self.deque)
+            e = self.deque.popleft()
+            if e.event_type == 'tick':
+                self._end_tick()
+            self.events_this_tick += 1
+            event_start = clock()
+            for listener in self.listeners[e.event_type]:
+                self._timed_call(listener, e)
+            if e.event_type in self.routes:
+                routed = self.routed_listeners[e.event_type]
+                for address in self.routes[e.event_type](e.event_value):
+                    if address not in routed:
+                        continue
+                    for listener in routed[address]:
+                        self._timed_call(listener, e)
+            elapsed = clock() - event_start
+            try:
+                self.event_stats[e.event_type].add(elapsed)
+            except KeyError:
+                self.event_stats[e.event_type] = DispatchStats()
+                self.event_stats[e.event_type].add(elapsed)
+
+    def _timed_call(self, listener, event):
+        start = time.perf_counter()
+        r = listener.on_event(event)
+        elapsed = time.perf_counter() - start
+        name = type(listener).__name__
+        try:
+            self.listener_stats[name].add(elapsed)
+        except KeyError:
+            self.listener_stats[name] = DispatchStats()
+            self.listener_stats[name].add(elapsed)
+        self._process_return(r)
+
+    def _call_deferred(self, callback):
+        # Deferred callbacks are listed by name, eg 'DamageSystem.resolve'
+        if not self.enabled:
+            return callback()
+        start = time.perf_counter()
+        callback()
+        elapsed = time.perf_counter() - start
+        name = getattr(callback, '__qualname__', type(callback).__name__)
+        try:
+            self.listener_stats[name].add(elapsed)
+        except KeyError:
+            self.listener_stats[name] = DispatchStats()
+            self.listener_stats[name].add(elapsed)
+
+    def _end_tick(self):
+        if self.ticks:
+            self.total_events += self.events_this_tick
+            if self.events_this_tick > self.max_events_per_tick:
+                self.max_events_per_tick = self.events_this_tick
+        self.ticks += 1
+        self.events_this_tick = 0
+
+    def report(self, top=20):
+        """
+        Return a human-readable report as a string.
+
+        :param top: maximum number of listener classes and event types to list,
+        most expensive first.
+        """
+        wall = time.perf_counter() - self.started
+        lines = [f'{self.ticks} ticks in {wall:.2f} s']
+        if self.ticks > 1:
+            lines.append(f'Events per tick: '
+                         f'{self.total_events / (self.ticks - 1):.1f} mean, '
+                         f'{self.max_events_per_tick} max')
+        lines.append(f'Max queue depth: {self.max_queue_depth}')
+        for title, stats in (('Listener', self.listener_stats),
+                             ('Event type', self.event_stats)):
+            lines.append('')
+            lines.append(f'{title:<32} {"calls":>9} {"total ms":>10} '
+                         f'{"mean us":>9} {"max us":>9}')
+            for name, s in sorted(stats.items(),
+                                  key=lambda x: x[1].total,
+                                  reverse=True)[:top]:
+                lines.append(f'{name:<32} {s.calls:>9} '
+                             f'{s.total * 1e3:>10.1f} '
+                             f'{s.total / s.calls * 1e6:>9.1f} '
+                             f'{s.max * 1e6:>9.1f}')
+        return '\n'.join(lines)
+
+    def dump(self, file=sys.stderr):
+        print(self.report(), file=file)
+
+
+class ProfileReportListener(Listener):
+    """
+    Dumps the ProfilingDispatcher report when a key is pressed.
+
+    Should be subscribed to 'key_down' and 'key_up'. Holding the key produces
+    a single report.
+
+    :param dispatcher: ProfilingDispatcher
+
+    :param key: key to press, as in BearTerminal 'key_down' events.
+
+    :param file: where to write the report
+    """
+    def __init__(self, *args, dispatcher, key='TK_F12', file=sys.stderr,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = dispatcher
+        self.key = key
+        self.file = file
+        self.pressed = False
+
+    def on_event(self, event):
+        if event.event_value != self.key:
+            return
+        if event.event_type == 'key_down' and not self.pressed:
+            self.pressed = True
+            self.dispatcher.dump(self.file)
+        elif event.event_type == 'key_up':
+            self.pressed = False
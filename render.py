@@ -0,0 +1,256 @@
+"""
+Dirty-rectangle rendering.
+
+ECSLayout recomposites all of its 84x60 chars whenever anything on the map has
+moved, and BearTerminal then pushes every one of them to bearlibterminal.
+Most of the time, only a few tanks and bullets have changed. DirtyRectLayout
+remembers which cells were covered by the entities that moved, switched image,
+were added or removed during a tick, and at 'tick_over' recomposites only
+those, merged into a single flush. RegionTerminal can then put just these
+cells on screen.
+"""
+
+from bearlibterminal import terminal as blt
+
+import time
+
+from bear_hug.bear_hug import BearTerminal
+from bear_hug.bear_utilities import BearException
+
+from spatial import GridECSLayout
+
+
+class RegionTerminal(BearTerminal):
+    """
+    A BearTerminal that can update a part of a widget.
+
+    Widgets that know which of their cells have changed can call
+    ``update_cells`` instead of ``update_widget``.
+
+    Widgets that keep their chars in a ``buffer`` (a buffers.CharBuffer, eg
+    buffers.ArrayLayout) are drawn from it, and can have a few rectangles
+    updated via ``update_rects``.
+    """
+    def update_widget(self, widget, refresh=False):
+        if getattr(widget, 'buffer', None) is None:
+            return super().update_widget(widget, refresh=refresh)
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        blt.layer(self.widget_locations[widget].layer)
+        blt.clear_area(*self.widget_locations[widget].pos,
+                       widget.buffer.width, widget.buffer.height)
+        self.update_rects(widget, [(0, 0, widget.buffer.width,
+                                    widget.buffer.height)], refresh=refresh)
+
+    def update_cells(self, widget, cells, refresh=False):
+        """
+        Draw some of the widget's chars on screen.
+
+        :param widget: A widget to be updated.
+
+        :param cells: an iterable of (x, y) positions within the widget.
+        """
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        pos_x, pos_y = self.widget_locations[widget].pos
+        layer = self.widget_locations[widget].layer
+        pointers = self._widget_pointers[layer]
+        blt.layer(layer)
+        running_color = self.default_color
+        for x, y in cells:
+            color = widget.colors[y][x]
+            if color and color != running_color:
+                running_color = color
+                blt.color(running_color)
+            blt.put(pos_x + x, pos_y + y, widget.chars[y][x])
+            pointers[pos_x + x][pos_y + y] = widget
+        if running_color != self.default_color:
+            blt.color(self.default_color)
+        if refresh:
+            self.refresh()
+
+    def update_rects(self, widget, rects, refresh=False):
+        """
+        Draw some rectangles of the widget's buffer on screen.
+
+        :param widget: A widget with a ``buffer`` to be updated.
+
+        :param rects: an iterable of (x, y, x_end, y_end) within the widget,
+        ends excluded.
+        """
+        if widget not in self.widget_locations:
+            raise BearException('Cannot update non-added Widgets')
+        pos_x, pos_y = self.widget_locations[widget].pos
+        layer = self.widget_locations[widget].layer
+        pointers = self._widget_pointers[layer]
+        blt.layer(layer)
+        buffer = widget.buffer
+        palette = buffer.palette.colors
+        # Palette index rather than the color itself. 0 is no color
+        running_color = 0
+        for x, y, x_end, y_end in rects:
+            chars = buffer.chars[y:y_end, x:x_end].tolist()
+            colors = buffer.colors[y:y_end, x:x_end].tolist()
+            for line, char_row, color_row in zip(
+                    range(pos_y + y, pos_y + y_end), chars, colors):
+                for char, code, color in zip(
+                        range(pos_x + x, pos_x + x_end), char_row, color_row):
+                    if color and color != running_color:
+                        running_color = color
+                        blt.color(palette[color])
+                    blt.put(char, line, code)
+                    pointers[char][line] = widget
+        if running_color:
+            blt.color(self.default_color)
+        if refresh:
+            self.refresh()
+
+
+class DirtyRectLayout(GridECSLayout):
+    """
+    A GridECSLayout that only redraws the cells that have changed.
+
+    A cell is dirty if it was covered (before or after) by an entity that
+    was moved, added, removed or destroyed, or by a widget that has switched
+    image, during the current tick. Anything else that changes the map should
+    call ``mark_dirty``, or emit ``BearEvent('ecs_update', entity_id)`` for a
+    single entity. 'ecs_update' without entity ID redraws the entire layout.
+
+    At 'tick_over', all dirty cells are recomposited exactly like
+    ``Layout._rebuild_self`` would do it, and pushed to the terminal at once:
+    via ``terminal.update_cells``, if the terminal supports it, or as the
+    whole widget otherwise.
+
+    If ``deferred`` is set, nothing is drawn at 'tick_over'. Dirty cells are
+    collected until ``draw_frame`` is called, eg by timestep.FixedStepLoop
+    when it is time to render.
+
+    ``cells_redrawn`` is the number of cells recomposited during the latest
+    frame. ``total_cells_redrawn`` and ``frames`` are the totals since
+    creation, with every 'tick_over' (or, if deferred, every ``draw_frame``
+    call) counted as a frame, even if nothing was drawn. ``draw_time`` is the
+    total time spent in ``draw_frame``, in seconds.
+    """
+    def __init__(self, chars, colors, **kwargs):
+        super().__init__(chars, colors, **kwargs)
+        # Set of (x, y)
+        self.dirty_cells = set()
+        # The first frame is always drawn in full
+        self.full_redraw = True
+        self.deferred = False
+        self.cells_redrawn = 0
+        self.total_cells_redrawn = 0
+        self.frames = 0
+        self.draw_time = 0
+
+    def mark_dirty(self, x, y, width, height):
+        """
+        Redraw a given rectangle at the end of this tick.
+
+        Parts of the rectangle that are outside the layout are ignored.
+        """
+        if self.full_redraw:
+            return
+        x_end = min(x + width, len(self.chars[0]))
+        y_end = min(y + height, len(self.chars))
+        x = max(x, 0)
+        if x == 0 and y <= 0 and x_end == len(self.chars[0]) \
+                and y_end == len(self.chars):
+            # No point in listing every cell
+            self.full_redraw = True
+            return
+        cells = self.dirty_cells
+        for line in range(max(y, 0), y_end):
+            cells.update((char, line) for char in range(x, x_end))
+
+    def _mark_child(self, child):
+        # Mark the widget's current rectangle, if it is on the layout
+        pos = self.child_locations.get(child)
+        if pos is not None:
+            self.mark_dirty(*pos, len(child.chars[0]), len(child.chars))
+
+    def on_event(self, event):
+        event_type = event.event_type
+        if event_type == 'ecs_move':
+            widget = self.widgets[event.event_value[0]]
+            old_pos = self.child_locations.get(widget)
+            r = super().on_event(event)
+            if self.child_locations.get(widget) != old_pos:
+                if old_pos is not None:
+                    self.mark_dirty(*old_pos, len(widget.chars[0]),
+                                    len(widget.chars))
+                self._mark_child(widget)
+            return r
+        elif event_type in ('ecs_remove', 'ecs_destroy'):
+            # Before the widget is gone
+            self._mark_child(self.widgets[event.event_value])
+        elif event_type == 'ecs_update':
+            if event.event_value in self.widgets:
+                self._mark_child(self.widgets[event.event_value])
+            else:
+                self.full_redraw = True
+        elif event_type == 'service' and event.event_value == 'tick_over':
+            if not self.deferred:
+                self.draw_frame()
+            return
+        r = super().on_event(event)
+        if event_type == 'ecs_add':
+            self._mark_child(self.widgets[event.event_value[0]])
+        return r
+
+    def redraw_child(self, child):
+        """
+        Redraw a child widget at the end of this tick, eg after its image has
+        changed
+        """
+        self._mark_child(child)
+
+    def draw_frame(self):
+        """
+        Recomposite the dirty cells and push them to the terminal
+        """
+        start = time.perf_counter()
+        self.frames += 1
+        self.cells_redrawn = self._redraw()
+        self.total_cells_redrawn += self.cells_redrawn
+        self.full_redraw = False
+        self.need_redraw = False
+        self.draw_time += time.perf_counter() - start
+
+    def _redraw(self):
+        # Returns the number of cells redrawn
+        if self.full_redraw:
+            self._rebuild_self()
+            self.terminal.update_widget(self)
+            self.dirty_cells = set()
+            return len(self.chars) * len(self.chars[0])
+        if not self.dirty_cells:
+            return 0
+        cells = self.dirty_cells
+        self._rebuild_cells(cells)
+        if hasattr(self.terminal, 'update_cells'):
+            self.terminal.update_cells(self, cells)
+        else:
+            self.terminal.update_widget(self)
+        self.dirty_cells = set()
+        return len(cells)
+
+    def _rebuild_cells(self, cells):
+        # Same as Layout._rebuild_self, including which child the color is
+        # taken from, but for the given cells only. It is done in place: the
+        # first frame is always a full one, and Layout._rebuild_self makes
+        # fresh lists for it, so these are no longer the background's
+        chars = self.chars
+        colors = self.colors
+        pointers = self._child_pointers
+        locations = self.child_locations
+        for x, y in cells:
+            for child in reversed(pointers[y][x]):
+                child_x, child_y = locations[child]
+                c = child.chars[y - child_y][x - child_x]
+                if c != ' ':
+                    chars[y][x] = c
+                    break
+            else:
+                chars[y][x] = ' '
+            colors[y][x] = child.colors[y - child_y][x - child_x]
@@ -0,0 +1,360 @@
+#! /usr/bin/env python3
+"""
+Input recording and replay.
+
+The only things that make one session different from another are the RNG
+seed, the time deltas of the 'tick' events and the keys pressed. RecordingLoop
+writes all three into a compact binary log, along with a hash of the game
+state every now and then. ``replay`` feeds the log back into a headless game
+as fast as possible and checks that the hashes match.
+
+Log format (all numbers little-endian):
+
+* Header: ``b'ACRL'``, version (uint8), seed (uint64), metadata length
+  (uint32) and the metadata itself, a JSON dict of ``{'fps': fps, 'world':
+  build_world kwargs}``.
+* Then any number of records, each starting with a single type byte:
+    * ``b'K'``: a new key name: length (uint8) and the name itself, in ASCII.
+      Keys are numbered in the order of their definitions, starting with 0.
+    * ``b'T'``: a tick: time delta (double), key count (uint8) and that many
+      key numbers (uint8 each), for the 'key_down' events that came before
+      this tick.
+    * ``b'H'``: a state hash: tick count (uint32) and ``state_hash`` (8 bytes)
+      after that many ticks.
+
+Can also be launched as a script to replay a log:
+``python3 replay.py session.acrl``
+"""
+
+from bear_hug.bear_hug import BearLoop
+from bear_hug.ecs import EntityTracker
+from bear_hug.event import BearEvent
+
+from hashlib import blake2b
+import json
+import struct
+
+from headless import HeadlessGame
+from timestep import FixedStepLoop
+
+
+MAGIC = b'ACRL'
+VERSION = 1
+HASH_SIZE = 8
+
+_HEADER = struct.Struct('<BQI')
+_TICK = struct.Struct('<dB')
+_HASH = struct.Struct('<I')
+
+
+class DesyncError(Exception):
+    """
+    Raised when the replayed game state does not match the recorded one
+    """
+    def __init__(self, tick, expected, actual):
+        super().__init__(f'State mismatch after tick {tick}: expected '
+                         f'{expected.hex()}, got {actual.hex()}')
+        self.tick = tick
+        self.expected = expected
+        self.actual = actual
+
+
+def state_hash(world):
+    """
+    Hash the state of the game: every entity's ID, position, hitpoints and
+    image, plus the score and player HP.
+
+    :param world: World instance
+
+    :returns: bytes of length HASH_SIZE
+    """
+    h = blake2b(digest_size=HASH_SIZE)
+    entities = EntityTracker().entities
+    for entity_id in sorted(entities):
+        entity = entities[entity_id]
+        state = [entity_id]
+        if hasattr(entity, 'position'):
+            state.append(entity.position.pos)
+        if hasattr(entity, 'health'):
+            state.append(entity.health.hitpoints)
+        if hasattr(entity.widget.widget, 'current_image'):
+            state.append(entity.widget.widget.current_image)
+        h.update(repr(state).encode())
+    h.update(repr((world.score.score, world.hp.hp)).encode())
+    return h.digest()
+
+
+################################################################################
+# Log writing and reading
+################################################################################
+
+
+class LogWriter:
+    """
+    Writes the input log, record by record.
+
+    :param path: file to write to
+
+    :param seed: seed of the global RNG
+
+    :param fps: ticks per second that the game runs at
+
+    :param world_kwargs: kwargs that were passed to ``build_world``. Should be
+    JSON-serializable.
+    """
+    def __init__(self, path, seed, fps=30, world_kwargs=None):
+        self.file = open(path, 'wb')
+        metadata = json.dumps({'fps': fps,
+                               'world': world_kwargs or {}}).encode()
+        self.file.write(MAGIC)
+        self.file.write(_HEADER.pack(VERSION, seed, len(metadata)))
+        self.file.write(metadata)
+        # {key name: key number}
+        self.keys = {}
+
+    def write_tick(self, dt, keys):
+        """
+        Record a tick and the keys pressed before it
+        """
+        numbers = []
+        for key in keys:
+            if key not in self.keys:
+                name = key.encode('ascii')
+                self.file.write(b'K' + bytes((len(name),)) + name)
+                self.keys[key] = len(self.keys)
+            numbers.append(self.keys[key])
+        self.file.write(b'T' + _TICK.pack(dt, len(numbers)) + bytes(numbers))
+
+    def write_hash(self, ticks, digest):
+        """
+        Record a state hash after a given number of ticks.
+
+        The file is flushed after every hash, so a crashed game leaves a log
+        that is good at least up to the latest hash.
+        """
+        self.file.write(b'H' + _HASH.pack(ticks) + digest)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class InputLog:
+    """
+    A recorded session, as read by ``read_log``.
+
+    :param seed: seed of the global RNG
+
+    :param fps: ticks per second
+
+    :param world_kwargs: kwargs for ``build_world``
+
+    :param ticks: a list of ``(dt, keys)`` tuples, one per tick
+
+    :param hashes: a dict of ``{tick count: state hash}``
+    """
+    def __init__(self, seed, fps, world_kwargs, ticks, hashes):
+        self.seed = seed
+        self.fps = fps
+        self.world_kwargs = world_kwargs
+        self.ticks = ticks
+        self.hashes = hashes
+
+    def keys_for_tick(self, tick):
+        """
+        Keys pressed before a given tick. Can be used as HeadlessTerminal's
+        ``input_script``.
+        """
+        return self.ticks[tick][1] if tick < len(self.ticks) else ()
+
+    @property
+    def duration(self):
+        """
+        Session length in seconds
+        """
+        return sum(dt for dt, _ in self.ticks)
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+def read_log(path):
+    """
+    Read the input log from a file.
+
+    If the file ends in the middle of a record (eg the game has crashed while
+    recording), that record is ignored.
+
+    :returns: InputLog
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not an input log')
+    offset = len(MAGIC)
+    version, seed, metadata_length = _HEADER.unpack_from(data, offset)
+    if version != VERSION:
+        raise ValueError(f'Unsupported input log version {version}')
+    offset += _HEADER.size
+    metadata = json.loads(data[offset:offset + metadata_length])
+    offset += metadata_length
+    keys = []
+    ticks = []
+    hashes = {}
+    try:
+        while offset < len(data):
+            record = data[offset:offset + 1]
+            offset += 1
+            if record == b'T':
+                dt, count = _TICK.unpack_from(data, offset)
+                offset += _TICK.size
+                if offset + count > len(data):
+                    break
+                ticks.append((dt, tuple(keys[x]
+                                        for x in data[offset:offset + count])))
+                offset += count
+            elif record == b'K':
+                length = data[offset]
+                if offset + 1 + length > len(data):
+                    break
+                name = data[offset + 1:offset + 1 + length]
+                keys.append(name.decode('ascii'))
+                offset += 1 + length
+            elif record == b'H':
+                ticks_count, = _HASH.unpack_from(data, offset)
+                offset += _HASH.size
+                if offset + HASH_SIZE > len(data):
+                    break
+                hashes[ticks_count] = data[offset:offset + HASH_SIZE]
+                offset += HASH_SIZE
+            else:
+                raise ValueError(f'Unknown record {record} in {path}')
+    except (struct.error, IndexError):
+        # The game has crashed in the middle of writing a record. Everything
+        # before it is still good
+        pass
+    return InputLog(seed, metadata['fps'], metadata['world'], ticks, hashes)
+
+
+################################################################################
+# Recording and replaying
+################################################################################
+
+
+class RecordingLoop(BearLoop):
+    """
+    A BearLoop that writes every tick into the input log.
+
+    It records exactly what the loop feeds into the dispatcher: the time
+    delta and the 'key_down' events from the terminal. Every
+    ``hash_interval`` ticks, if ``world`` is set, the state hash is recorded
+    too, and ``finish`` records the final one.
+
+    The game should be built after the global RNG is seeded with the seed
+    passed to the writer.
+
+    :param writer: LogWriter
+
+    :param world: World to hash. Can be set later.
+
+    :param hash_interval: ticks between state hashes.
+    """
+    def __init__(self, terminal, queue, writer, world=None, fps=30,
+                 hash_interval=300, **kwargs):
+        super().__init__(terminal, queue, fps=fps, **kwargs)
+        self.writer = writer
+        self.world = world
+        self.hash_interval = hash_interval
+        self.recorded_ticks = 0
+
+    def _run_iteration(self, time_since_last_tick):
+        self._simulate(time_since_last_tick)
+        self.terminal.refresh()
+
+    def _simulate(self, time_since_last_tick):
+        # Same as BearLoop._run_iteration, plus the recording, minus the
+        # refresh
+        keys = []
+        for event in self.terminal.check_input():
+            if event.event_type == 'key_down':
+                keys.append(event.event_value)
+            self.queue.add_event(event)
+        self.writer.write_tick(time_since_last_tick, keys)
+        self.queue.add_event(BearEvent(event_type='tick',
+                                       event_value=time_since_last_tick))
+        self.queue.dispatch_events()
+        self.queue.add_event(BearEvent(event_type='service',
+                                       event_value='tick_over'))
+        self.queue.dispatch_events()
+        self.recorded_ticks += 1
+        if self.world and self.recorded_ticks % self.hash_interval == 0:
+            self.writer.write_hash(self.recorded_ticks,
+                                   state_hash(self.world))
+
+    def finish(self):
+        """
+        Record the final state hash and close the log.
+
+        Should be called after the loop has stopped.
+        """
+        if self.world and self.recorded_ticks % self.hash_interval != 0:
+            self.writer.write_hash(self.recorded_ticks,
+                                   state_hash(self.world))
+        self.writer.close()
+
+
+class FixedStepRecordingLoop(RecordingLoop, FixedStepLoop):
+    """
+    A FixedStepLoop that writes every tick into the input log.
+
+    Accepts the arguments of both. Every tick is recorded with the same time
+    delta, regardless of the frames skipped.
+    """
+    pass
+
+
+def replay(log, atlas=None, check=True):
+    """
+    Replay a recorded session in a headless game, as fast as possible.
+
+    :param log: InputLog or a path to the log file
+
+    :param atlas: an Atlas. If not set, battlecity atlas is loaded.
+
+    :param check: if True, the state is compared to every recorded hash, and
+    DesyncError is raised on the first mismatch.
+
+    :returns: HeadlessGame in the state it was at the end of the session
+    """
+    if isinstance(log, str):
+        log = read_log(log)
+    game = HeadlessGame(atlas=atlas, input_script=log.keys_for_tick,
+                        seed=log.seed, fps=log.fps, **log.world_kwargs)
+    for tick, (dt, _) in enumerate(log.ticks, start=1):
+        game.loop.step(dt)
+        if check and tick in log.hashes:
+            actual = state_hash(game.world)
+            if actual != log.hashes[tick]:
+                raise DesyncError(tick, log.hashes[tick], actual)
+    return game
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(
+        description='Replay a recorded AsciiCity session without a window')
+    parser.add_argument('log', help='Input log file')
+    parser.add_argument('--no-check', action='store_true',
+                        help='Do not compare state hashes')
+    args = parser.parse_args()
+    log = read_log(args.log)
+    start = time.perf_counter()
+    game = replay(log, check=not args.no_check)
+    elapsed = time.perf_counter() - start
+    print(f'Replayed {log.duration:.1f} s ({len(log)} ticks) in '
+          f'{elapsed:.2f} s')
+    if not args.no_check:
+        print(f'All {len(log.hashes)} state hashes match')
+    print(f'Score: {game.world.score.score}, HP: {game.world.hp.hp}, '
+          f'state: {state_hash(game.world).hex()}')
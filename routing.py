@@ -0,0 +1,204 @@
+"""
+Event routing.
+
+BearEventDispatcher sends every event to every listener subscribed to its
+type, and it's up to the listeners to throw away events that are about
+somebody else. For 'ac_damage' and 'ecs_collision' this means every hit
+is processed by every health and collision component on the map.
+
+RoutingDispatcher additionally supports routed subscriptions: a listener
+subscribes to an event type *and an address* (normally its owner's entity
+ID) and gets only the events of this type that are addressed to it. Regular
+subscriptions work as usual, so loggers and labels still get everything.
+
+It can also defer a callback until the queue runs dry, which is the way to
+do something once per tick after everything else has happened, but before
+'tick_over'.
+"""
+
+from bear_hug.bear_utilities import BearLoopException
+from bear_hug.event import BearEvent, BearEventDispatcher
+
+
+def route_to_first(value):
+    """
+    A route for events whose value is ``(entity_id, whatever...)``, such as
+    'ac_damage'
+    """
+    return value[:1]
+
+
+def route_nowhere(value):
+    """
+    A route for events that only regular listeners should get, eg 'ac_damage'
+    when the hits are resolved by a DamageSystem rather than by every health
+    component
+    """
+    return ()
+
+
+class RoutingDispatcher(BearEventDispatcher):
+    """
+    A BearEventDispatcher with routed subscriptions.
+
+    An event type can be routed if it has a route, which is a callable that
+    accepts ``event_value`` and returns an iterable of addresses. Routed
+    listeners are called after the regular ones, in the order of addresses and
+    then in the order of subscription.
+
+    'ecs_collision' is routed out of the box, to both entities involved in the
+    collision. Other event types can be made routable either via
+    ``register_event_type(event_type, route=...)`` or ``add_route``.
+
+    Callbacks passed to ``defer`` are called when the queue is empty, and
+    then whatever they have emitted is dispatched.
+    """
+    def __init__(self):
+        super().__init__()
+        # {event_type: route callable}
+        self.routes = {}
+        # {event_type: {address: [listeners]}}
+        self.routed_listeners = {}
+        # {listener: set of (event_type, address)}, for quick unsubscription
+        self._listener_routes = {}
+        # Callables to call when the queue is empty
+        self.deferred = []
+        self.add_route('ecs_collision', lambda value: value)
+
+    def register_event_type(self, event_type, route=None):
+        """
+        Add a new event type to be processed by queue.
+
+        :param event_type: A string to be used as an event type.
+
+        :param route: if set, the event type is made routable with this route.
+        """
+        super().register_event_type(event_type)
+        if route is not None:
+            self.add_route(event_type, route)
+
+    def add_route(self, event_type, route):
+        """
+        Make an event type routable.
+
+        :param event_type: an already registered event type
+
+        :param route: a callable that accepts ``event_value`` and returns an
+        iterable of addresses this event should be delivered to.
+        """
+        if event_type not in self.event_types:
+            raise BearLoopException(f'Unknown event class {event_type}')
+        if not callable(route):
+            raise BearLoopException('Event route should be callable')
+        self.routes[event_type] = route
+        self.routed_listeners.setdefault(event_type, {})
+
+    def register_routed_listener(self, listener, event_types, address):
+        """
+        Subscribe a listener to the events addressed to ``address``.
+
+        :param listener: a listener to add.
+
+        :param event_types: a single routable event type or a list of them.
+
+        :param address: an address, normally an entity ID.
+        """
+        if not hasattr(listener, 'on_event'):
+            raise BearLoopException('Cannot add an object without on_event' +
+                                    ' method as a listener')
+        if isinstance(event_types, str):
+            event_types = [event_types]
+        for event_type in event_types:
+            if event_type not in self.routes:
+                raise BearLoopException(
+                    f'Event type {event_type} cannot be routed')
+            listeners = self.routed_listeners[event_type].setdefault(address,
+                                                                     [])
+            if listener not in listeners:
+                listeners.append(listener)
+                self._listener_routes.setdefault(listener, set()).add(
+                    (event_type, address))
+
+    def unregister_routed_listener(self, listener, event_types='all'):
+        """
+        Remove routed subscriptions of a listener.
+
+        :param listener: listener to unsubscribe
+
+        :param event_types: a list of event types to unsubscribe from or 'all'.
+        """
+        subscriptions = self._listener_routes.get(listener)
+        if not subscriptions:
+            return
+        for event_type, address in list(subscriptions):
+            if event_types != 'all' and event_type not in event_types:
+                continue
+            listeners = self.routed_listeners[event_type][address]
+            listeners.remove(listener)
+            if not listeners:
+                del self.routed_listeners[event_type][address]
+            subscriptions.remove((event_type, address))
+        if not subscriptions:
+            del self._listener_routes[listener]
+
+    def unregister_listener(self, listener, event_types='all'):
+        """
+        Unsubscribe a listener from all or some of its event types, including
+        the routed subscriptions.
+        """
+        super().unregister_listener(listener, event_types)
+        self.unregister_routed_listener(listener, event_types)
+
+    def defer(self, callback):
+        """
+        Call ``callback`` (without arguments) once the queue is empty.
+
+        It is called after all the events queued so far, and all the events
+        they cause, are processed, but still within the same
+        ``dispatch_events``. During the tick, this means after everything
+        else that happens in this tick and before 'tick_over'. Every ``defer``
+        means a single call.
+        """
+        self.deferred.append(callback)
+
+    def dispatch_events(self):
+        """
+        Dispatch all the events to their listeners, both regular and routed,
+        then call the deferred callbacks and dispatch whatever they emit.
+
+        Whatever listeners return is added to the queue.
+        """
+        self._dispatch_queue()
+        while self.deferred:
+            callbacks = self.deferred
+            self.deferred = []
+            for callback in callbacks:
+                self._call_deferred(callback)
+            self._dispatch_queue()
+
+    def _dispatch_queue(self):
+        while len(self.deque) > 0:
+            e = self.deque.popleft()
+            for listener in self.listeners[e.event_type]:
+                self._process_return(listener.on_event(e))
+            if e.event_type in self.routes:
+                routed = self.routed_listeners[e.event_type]
+                for address in self.routes[e.event_type](e.event_value):
+                    if address not in routed:
+                        continue
+                    for listener in routed[address]:
+                        self._process_return(listener.on_event(e))
+
+    def _call_deferred(self, callback):
+        callback()
+
+    def _process_return(self, r):
+        if r:
+            if isinstance(r, BearEvent):
+                self.add_event(r)
+            elif isinstance(r, list):
+                for event in r:
+                    self.add_event(event)
+            else:
+                raise BearLoopException('on_event returns something ' +
+                                        'other than BearEvent')
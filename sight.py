@@ -0,0 +1,114 @@
+"""
+Line of sight index.
+
+Enemy tanks shoot whenever they are roughly aligned with the player, even if
+there is a wall in between. LineOfSight keeps a bitset of wall tiles for
+every row and every column of the tile grid, so checking whether a straight
+line between a tank and the player is clear is a single AND of two ints,
+regardless of the distance and the number of walls.
+"""
+
+from bear_hug.widgets import Listener
+
+from level import TILE_SIZE, wall_id
+from tags import EntityIndex, Tag
+
+
+class LineOfSight(Listener):
+    """
+    Row and column bitsets of wall tiles.
+
+    Bit ``x`` of ``rows[y]`` and bit ``y`` of ``columns[x]`` are set if the
+    tile (x, y) is a wall. Other tanks don't block the line.
+
+    Should be subscribed to 'ecs_create' and 'ecs_destroy', after the
+    EntityIndex. Walls are the entities tagged Tag.WALL; whatever tile such
+    an entity is created in becomes a wall (so walls created as entities at
+    the start, walls created by StaticWallLayer when hit and any walls added
+    during the game are all the same), and is cleared when it is destroyed.
+
+    :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+
+    :param tile_size: size of a map tile in chars
+    """
+    def __init__(self, *args, walls, tile_size=TILE_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tile_size = tile_size
+        self.reset(walls)
+
+    def reset(self, walls):
+        """
+        Forget all the walls and index the new ones.
+
+        :param walls: a 2-nested list of tiles, 1 for wall and 0 for nothing
+        """
+        self.rows = [0] * len(walls)
+        self.columns = [0] * len(walls[0])
+        # {entity ID: tile}
+        self.wall_ids = {}
+        for y in range(len(walls)):
+            for x in range(len(walls[0])):
+                if walls[y][x]:
+                    self.add_wall(x, y, wall_id(x, y))
+
+    def add_wall(self, x, y, entity_id=None):
+        """
+        Mark a tile as a wall.
+
+        :param entity_id: ID of the wall entity, so that the tile is cleared
+        when it's destroyed.
+        """
+        if not 0 <= y < len(self.rows) or not 0 <= x < len(self.columns):
+            return
+        self.rows[y] |= 1 << x
+        self.columns[x] |= 1 << y
+        if entity_id is not None:
+            self.wall_ids[entity_id] = (x, y)
+
+    def remove_wall(self, x, y):
+        """
+        Mark a tile as not a wall
+        """
+        if not 0 <= y < len(self.rows) or not 0 <= x < len(self.columns):
+            return
+        self.rows[y] &= ~(1 << x)
+        self.columns[x] &= ~(1 << y)
+
+    @staticmethod
+    def _span(start, end):
+        # Bitmask of start..end inclusive, in whatever order
+        if start > end:
+            start, end = end, start
+        return ((1 << (end + 1)) - 1) ^ ((1 << max(start, 0)) - 1)
+
+    def clear_row(self, y, x1, x2):
+        """
+        Check that a horizontal line of chars from (x1, y) to (x2, y) doesn't
+        cross any walls.
+        """
+        tile = self.tile_size
+        if not 0 <= y // tile < len(self.rows):
+            return False
+        return not self.rows[y // tile] & self._span(x1 // tile, x2 // tile)
+
+    def clear_column(self, x, y1, y2):
+        """
+        Check that a vertical line of chars from (x, y1) to (x, y2) doesn't
+        cross any walls.
+        """
+        tile = self.tile_size
+        if not 0 <= x // tile < len(self.columns):
+            return False
+        return not self.columns[x // tile] & self._span(y1 // tile,
+                                                        y2 // tile)
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_create':
+            entity = event.event_value
+            if EntityIndex().is_a(entity.id, Tag.WALL):
+                self.add_wall(entity.position.x // self.tile_size,
+                              entity.position.y // self.tile_size,
+                              entity.id)
+        elif event.event_type == 'ecs_destroy':
+            if event.event_value in self.wall_ids:
+                self.remove_wall(*self.wall_ids.pop(event.event_value))
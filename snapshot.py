@@ -0,0 +1,626 @@
+"""
+World snapshots.
+
+Components can be serialized via their JSON ``__repr__``, but that is meant
+for saving a single entity once in a while: every subclass calls
+``loads(super().__repr__())`` and dumps the result again. Snapshotter
+captures the state of every entity in the EntityTracker (plus score,
+spawner, untouched walls and, optionally, the RNGs) as a bunch of small
+fixed-size binary chunks, one per component, and can restore the game to it.
+
+Since the chunks are just bytes, comparing two snapshots is cheap, and a
+Delta records only the chunks that have changed. History keeps a snapshot
+per tick this way, so that the game can be rewound.
+
+Only the state that changes during the game is recorded. Whatever is set
+when the world is built (the level, controller parameters, listeners) is
+expected to be the same when a snapshot is restored.
+
+Binary format (all numbers little-endian): ``b'ACSN'``, version (uint8),
+flags (uint8: 1 for delta, 2 if world state is present, 4 if RNG state is
+present), then world state and RNG state, if present, each as length
+(uint32) and data. Then, for deltas only, the number of removed entities
+(uint32) and their IDs. Then the number of entity records (uint32), and the
+records themselves: ID length (uint8), ID, kind (uint8), a mask of the
+chunks present (uint8) and the chunks.
+"""
+
+from bear_hug.bear_utilities import BearECSException
+from bear_hug.ecs import EntityTracker
+from bear_hug.event import BearEvent
+from bear_hug.widgets import Listener
+
+from collections import deque
+import json
+import random
+import struct
+
+from entities import create_player_tank, create_enemy_tank, create_wall, \
+    create_bullet, create_spawner_house, PooledDestructorComponent
+from level import TILE_SIZE
+from tags import Tag
+
+
+MAGIC = b'ACSN'
+VERSION = 3
+
+DELTA = 1
+HAS_WORLD = 2
+HAS_RNG = 4
+
+# Entity kinds
+PLAYER, ENEMY, WALL, BULLET, OTHER, PLAYER_BULLET, ENEMY_BULLET = range(7)
+BULLETS = (BULLET, PLAYER_BULLET, ENEMY_BULLET)
+# {kind: entity tags}. Untagged entities, and those with other tags, are OTHER
+KIND_TAGS = {PLAYER: Tag.PLAYER_TANK,
+             ENEMY: Tag.ENEMY_TANK,
+             WALL: Tag.WALL,
+             BULLET: Tag.BULLET,
+             PLAYER_BULLET: Tag.PLAYER_BULLET,
+             ENEMY_BULLET: Tag.ENEMY_BULLET}
+TAG_KINDS = {tags: kind for kind, tags in KIND_TAGS.items()}
+
+# Chunk indices. Every entity kind has its own set of chunks
+POSITION, HEALTH, IMAGE, CONTROL = range(4)
+KIND_CHUNKS = {PLAYER: (POSITION, HEALTH, IMAGE, CONTROL),
+               ENEMY: (POSITION, HEALTH, IMAGE, CONTROL),
+               WALL: (POSITION, HEALTH, IMAGE),
+               BULLET: (POSITION,),
+               PLAYER_BULLET: (POSITION,),
+               ENEMY_BULLET: (POSITION,),
+               OTHER: (POSITION,)}
+
+# x, y, vx, vy, x_waited, y_waited, last_move
+_POSITION = struct.Struct('<qqddddbb')
+_HEALTH = struct.Struct('<q')
+# Index in the widget's images
+_IMAGE = struct.Struct('<B')
+# move_cd, shoot_cd, direction index (-1 for None), detour_left, bullet_count
+_ENEMY_CONTROL = struct.Struct('<ddbBI')
+# bullet_count
+_PLAYER_CONTROL = struct.Struct('<I')
+# score, HP, spawn_cd, enemies_current, counter and number of static tiles.
+# The tiles follow as (x, y) pairs of uint16, since chunked maps can be a lot
+# larger than 256 tiles
+_WORLD = struct.Struct('<qqdqqI')
+# Mersenne Twister state, whether there's a gauss_next and gauss_next
+_RANDOM = struct.Struct('<625I?d')
+_RECORD = struct.Struct('<BB')
+_COUNT = struct.Struct('<I')
+
+# {kind: (chunk sizes in chunk index order)}
+_CHUNK_SIZES = {PLAYER: (_POSITION.size, _HEALTH.size, _IMAGE.size,
+                         _PLAYER_CONTROL.size),
+                ENEMY: (_POSITION.size, _HEALTH.size, _IMAGE.size,
+                        _ENEMY_CONTROL.size)}
+for _kind in (WALL, OTHER) + BULLETS:
+    _CHUNK_SIZES[_kind] = (_POSITION.size, _HEALTH.size, _IMAGE.size, 0)
+
+# Same order as in ControllerComponent's direction list
+DIRECTIONS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+
+################################################################################
+# Snapshots and deltas
+################################################################################
+
+
+def _encode(flags, world, rng, removed, entities):
+    parts = [MAGIC, bytes((VERSION, flags))]
+    for block in (world, rng):
+        if block is not None:
+            parts.append(_COUNT.pack(len(block)))
+            parts.append(block)
+    if flags & DELTA:
+        parts.append(_COUNT.pack(len(removed)))
+        for entity_id in removed:
+            encoded = entity_id.encode()
+            parts.append(bytes((len(encoded),)))
+            parts.append(encoded)
+    parts.append(_COUNT.pack(len(entities)))
+    for entity_id, (kind, chunks) in entities.items():
+        encoded = entity_id.encode()
+        mask = 0
+        for index, chunk in enumerate(chunks):
+            if chunk is not None:
+                mask |= 1 << index
+        parts.append(bytes((len(encoded),)))
+        parts.append(encoded)
+        parts.append(_RECORD.pack(kind, mask))
+        parts.extend(x for x in chunks if x is not None)
+    return b''.join(parts)
+
+
+def _decode(data):
+    """
+    :returns: (flags, world, rng, removed, entities)
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a snapshot')
+    version, flags = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError(f'Unsupported snapshot version {version}')
+    offset = len(MAGIC) + 2
+    blocks = []
+    for flag in (HAS_WORLD, HAS_RNG):
+        if flags & flag:
+            length, = _COUNT.unpack_from(data, offset)
+            offset += _COUNT.size
+            blocks.append(data[offset:offset + length])
+            offset += length
+        else:
+            blocks.append(None)
+    removed = []
+    if flags & DELTA:
+        count, = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        for _ in range(count):
+            length = data[offset]
+            removed.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+    count, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    entities = {}
+    for _ in range(count):
+        length = data[offset]
+        entity_id = data[offset + 1:offset + 1 + length].decode()
+        offset += 1 + length
+        kind, mask = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        chunks = [None, None, None, None]
+        for index, size in enumerate(_CHUNK_SIZES[kind]):
+            if mask & (1 << index):
+                chunks[index] = data[offset:offset + size]
+                offset += size
+        entities[entity_id] = (kind, tuple(chunks))
+    return flags, blocks[0], blocks[1], removed, entities
+
+
+class Snapshot:
+    """
+    The state of the game at some moment.
+
+    :param world: world state (score, spawner etc) as bytes
+
+    :param rng: RNG state as bytes, or None if it's not recorded
+
+    :param entities: a dict of ``{entity ID: (kind, chunks)}``, where chunks
+    is a tuple of bytes (or None for the chunks this kind doesn't have), in
+    chunk index order.
+    """
+    def __init__(self, world, rng, entities):
+        self.world = world
+        self.rng = rng
+        self.entities = entities
+
+    def to_bytes(self):
+        flags = HAS_WORLD | (HAS_RNG if self.rng is not None else 0)
+        return _encode(flags, self.world, self.rng, (), self.entities)
+
+    @classmethod
+    def from_bytes(cls, data):
+        flags, world, rng, _, entities = _decode(data)
+        if flags & DELTA:
+            raise ValueError('Expected a snapshot, got a delta')
+        return cls(world, rng, entities)
+
+    def diff(self, newer):
+        """
+        Return a Delta that turns this snapshot into a newer one
+        """
+        old = self.entities
+        changed = {}
+        for entity_id, record in newer.entities.items():
+            previous = old.get(entity_id)
+            if previous == record:
+                continue
+            if previous is None or previous[0] != record[0]:
+                changed[entity_id] = record
+            else:
+                changed[entity_id] = (record[0], tuple(
+                    new if new != was else None
+                    for new, was in zip(record[1], previous[1])))
+        removed = [x for x in old if x not in newer.entities]
+        return Delta(newer.world if newer.world != self.world else None,
+                     newer.rng if newer.rng != self.rng else None,
+                     removed, changed)
+
+    def apply(self, delta):
+        """
+        Return a new Snapshot with the delta applied to this one
+        """
+        entities = dict(self.entities)
+        for entity_id in delta.removed:
+            del entities[entity_id]
+        for entity_id, (kind, chunks) in delta.entities.items():
+            previous = entities.get(entity_id)
+            if previous is None or previous[0] != kind:
+                entities[entity_id] = (kind, chunks)
+            else:
+                entities[entity_id] = (kind, tuple(
+                    new if new is not None else was
+                    for new, was in zip(chunks, previous[1])))
+        return Snapshot(delta.world if delta.world is not None
+                        else self.world,
+                        delta.rng if delta.rng is not None else self.rng,
+                        entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+
+class Delta:
+    """
+    Changes between two snapshots.
+
+    :param world: new world state, or None if it hasn't changed
+
+    :param rng: new RNG state, or None if it hasn't changed
+
+    :param removed: a list of IDs of the entities that are gone
+
+    :param entities: a dict of ``{entity ID: (kind, chunks)}`` for the new
+    and changed entities. Unchanged chunks are None.
+    """
+    def __init__(self, world, rng, removed, entities):
+        self.world = world
+        self.rng = rng
+        self.removed = removed
+        self.entities = entities
+
+    def to_bytes(self):
+        flags = DELTA | (HAS_WORLD if self.world is not None else 0) | \
+                (HAS_RNG if self.rng is not None else 0)
+        return _encode(flags, self.world, self.rng, self.removed,
+                       self.entities)
+
+    @classmethod
+    def from_bytes(cls, data):
+        flags, world, rng, removed, entities = _decode(data)
+        if not flags & DELTA:
+            raise ValueError('Expected a delta, got a snapshot')
+        return cls(world, rng, removed, entities)
+
+
+################################################################################
+# Capturing and restoring
+################################################################################
+
+
+class Snapshotter:
+    """
+    Captures and restores the state of a game built by ``world.build_world``.
+
+    ``restore`` should be called between ticks, not from within an event
+    handler: it processes the events it emits right away, so that the
+    listeners that count destroyed entities can be reset afterwards.
+
+    :param dispatcher: the game's dispatcher
+
+    :param atlas: the Atlas that the world was built with
+
+    :param world: World
+
+    :param rng: if True, the state of the global RNG (and of the batched AI
+    RNG, if any) is captured too, so that the game continues exactly the same
+    way after the restore.
+    """
+    def __init__(self, dispatcher, atlas, world, rng=True):
+        self.dispatcher = dispatcher
+        self.atlas = atlas
+        self.world = world
+        self.rng = rng
+        # {entity ID: kind}
+        self.kinds = {}
+        # {id(images dict): (image names, {name: index})}
+        self.image_names = {}
+        layout = world.layout
+        # A ChunkedLayout is only the size of the screen
+        width, height = getattr(layout, 'map_size',
+                                (len(layout.chars[0]), len(layout.chars)))
+        self.grid_size = (width // TILE_SIZE, height // TILE_SIZE)
+
+    def capture(self):
+        """
+        :returns: Snapshot of the current state
+        """
+        entities = {}
+        for entity_id, entity in EntityTracker().entities.items():
+            try:
+                kind = self.kinds[entity_id]
+            except KeyError:
+                kind = self._kind(entity)
+                self.kinds[entity_id] = kind
+            entities[entity_id] = (kind, self._chunks(entity, kind))
+        return Snapshot(self._world_state(),
+                        self._rng_state() if self.rng else None,
+                        entities)
+
+    @staticmethod
+    def _kind(entity):
+        return TAG_KINDS.get(getattr(entity, 'tags', Tag.NONE), OTHER)
+
+    def _chunks(self, entity, kind):
+        p = entity.position
+        position = _POSITION.pack(p.x, p.y, p.vx, p.vy, p.x_waited,
+                                  p.y_waited, *p.last_move)
+        if kind in BULLETS or kind == OTHER:
+            return position, None, None, None
+        widget = entity.widget.widget
+        names = self.image_names.get(id(widget.images))
+        if names is None:
+            names = (tuple(widget.images),
+                     {x: i for i, x in enumerate(widget.images)})
+            self.image_names[id(widget.images)] = names
+        health = _HEALTH.pack(entity.health.hitpoints)
+        image = _IMAGE.pack(names[1][widget.current_image])
+        if kind == WALL:
+            return position, health, image, None
+        c = entity.controller
+        if kind == PLAYER:
+            control = _PLAYER_CONTROL.pack(c.bullet_count)
+        else:
+            direction = DIRECTIONS.index(c.direction) \
+                if c.direction is not None else -1
+            control = _ENEMY_CONTROL.pack(c.move_cd, c.shoot_cd, direction,
+                                          c.detour_left, c.bullet_count)
+        return position, health, image, control
+
+    def _world_state(self):
+        world = self.world
+        spawner = world.spawner
+        tiles = sorted(world.static_walls.tiles) if world.static_walls else ()
+        return _WORLD.pack(world.score.score, world.hp.hp, spawner.spawn_cd,
+                           spawner.enemies_current, spawner.counter,
+                           len(tiles)) + \
+            struct.pack(f'<{2 * len(tiles)}H',
+                        *(x for tile in tiles for x in tile))
+
+    def _rng_state(self):
+        _, words, gauss = random.getstate()
+        r = _RANDOM.pack(*words, gauss is not None, gauss or 0.0)
+        if self.world.ai_system:
+            r += json.dumps(
+                self.world.ai_system.rng.bit_generator.state).encode()
+        return r
+
+    def restore(self, snapshot):
+        """
+        Bring the game into the state of a snapshot.
+
+        Entities that are not in the snapshot are destroyed, those that are
+        missing are created anew, and everything else is moved, damaged,
+        turned etc as necessary.
+        """
+        world = self.world
+        dispatcher = self.dispatcher
+        # A freshly built world has its entities announced, but not yet in
+        # the EntityTracker. Without this, they would be created once more
+        dispatcher.dispatch_events()
+        score, hp, spawn_cd, enemies_current, counter, tile_count = \
+            _WORLD.unpack_from(snapshot.world)
+        tile_data = struct.unpack_from(f'<{2 * tile_count}H', snapshot.world,
+                                       _WORLD.size)
+        tiles = set(zip(tile_data[::2], tile_data[1::2]))
+        if world.static_walls:
+            # Untouched walls are drawn on the layout rather than created
+            for tile in world.static_walls.tiles - tiles:
+                world.static_walls.remove_tile(*tile)
+            for tile in tiles - world.static_walls.tiles:
+                world.static_walls.add_tile(*tile)
+        tracker = EntityTracker().entities
+        destroyed = [entity for entity_id, entity in tracker.items()
+                     if entity_id not in snapshot.entities]
+        for entity in destroyed:
+            entity.destructor.destroy()
+        for entity_id, (kind, chunks) in snapshot.entities.items():
+            x, y, vx, vy, x_waited, y_waited, *last_move = \
+                _POSITION.unpack(chunks[POSITION])
+            entity = tracker.get(entity_id)
+            if entity is None:
+                entity = self._create(entity_id, kind, x, y, vx, vy)
+            elif entity.position.pos != (x, y):
+                # Moving via 'ecs_move' could collide it into the entities
+                # that haven't moved yet
+                dispatcher.add_event(BearEvent('ecs_remove', entity_id))
+                entity.position.move(x, y, emit_event=False)
+                dispatcher.add_event(BearEvent('ecs_add', (entity_id, x, y)))
+            position = entity.position
+            position.vx = vx
+            position.vy = vy
+            position.x_waited = x_waited
+            position.y_waited = y_waited
+            position.last_move = tuple(last_move)
+            if kind in (PLAYER, ENEMY):
+                entity.collision.settle()
+            if chunks[HEALTH] is not None:
+                hitpoints, = _HEALTH.unpack(chunks[HEALTH])
+                if entity.health.hitpoints != hitpoints:
+                    entity.health.hitpoints = hitpoints
+            if chunks[IMAGE] is not None:
+                widget = entity.widget.widget
+                names = tuple(widget.images)
+                entity.widget.switch_to_image(
+                    names[_IMAGE.unpack(chunks[IMAGE])[0]])
+            if kind == PLAYER:
+                entity.controller.bullet_count, = \
+                    _PLAYER_CONTROL.unpack(chunks[CONTROL])
+            elif kind == ENEMY:
+                c = entity.controller
+                c.move_cd, c.shoot_cd, direction, c.detour_left, \
+                    c.bullet_count = _ENEMY_CONTROL.unpack(chunks[CONTROL])
+                c.direction = DIRECTIONS[direction] if direction >= 0 \
+                    else None
+        dispatcher.add_event(BearEvent('ecs_update', None))
+        dispatcher.dispatch_events()
+        # Pooled bullets would only be back in the pool at the end of the
+        # next tick, so the shots in that tick would take other ones
+        for entity in destroyed:
+            if isinstance(entity.destructor, PooledDestructorComponent):
+                entity.destructor.finish()
+        # Now that the destroyed entities are counted, the counters can be
+        # set right
+        world.score.score = score
+        world.score.changed = True
+        world.hp.hp = hp
+        world.hp.changed = True
+        world.spawner.spawn_cd = spawn_cd
+        world.spawner.enemies_current = enemies_current
+        world.spawner.counter = counter
+        gameover = world.gameover
+        if 'player' in tracker and gameover.terminal and \
+                gameover.widget in gameover.terminal.widget_locations:
+            gameover.terminal.remove_widget(gameover.widget)
+        if world.flow_field or world.line_of_sight:
+            walls = [[0] * self.grid_size[0] for _ in range(self.grid_size[1])]
+            for x, y in tiles:
+                walls[y][x] = 1
+            for entity_id, (kind, chunks) in snapshot.entities.items():
+                if kind == WALL:
+                    x, y = _POSITION.unpack(chunks[POSITION])[:2]
+                    walls[y // TILE_SIZE][x // TILE_SIZE] = 1
+            if world.flow_field:
+                world.flow_field.reset(
+                    walls, tracker['player'].position.pos
+                    if 'player' in tracker else None)
+            if world.line_of_sight:
+                world.line_of_sight.reset(walls)
+        if snapshot.rng is not None:
+            self._restore_rng(snapshot.rng)
+
+    def _create(self, entity_id, kind, x, y, vx, vy):
+        world = self.world
+        dispatcher = self.dispatcher
+        if kind == PLAYER:
+            return create_player_tank(dispatcher, self.atlas, x, y,
+                                      bullet_pool=world.bullet_pool,
+                                      storage=world.storage,
+                                      entity_id=entity_id,
+                                      networked=world.players > 1)
+        elif kind == ENEMY:
+            return create_enemy_tank(
+                dispatcher, self.atlas, entity_id, x, y,
+                ai_system=world.ai_system, bullet_pool=world.bullet_pool,
+                storage=world.storage,
+                controller_params=world.spawner.controller_params)
+        elif kind == WALL:
+            return create_wall(dispatcher, self.atlas, entity_id, x, y,
+                               storage=world.storage)
+        elif kind in BULLETS:
+            if world.bullet_pool:
+                return world.bullet_pool.fire(entity_id.rstrip('0123456789'),
+                                              x, y, vx, vy,
+                                              bullet_id=entity_id,
+                                              tags=KIND_TAGS[kind])
+            return create_bullet(dispatcher, entity_id, x, y, vx, vy,
+                                 storage=world.storage, tags=KIND_TAGS[kind])
+        elif entity_id == 'house':
+            return create_spawner_house(dispatcher, self.atlas, x, y,
+                                        storage=world.storage)
+        raise BearECSException(f'Cannot restore entity {entity_id}')
+
+    def _restore_rng(self, data):
+        state = _RANDOM.unpack_from(data)
+        random.setstate((3, state[:625], state[626] if state[625] else None))
+        if self.world.ai_system and len(data) > _RANDOM.size:
+            self.world.ai_system.rng.bit_generator.state = \
+                json.loads(data[_RANDOM.size:])
+
+    def save(self, path):
+        """
+        Write a snapshot of the current state into a file
+        """
+        with open(path, 'wb') as f:
+            f.write(self.capture().to_bytes())
+
+    def load(self, path):
+        """
+        Restore the state saved by ``save``
+        """
+        with open(path, 'rb') as f:
+            self.restore(Snapshot.from_bytes(f.read()))
+
+
+class History(Listener):
+    """
+    Records the game state every tick, so that it can be rewound.
+
+    Should be subscribed to 'service', after every other listener. Every
+    ``keyframe_interval`` ticks a full snapshot is stored, and deltas in
+    between, all of them encoded. At most ``length`` ticks (rounded up to a
+    whole number of keyframes) are kept.
+
+    :param snapshotter: Snapshotter
+
+    :param length: ticks to keep
+
+    :param keyframe_interval: ticks between full snapshots
+    """
+    def __init__(self, snapshotter, length=300, keyframe_interval=30,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.snapshotter = snapshotter
+        self.length = length
+        self.keyframe_interval = keyframe_interval
+        # A deque of [keyframe bytes, [delta bytes]]
+        self.groups = deque()
+        self.latest = None
+        self.bytes = 0
+
+    def __len__(self):
+        return sum(1 + len(deltas) for _, deltas in self.groups)
+
+    def on_event(self, event):
+        if event.event_type == 'service' and event.event_value == 'tick_over':
+            self.record()
+
+    def record(self):
+        """
+        Store the current state
+        """
+        snapshot = self.snapshotter.capture()
+        if not self.groups or \
+                len(self.groups[-1][1]) + 1 >= self.keyframe_interval:
+            data = snapshot.to_bytes()
+            self.groups.append([data, []])
+        else:
+            data = self.latest.diff(snapshot).to_bytes()
+            self.groups[-1][1].append(data)
+        self.bytes += len(data)
+        self.latest = snapshot
+        while len(self) - len(self.groups[0][1]) - 1 >= self.length:
+            keyframe, deltas = self.groups.popleft()
+            self.bytes -= len(keyframe) + sum(len(x) for x in deltas)
+
+    def get(self, ticks_ago):
+        """
+        :returns: the Snapshot that was recorded a given number of ticks ago,
+        0 being the latest one.
+        """
+        index = len(self) - 1 - ticks_ago
+        if not 0 <= index < len(self):
+            raise IndexError(f'{ticks_ago} ticks are not in the history')
+        for keyframe, deltas in self.groups:
+            if index <= len(deltas):
+                snapshot = Snapshot.from_bytes(keyframe)
+                for data in deltas[:index]:
+                    snapshot = snapshot.apply(Delta.from_bytes(data))
+                return snapshot
+            index -= len(deltas) + 1
+
+    def rewind(self, ticks):
+        """
+        Restore the state from a given number of ticks ago. Everything
+        recorded after it is forgotten.
+        """
+        snapshot = self.get(ticks)
+        self.snapshotter.restore(snapshot)
+        # Dropping the future
+        for _ in range(ticks):
+            keyframe, deltas = self.groups[-1]
+            if deltas:
+                self.bytes -= len(deltas.pop())
+            else:
+                self.bytes -= len(keyframe)
+                self.groups.pop()
+        self.latest = snapshot
@@ -0,0 +1,226 @@
+"""
+Spatial index for collision detection.
+
+ECSLayout detects collisions by collecting every widget under the moved
+entity and then scanning all entities to find which of them own those
+widgets, so every move costs O(all entities). GridECSLayout keeps entity
+rectangles in a uniform grid instead, so a single move only looks at the
+entities in the grid cells it covers.
+"""
+
+from bear_hug.ecs_widgets import ECSLayout
+from bear_hug.event import BearEvent
+
+
+class SpatialHash:
+    """
+    A uniform grid of rectangles.
+
+    Every item is stored with its rectangle, and is listed in every cell that
+    the rectangle touches. Items can be anything hashable; ECS layouts use
+    entity IDs.
+
+    :param cell_size: size of a (square) grid cell, in chars. Defaults to 6,
+    which is the size of a map tile.
+    """
+    def __init__(self, cell_size=6):
+        self.cell_size = cell_size
+        # {(cell_x, cell_y): set of items}
+        self.cells = {}
+        # {item: (x, y, width, height)}
+        self.rects = {}
+
+    def _cells(self, x, y, width, height):
+        size = self.cell_size
+        for cell_y in range(y // size, (y + height - 1) // size + 1):
+            for cell_x in range(x // size, (x + width - 1) // size + 1):
+                yield cell_x, cell_y
+
+    def insert(self, item, x, y, width, height):
+        """
+        Add an item with a given rectangle.
+
+        If the item is already in the index, it is moved instead.
+        """
+        if item in self.rects:
+            self.remove(item)
+        self.rects[item] = (x, y, width, height)
+        for cell in self._cells(x, y, width, height):
+            try:
+                self.cells[cell].add(item)
+            except KeyError:
+                self.cells[cell] = {item}
+
+    def remove(self, item):
+        """
+        Remove an item. Does nothing if it is not in the index.
+        """
+        rect = self.rects.pop(item, None)
+        if rect is None:
+            return
+        for cell in self._cells(*rect):
+            items = self.cells[cell]
+            items.discard(item)
+            if not items:
+                del self.cells[cell]
+
+    def move(self, item, x, y, width, height):
+        """
+        Update item rectangle.
+
+        Cell lists are only touched if the item has moved to a different set of
+        cells, which is not the case for most one-char moves.
+        """
+        old = self.rects.get(item)
+        if old is not None and old[2:] == (width, height) \
+                and old[0] // self.cell_size == x // self.cell_size \
+                and old[1] // self.cell_size == y // self.cell_size \
+                and (old[0] + width - 1) // self.cell_size == \
+                (x + width - 1) // self.cell_size \
+                and (old[1] + height - 1) // self.cell_size == \
+                (y + height - 1) // self.cell_size:
+            self.rects[item] = (x, y, width, height)
+        else:
+            self.insert(item, x, y, width, height)
+
+    def query(self, x, y, width, height):
+        """
+        Return a set of all items whose rectangles overlap a given one.
+        """
+        r = set()
+        for cell in self._cells(x, y, width, height):
+            if cell not in self.cells:
+                continue
+            for item in self.cells[cell]:
+                if item in r:
+                    continue
+                other_x, other_y, other_width, other_height = self.rects[item]
+                if x <= other_x + other_width - 1 and \
+                        other_x <= x + width - 1 and \
+                        y <= other_y + other_height - 1 and \
+                        other_y <= y + height - 1:
+                    r.add(item)
+        return r
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __contains__(self, item):
+        return item in self.rects
+
+
+class GridECSLayout(ECSLayout):
+    """
+    An ECSLayout that uses SpatialHash for collision detection.
+
+    Emits exactly the same 'ecs_collision' events as ECSLayout. The only
+    difference is that collisions of a single move are emitted in the order
+    the colliding entities were created, rather than in arbitrary set order.
+
+    The index contains every entity whose widget is currently shown, and is
+    kept up to date by 'ecs_add', 'ecs_move', 'ecs_remove' and 'ecs_destroy'.
+    It is available as ``layout.index`` for anyone who needs to know what is
+    near a given point.
+
+    If ``static_layer`` (a level.StaticWallLayer) is set, every move also
+    materializes the static walls under the moved entity. These are put into
+    the index immediately, so that anything else that moves into them before
+    their 'ecs_add' is processed collides with them too. Collisions with the
+    freshly materialized walls are emitted after all others.
+
+    An entity added outside the layout is not shown, and collides into the
+    edge instead.
+
+    :param cell_size: index cell size. Defaults to the 6x6 map tile.
+    """
+    def __init__(self, chars, colors, cell_size=6):
+        super().__init__(chars, colors)
+        self.index = SpatialHash(cell_size=cell_size)
+        self.static_layer = None
+        # Creation order, to keep collision events in a reproducible order
+        self._entity_order = {}
+        self._entity_counter = 0
+
+    def _remember_order(self, entity_id):
+        if entity_id not in self._entity_order:
+            self._entity_order[entity_id] = self._entity_counter
+            self._entity_counter += 1
+
+    def add_entity(self, entity):
+        super().add_entity(entity)
+        self._remember_order(entity.id)
+
+    def remove_entity(self, entity_id):
+        if self.widgets[entity_id] in self.child_locations:
+            super().remove_entity(entity_id)
+        else:
+            # Never made it onto the map, see 'ecs_add' below
+            del self.entities[entity_id]
+        self.index.remove(entity_id)
+        del self._entity_order[entity_id]
+
+    def _outside(self, x, y, width, height):
+        return x < 0 or x + width > len(self.chars[0]) or y < 0 or \
+            y + height > len(self.chars)
+
+    def mark_dirty(self, x, y, width, height):
+        """
+        Tell the layout that a part of the map has changed.
+
+        This one simply redraws everything at 'tick_over'; DirtyRectLayout
+        redraws only the given rectangle.
+        """
+        self.need_redraw = True
+
+    def redraw_child(self, child):
+        """
+        Tell the layout that a child widget has changed its chars or colors
+        """
+        self.need_redraw = True
+
+    def background_changed(self, x, y, width, height):
+        """
+        Tell the layout that a part of the background has been drawn on.
+
+        Same as ``mark_dirty`` here; buffers.ArrayLayout also has to re-read
+        the background lists.
+        """
+        self.mark_dirty(x, y, width, height)
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_move':
+            entity_id, x, y = event.event_value
+            width, height = self.entities[entity_id].widget.size
+            if self._outside(x, y, width, height):
+                return [BearEvent(event_type='ecs_collision',
+                                  event_value=(entity_id, None))]
+            self.move_child(self.widgets[entity_id], (x, y))
+            self.need_redraw = True
+            self.index.move(entity_id, x, y, width, height)
+            collided = self.index.query(x, y, width, height)
+            collided.discard(entity_id)
+            r = [BearEvent('ecs_collision', (entity_id, other))
+                 for other in sorted(collided,
+                                     key=self._entity_order.__getitem__)]
+            if self.static_layer:
+                for other, rect in self.static_layer.materialize(x, y, width,
+                                                                 height):
+                    self.index.insert(other, *rect)
+                    self._remember_order(other)
+                    r.append(BearEvent('ecs_collision', (entity_id, other)))
+            return r
+        if event.event_type == 'ecs_add':
+            # Eg a bullet fired point-blank into the map edge. It is not
+            # shown, but collides into the edge, just as if it had moved there
+            entity_id, x, y = event.event_value
+            if self._outside(x, y, *self.entities[entity_id].widget.size):
+                return [BearEvent(event_type='ecs_collision',
+                                  event_value=(entity_id, None))]
+        r = super().on_event(event)
+        if event.event_type == 'ecs_add':
+            entity_id, x, y = event.event_value
+            self.index.insert(entity_id, x, y,
+                              *self.entities[entity_id].widget.size)
+        elif event.event_type == 'ecs_remove':
+            self.index.remove(event.event_value)
+        return r
@@ -0,0 +1,301 @@
+"""
+Compact component storage.
+
+PositionComponent and HealthComponent keep their state in instance dicts,
+which is about a dozen boxed numbers and dict entries per entity. With
+CompactStorage, positions, velocities and hitpoints of all entities live in
+typed arrays (one array per field, one slot per component), and the
+components are thin views into them.
+
+The arrays support the buffer protocol, so a system can process them in bulk
+(eg via ``numpy.frombuffer``) instead of going through the components. Arrays
+are grown in place, but growing may move their memory, so such views should
+not be kept between ticks.
+
+It is opt-in: ``build_world(compact_storage=True)``.
+"""
+
+from array import array
+
+from bear_hug.bear_utilities import BearECSException
+from bear_hug.ecs import PositionComponent, DestructorComponent
+
+from json import dumps, loads
+
+
+class ArrayTable:
+    """
+    A set of same-length typed arrays with slot allocation.
+
+    Every field is available as an attribute, eg ``table.x[slot]``. Freshly
+    allocated slots are zeroed.
+
+    :param fields: a dict of ``{field name: array typecode}``
+
+    :param capacity: initial number of slots. Doubles when necessary.
+    """
+    def __init__(self, fields, capacity=64):
+        self.fields = dict(fields)
+        self.capacity = capacity
+        for name, typecode in self.fields.items():
+            setattr(self, name, array(typecode, [0]) * capacity)
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def allocate(self):
+        """
+        Reserve a slot and return its index
+        """
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        for name in self.fields:
+            getattr(self, name)[slot] = 0
+        return slot
+
+    def release(self, slot):
+        self.free.append(slot)
+
+    def reserve(self, count):
+        """
+        Grow the arrays so that at least ``count`` more slots are available
+        without reallocation
+        """
+        while len(self.free) < count:
+            self._grow()
+
+    def _grow(self):
+        old = self.capacity
+        for name, typecode in self.fields.items():
+            getattr(self, name).extend(array(typecode, [0]) * old)
+        self.capacity = old * 2
+        self.free = list(range(self.capacity - 1, old - 1, -1)) + self.free
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    @property
+    def slot_size(self):
+        """
+        Bytes per slot, summed over all arrays
+        """
+        return sum(getattr(self, x).itemsize for x in self.fields)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays themselves
+        """
+        return self.slot_size * self.capacity
+
+
+class CompactStorage:
+    """
+    Typed arrays for position and health components of a single game.
+
+    Slots are released by CompactDestructorComponent when it removes the
+    components, or by calling their ``release_slot``.
+    """
+    def __init__(self, capacity=64):
+        self.positions = ArrayTable({'x': 'q', 'y': 'q',
+                                     'vx': 'd', 'vy': 'd',
+                                     'x_waited': 'd', 'y_waited': 'd'},
+                                    capacity=capacity)
+        self.health = ArrayTable({'hitpoints': 'q'}, capacity=capacity)
+
+
+def _array_property(name):
+    """
+    A property that reads and writes ``self.table.<name>[self.slot]``
+    """
+    def fget(self):
+        return getattr(self.table, name)[self.slot]
+
+    def fset(self, value):
+        getattr(self.table, name)[self.slot] = value
+    return property(fget, fset)
+
+
+class CompactSlotMixin:
+    """
+    The part of a compact component that owns a slot in an ArrayTable
+    """
+    def allocate_slot(self, table):
+        self.table = table
+        self.slot = table.allocate()
+
+    def release_slot(self):
+        """
+        Give the slot back to the table. The component is unusable afterwards
+        """
+        if self.slot is not None:
+            self.table.release(self.slot)
+            self.slot = None
+
+
+class CompactPositionComponent(CompactSlotMixin, PositionComponent):
+    """
+    A PositionComponent whose coordinates, velocity and movement timers are
+    stored in CompactStorage.
+
+    Behaves like PositionComponent, except that it only subscribes to 'tick'
+    once it has a non-zero velocity, so that the walls and the tanks (which are
+    moved by their controllers) don't get a useless call every tick. Movement
+    delays are computed from the velocity instead of being stored. Serializes
+    as PositionComponent.
+
+    :param storage: CompactStorage
+    """
+    def __init__(self, dispatcher, *args, storage, **kwargs):
+        # Slot should exist before PositionComponent.__init__ sets the values
+        self.allocate_slot(storage.positions)
+        self.ticking = False
+        try:
+            # Without the dispatcher, PositionComponent doesn't subscribe to
+            # tick
+            super().__init__(None, *args, **kwargs)
+        except Exception:
+            self.release_slot()
+            raise
+        self.dispatcher = dispatcher
+        if self.vx or self.vy:
+            self.start_ticking()
+
+    def start_ticking(self):
+        if self.dispatcher and not self.ticking:
+            self.dispatcher.register_listener(self, 'tick')
+            self.ticking = True
+
+    _x = _array_property('x')
+    _y = _array_property('y')
+    x_waited = _array_property('x_waited')
+    y_waited = _array_property('y_waited')
+
+    @property
+    def vx(self):
+        return self.table.vx[self.slot]
+
+    @vx.setter
+    def vx(self, value):
+        self.table.vx[self.slot] = value
+        if value:
+            self.start_ticking()
+
+    @property
+    def vy(self):
+        return self.table.vy[self.slot]
+
+    @vy.setter
+    def vy(self, value):
+        self.table.vy[self.slot] = value
+        if value:
+            self.start_ticking()
+
+    @property
+    def x_delay(self):
+        vx = self.table.vx[self.slot]
+        return abs(1 / vx) if vx else None
+
+    @x_delay.setter
+    def x_delay(self, value):
+        # Always consistent with velocity, which is what vx setter sets it to
+        pass
+
+    @property
+    def y_delay(self):
+        vy = self.table.vy[self.slot]
+        return abs(1 / vy) if vy else None
+
+    @y_delay.setter
+    def y_delay(self, value):
+        pass
+
+    def on_event(self, event):
+        # Same as PositionComponent.on_event, but works with the arrays
+        # directly instead of going through half a dozen properties
+        if event.event_type == 'tick':
+            table = self.table
+            slot = self.slot
+            vx = table.vx[slot]
+            vy = table.vy[slot]
+            if vx or vy:
+                x_waited = table.x_waited[slot] + event.event_value
+                y_waited = table.y_waited[slot] + event.event_value
+                x = new_x = table.x[slot]
+                y = new_y = table.y[slot]
+                if vx and x_waited > abs(1 / vx):
+                    steps = round(x_waited / abs(1 / vx))
+                    new_x = x + steps if vx > 0 else x - steps
+                    x_waited = 0
+                if vy and y_waited > abs(1 / vy):
+                    steps = round(y_waited / abs(1 / vy))
+                    new_y = y + steps if vy > 0 else y - steps
+                    y_waited = 0
+                table.x_waited[slot] = x_waited
+                table.y_waited[slot] = y_waited
+                if x != new_x or y != new_y:
+                    self.move(new_x, new_y)
+
+    def __repr__(self):
+        d = loads(super().__repr__())
+        d['class'] = 'PositionComponent'
+        return dumps(d)
+
+
+class CompactHealthMixin(CompactSlotMixin):
+    """
+    Stores HealthComponent hitpoints in CompactStorage.
+
+    Should be mixed in before a HealthComponent subclass. The hitpoint type
+    check is done by the array itself, so setting hitpoints doesn't run
+    ``isinstance``. Serializes as the HealthComponent subclass it is mixed
+    into.
+
+    :param storage: CompactStorage
+    """
+    def __init__(self, *args, storage, **kwargs):
+        self.allocate_slot(storage.health)
+        try:
+            super().__init__(*args, **kwargs)
+        except Exception:
+            self.release_slot()
+            raise
+
+    _hitpoints = _array_property('hitpoints')
+
+    @property
+    def hitpoints(self):
+        return self.table.hitpoints[self.slot]
+
+    @hitpoints.setter
+    def hitpoints(self, value):
+        try:
+            self.table.hitpoints[self.slot] = value if value > 0 else 0
+        except TypeError:
+            raise BearECSException(
+                f'Attempting to set hitpoints of {self.owner.id} to non-integer {value}')
+        self.process_hitpoint_update()
+
+    def __repr__(self):
+        d = loads(super().__repr__())
+        # The first non-compact class in MRO
+        d['class'] = next(x.__name__ for x in type(self).__mro__[1:]
+                          if not issubclass(x, CompactSlotMixin))
+        return dumps(d)
+
+
+class CompactDestructorComponent(DestructorComponent):
+    """
+    A DestructorComponent that releases the slots of the compact components
+    when it removes them at the end of the tick.
+    """
+    def on_event(self, event):
+        if self.is_destroying and event.event_type == 'service' \
+                and event.event_value == 'tick_over':
+            owner = self.owner
+            components = [owner.__dict__[x] for x in owner.components]
+            super().on_event(event)
+            for component in components:
+                if isinstance(component, CompactSlotMixin):
+                    component.release_slot()
+        else:
+            super().on_event(event)
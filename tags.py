@@ -0,0 +1,145 @@
+"""
+Entity tags and indices.
+
+Game logic used to tell entities apart by their IDs (an enemy tank is an
+entity with 'enemy', but not 'bullet', in its ID) and by their components
+(``hasattr(EntityTracker().entities[entity_id], 'collision')``). Instead,
+every entity created by entities.py gets a ``tags`` attribute, and
+EntityIndex keeps a set of IDs per tag and per component name, so that "all
+enemies" or "does it collide" is a single set lookup.
+"""
+
+from bear_hug.ecs import Singleton
+from bear_hug.widgets import Listener
+
+from enum import Flag
+
+
+class Tag(Flag):
+    """
+    Entity tags.
+
+    PLAYER and ENEMY are sides: the player's tank and bullets are both
+    PLAYER, enemy tanks and bullets are ENEMY. Combinations, like ENEMY_TANK,
+    match only the entities that have all of their tags.
+    """
+    NONE = 0
+    PLAYER = 1
+    ENEMY = 2
+    TANK = 4
+    BULLET = 8
+    WALL = 16
+    HOUSE = 32
+    PLAYER_TANK = PLAYER | TANK
+    ENEMY_TANK = ENEMY | TANK
+    PLAYER_BULLET = PLAYER | BULLET
+    ENEMY_BULLET = ENEMY | BULLET
+
+
+# Every tag and combination above gets a set in the index. Values are used
+# instead of Tags themselves, because Flag operators are slow
+INDEXED_VALUES = tuple(x._value_ for x in Tag.__members__.values()
+                       if x._value_)
+
+
+class EntityIndex(Listener, metaclass=Singleton):
+    """
+    A singleton index of entities by tag and by component name.
+
+    Should be subscribed to 'ecs_create', 'ecs_destroy' and 'service', before
+    any listener that uses it for 'ecs_create'. Tags are taken from the
+    entity's ``tags`` attribute (entities without one get Tag.NONE), and
+    components from ``entity.components``, when the entity is created.
+
+    Tags are kept as their integer values, since even ``tag & other`` on a
+    Flag is several times slower than a set lookup. Destroyed entities are
+    dropped from the sets right away, like they are from EntityTracker. Their
+    tags, though, are still known to ``tags_of`` and ``is_a`` until the end
+    of the tick, so that other 'ecs_destroy' listeners can check what was
+    destroyed.
+
+    The sets returned by ``tagged`` and ``with_component`` are the index's
+    own and should not be modified.
+    """
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def clear(self):
+        """
+        Forget everything, eg when a new game is started
+        """
+        # {entity ID: Tag value}
+        self.tags = {}
+        # {Tag value: set of entity IDs}
+        self.tag_sets = {value: set() for value in INDEXED_VALUES}
+        # {component name: set of entity IDs}
+        self.component_sets = {}
+        # IDs destroyed during the current tick
+        self.destroyed = set()
+
+    def on_event(self, event):
+        if event.event_type == 'ecs_create':
+            entity = event.event_value
+            entity_id = entity.id
+            tags = getattr(entity, 'tags', Tag.NONE)._value_
+            self.tags[entity_id] = tags
+            self.destroyed.discard(entity_id)
+            for value in INDEXED_VALUES:
+                if tags & value == value:
+                    self.tag_sets[value].add(entity_id)
+            for name in entity.components:
+                self.component_sets.setdefault(name, set()).add(entity_id)
+        elif event.event_type == 'ecs_destroy':
+            entity_id = event.event_value
+            for ids in self.tag_sets.values():
+                ids.discard(entity_id)
+            for ids in self.component_sets.values():
+                ids.discard(entity_id)
+            self.destroyed.add(entity_id)
+        elif event.event_type == 'service' and \
+                event.event_value == 'tick_over' and self.destroyed:
+            for entity_id in self.destroyed:
+                del self.tags[entity_id]
+            self.destroyed = set()
+
+    def tags_of(self, entity_id):
+        """
+        :returns: Tag of an entity, or Tag.NONE if it's unknown
+        """
+        return Tag(self.tags.get(entity_id, 0))
+
+    def is_a(self, entity_id, tag):
+        """
+        Check whether an entity has all the given tags
+        """
+        value = tag._value_
+        return self.tags.get(entity_id, 0) & value == value
+
+    def tagged(self, tag):
+        """
+        :returns: a set of IDs of the existing entities that have all the
+        given tags.
+        """
+        value = tag._value_
+        try:
+            return self.tag_sets[value]
+        except KeyError:
+            # Some combination that isn't in Tag
+            return {entity_id for entity_id in self.tags
+                    if entity_id not in self.destroyed and
+                    self.tags[entity_id] & value == value}
+
+    def has_component(self, entity_id, name):
+        """
+        Check whether an existing entity has a component with a given name
+        """
+        ids = self.component_sets.get(name)
+        return ids is not None and entity_id in ids
+
+    def with_component(self, name):
+        """
+        :returns: a set of IDs of the existing entities that have a component
+        with a given name.
+        """
+        return self.component_sets.get(name, set())
@@ -0,0 +1,84 @@
+"""
+Checks for ChunkManager.
+
+Run with ``python -m pytest test_chunks.py``.
+"""
+
+from bear_hug.ecs import EntityTracker
+
+from entities import create_enemy_tank
+from headless import HeadlessGame
+from level import TILE_SIZE
+
+
+def free_tile(tiles, x, y):
+    """
+    The first tile from (x, y) onwards with no walls around it
+    """
+    for dx in range(20):
+        for dy in range(20):
+            around = {(x + dx + i, y + dy + j)
+                      for i in (-1, 0, 1) for j in (-1, 0, 1)}
+            if not around & tiles:
+                return x + dx, y + dy
+
+
+def subscribed(game, entity):
+    """
+    Names of the entity's components subscribed to 'tick' or 'service'
+    """
+    components = {id(entity.__dict__[x]): x for x in entity.components}
+    return {components[id(listener)]
+            for event_type in ('tick', 'service')
+            for listener in game.dispatcher.listeners[event_type]
+            if id(listener) in components}
+
+
+def state(entity):
+    return (entity.position.pos, entity.position.vx, entity.position.vy,
+            entity.health.hitpoints, entity.controller.direction)
+
+
+def test_sleep_and_wake():
+    game = HeadlessGame(seed=1, chunked=True, map_size=(60, 60),
+                        chunk_size=4, enemies=0)
+    game.run(ticks=1)
+    chunks = game.world.chunks
+    entities = EntityTracker().entities
+    # One tank next to the player and another one in the far corner, which
+    # is asleep from the start
+    x, y = entities['player'].position.pos
+    create_enemy_tank(game.dispatcher, game.atlas, 'near', x,
+                      y - 5 * TILE_SIZE)
+    far_x, far_y = free_tile(game.world.static_walls.tiles, 2, 2)
+    create_enemy_tank(game.dispatcher, game.atlas, 'far', far_x * TILE_SIZE,
+                      far_y * TILE_SIZE)
+    game.run(ticks=1)
+    near, far = entities['near'], entities['far']
+    assert 'far' in chunks.asleep and 'near' not in chunks.asleep
+    assert subscribed(game, far) == set()
+    awake_subscriptions = subscribed(game, near)
+    assert awake_subscriptions
+    far_pos = far.position.pos
+    game.run(ticks=30)
+    assert far.position.pos == far_pos
+
+    # The active area follows the far tank, so the near one's chunk unloads
+    # at the end of the tick
+    chunks.focus = 'far'
+    game.run(ticks=1)
+    assert 'near' in chunks.asleep and 'far' not in chunks.asleep
+    assert subscribed(game, near) == set()
+    asleep = state(near)
+    game.run(ticks=60)
+    assert far.position.pos != far_pos
+    assert state(near) == asleep
+
+    chunks.focus = 'player'
+    game.run(ticks=1)
+    assert 'near' not in chunks.asleep
+    assert subscribed(game, near) == awake_subscriptions
+    assert state(near) == asleep
+    game.run(ticks=60)
+    assert near.position.pos != asleep[0]
+    assert chunks.sleeps >= 2 and chunks.wakeups >= 1
@@ -0,0 +1,81 @@
+"""
+Regression checks for TankCollisionComponent.
+
+Run with ``python -m pytest test_collisions.py``.
+"""
+
+import pytest
+
+from bear_hug.ecs import EntityTracker
+
+from headless import HeadlessGame
+from level import TILE_SIZE
+from tags import Tag, EntityIndex
+
+
+def overlaps(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and \
+        a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+# Two keys held down make the player move twice per tick
+@pytest.mark.parametrize('keys', [['TK_W', 'TK_A'], ['TK_A', 'TK_W'],
+                                  ['TK_S', 'TK_D'], ['TK_D', 'TK_S']])
+def test_two_keys_stay_on_map(keys):
+    game = HeadlessGame(seed=1, enemies=0, input_script=lambda tick: keys)
+    game.run(ticks=120)
+    entities = EntityTracker().entities
+    player = entities['player']
+    layout = game.world.layout
+    width, height = player.widget.widget.size
+    rect = (player.position.x, player.position.y, width, height)
+    assert 0 <= rect[0] <= len(layout.chars[0]) - width
+    assert 0 <= rect[1] <= len(layout.chars) - height
+    # Where the player is drawn
+    assert layout.child_locations[player.widget.widget] == player.position.pos
+    for entity_id, entity in entities.items():
+        if entity_id != 'player' and 'passability' in entity.__dict__:
+            assert not overlaps(rect, (entity.position.x, entity.position.y,
+                                       *entity.widget.widget.size))
+    if game.world.static_walls:
+        for x, y in game.world.static_walls.tiles:
+            assert not overlaps(rect, (x * TILE_SIZE, y * TILE_SIZE,
+                                       TILE_SIZE, TILE_SIZE))
+
+
+def player_clear(game, width, height):
+    """
+    Assert that the player's tank is on the map and overlaps no walls and no
+    other tanks
+    """
+    entities = EntityTracker().entities
+    player = entities['player']
+    rect = (player.position.x, player.position.y,
+            *player.widget.widget.size)
+    assert 0 <= rect[0] <= width - rect[2]
+    assert 0 <= rect[1] <= height - rect[3]
+    for entity_id in EntityIndex().tagged(Tag.TANK):
+        entity = entities[entity_id]
+        if entity_id != 'player':
+            assert not overlaps(rect, (entity.position.x, entity.position.y,
+                                       *entity.widget.widget.size))
+    for x, y in game.world.static_walls.tiles:
+        assert not overlaps(rect, (x * TILE_SIZE, y * TILE_SIZE,
+                                   TILE_SIZE, TILE_SIZE))
+
+
+# Tanks running into each other used to be bounced back and forth forever,
+# hanging the game, and a tank put back where it was could land on another
+# one that had just taken its place
+@pytest.mark.parametrize('seed', range(1, 11))
+def test_crowded_game(seed):
+    def keys(tick):
+        return ['TK_W', 'TK_A'] if tick % 80 < 40 else ['TK_D', 'TK_S']
+    game = HeadlessGame(seed=seed, enemies=12, input_script=keys)
+    layout = game.world.layout
+    for _ in range(60):
+        game.run(ticks=10)
+        if 'player' not in EntityTracker().entities:
+            # Shot dead
+            break
+        player_clear(game, len(layout.chars[0]), len(layout.chars))
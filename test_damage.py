@@ -0,0 +1,60 @@
+"""
+Checks for DamageSystem.
+
+Run with ``python -m pytest test_damage.py``.
+"""
+
+from bear_hug.ecs import EntityTracker
+from bear_hug.event import BearEvent
+
+from entities import create_enemy_tank
+from headless import HeadlessGame
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, event):
+        self.events.append((event.event_type, event.event_value))
+
+
+def test_hits_applied_once():
+    game = HeadlessGame(seed=1, enemies=0, batched_damage=True)
+    game.run(ticks=1)
+    entities = EntityTracker().entities
+    x, y = entities['player'].position.pos
+    create_enemy_tank(game.dispatcher, game.atlas, 'enemy', x, y - 30)
+    game.run(ticks=1)
+    enemy, player = entities['enemy'], entities['player']
+    enemy.health.hitpoints = 5
+    player_hp = player.health.hitpoints
+    recorder = Recorder()
+    game.dispatcher.register_listener(recorder, ['ac_damage_resolved',
+                                                 'ecs_destroy'])
+    system = game.world.damage_system
+    hits, passes = system.hits, system.passes
+    for entity_id, damage in (('enemy', 1), ('player', 1), ('enemy', 2),
+                              ('nobody', 1), ('enemy', 1)):
+        game.dispatcher.add_event(BearEvent('ac_damage', (entity_id, damage)))
+    game.run(ticks=1)
+    assert enemy.health.hitpoints == 1
+    assert player.health.hitpoints == player_hp - 1
+    assert (system.hits - hits, system.passes - passes) == (5, 1)
+    assert recorder.events == [('ac_damage_resolved',
+                                ({'enemy': 4, 'player': 1}, []))]
+
+    # Enough to destroy it: 'ecs_destroy' comes first
+    recorder.events = []
+    game.dispatcher.add_event(BearEvent('ac_damage', ('enemy', 1)))
+    game.dispatcher.add_event(BearEvent('ac_damage', ('enemy', 1)))
+    game.run(ticks=1)
+    assert recorder.events == [('ecs_destroy', 'enemy'),
+                               ('ac_damage_resolved',
+                                ({'enemy': 2}, ['enemy']))]
+    assert 'enemy' not in entities
+    # Hits on a destroyed entity are ignored
+    recorder.events = []
+    game.dispatcher.add_event(BearEvent('ac_damage', ('enemy', 1)))
+    game.run(ticks=1)
+    assert recorder.events == []
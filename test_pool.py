@@ -0,0 +1,47 @@
+"""
+Checks for BulletPool.
+
+Run with ``python -m pytest test_pool.py``.
+"""
+
+from bear_hug.ecs import EntityTracker
+
+from headless import HeadlessGame
+from tags import Tag
+
+
+def test_destroyed_bullet_is_reused():
+    game = HeadlessGame(seed=1, enemies=0)
+    pool = game.world.bullet_pool
+    game.run(ticks=1)
+    bullet = pool.fire('test_', 10, 10, 20, 0)
+    game.run(ticks=3)
+    assert bullet.position.x > 10
+    bullet.destructor.destroy()
+    game.run(ticks=1)
+    assert bullet.id not in EntityTracker().entities
+    assert pool.available == 1
+    again = pool.fire('test_', 30, 12, 0, 20, tags=Tag.ENEMY_BULLET)
+    assert again is bullet
+    assert (pool.hits, pool.misses, pool.size) == (1, 1, 1)
+    assert pool.available == 0
+    # Fresh state: the new place, velocity and tags, and nothing left over
+    # from the first shot
+    assert (again.position.x, again.position.y) == (30, 12)
+    assert (again.position.vx, again.position.vy) == (0, 20)
+    assert again.tags == Tag.ENEMY_BULLET
+    assert not again.destructor.is_destroying
+    game.run(ticks=3)
+    assert EntityTracker().entities[again.id] is again
+    assert again.position.x == 30 and again.position.y > 12
+
+
+def test_new_bullet_when_none_is_free():
+    game = HeadlessGame(seed=1, enemies=0)
+    pool = game.world.bullet_pool
+    game.run(ticks=1)
+    first = pool.fire('test_', 10, 10, 20, 0)
+    second = pool.fire('test_', 10, 12, 20, 0)
+    assert first is not second
+    assert (first.id, second.id) == ('test_0', 'test_1')
+    assert (pool.hits, pool.misses) == (0, 2)
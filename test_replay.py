@@ -0,0 +1,74 @@
+"""
+Checks for input recording and replay.
+
+Run with ``python -m pytest test_replay.py``.
+"""
+
+import pytest
+
+from headless import HeadlessGame
+from replay import LogWriter, RecordingLoop, DesyncError, read_log, replay, \
+    state_hash, HASH_SIZE
+
+
+SEED = 3
+TICKS = 200
+WORLD_KWARGS = {'enemies': 4}
+
+
+def keys(tick):
+    if tick % 50 < 20:
+        return ['TK_W', 'TK_SPACE']
+    elif tick % 50 < 35:
+        return ['TK_D']
+    return ['TK_S', 'TK_A']
+
+
+def record(path, ticks=TICKS):
+    game = HeadlessGame(seed=SEED, input_script=keys, **WORLD_KWARGS)
+    writer = LogWriter(str(path), SEED, fps=30, world_kwargs=WORLD_KWARGS)
+    loop = RecordingLoop(game.terminal, game.dispatcher, writer,
+                         world=game.world, fps=30, hash_interval=50)
+    for _ in range(ticks):
+        loop._run_iteration(1 / 30)
+    loop.finish()
+    return game
+
+
+def test_replay_matches(tmp_path):
+    path = tmp_path / 'session.acrl'
+    recorded = record(path)
+    final_hash = state_hash(recorded.world)
+    log = read_log(str(path))
+    assert len(log) == TICKS
+    assert sorted(log.hashes) == [50, 100, 150, 200]
+    game = replay(log)
+    assert state_hash(game.world) == final_hash
+
+
+def test_truncated_log(tmp_path):
+    path = tmp_path / 'session.acrl'
+    record(path)
+    data = path.read_bytes()
+    full = read_log(str(path))
+    # Cut the final hash record in half
+    path.write_bytes(data[:-HASH_SIZE // 2])
+    log = read_log(str(path))
+    assert len(log) == len(full)
+    assert sorted(log.hashes) == [50, 100, 150]
+    # Drop the final hash record, and the last key of the final tick
+    path.write_bytes(data[:-(1 + 4 + HASH_SIZE) - 1])
+    log = read_log(str(path))
+    assert log.ticks == full.ticks[:-1]
+    assert sorted(log.hashes) == [50, 100, 150]
+    replay(log)
+
+
+def test_tampered_hash(tmp_path):
+    path = tmp_path / 'session.acrl'
+    record(path)
+    log = read_log(str(path))
+    log.hashes[100] = bytes(x ^ 0xff for x in log.hashes[100])
+    with pytest.raises(DesyncError) as e:
+        replay(log)
+    assert e.value.tick == 100
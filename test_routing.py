@@ -0,0 +1,73 @@
+"""
+Checks for RoutingDispatcher.
+
+Run with ``python -m pytest test_routing.py``.
+"""
+
+from bear_hug.event import BearEvent
+
+from routing import RoutingDispatcher, route_to_first
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, event):
+        self.events.append(event.event_value)
+
+
+def make_dispatcher():
+    dispatcher = RoutingDispatcher()
+    dispatcher.register_event_type('ac_damage', route=route_to_first)
+    return dispatcher
+
+
+def test_routed_event_reaches_only_the_address():
+    dispatcher = make_dispatcher()
+    tank, wall, logger = Recorder(), Recorder(), Recorder()
+    dispatcher.register_routed_listener(tank, 'ac_damage', 'tank')
+    dispatcher.register_routed_listener(wall, 'ac_damage', 'wall')
+    dispatcher.register_listener(logger, 'ac_damage')
+    dispatcher.add_event(BearEvent('ac_damage', ('tank', 1)))
+    dispatcher.add_event(BearEvent('ac_damage', ('nobody', 2)))
+    dispatcher.dispatch_events()
+    assert tank.events == [('tank', 1)]
+    assert wall.events == []
+    # Regular listeners still get everything
+    assert logger.events == [('tank', 1), ('nobody', 2)]
+
+
+def test_collisions_reach_both_entities():
+    dispatcher = make_dispatcher()
+    tank, wall, bystander = Recorder(), Recorder(), Recorder()
+    for listener, address in ((tank, 'tank'), (wall, 'wall'),
+                              (bystander, 'bystander')):
+        dispatcher.register_routed_listener(listener, 'ecs_collision',
+                                            address)
+    dispatcher.add_event(BearEvent('ecs_collision', ('tank', 'wall')))
+    dispatcher.dispatch_events()
+    assert tank.events == wall.events == [('tank', 'wall')]
+    assert bystander.events == []
+
+
+def test_unregistered_listener_gets_nothing():
+    dispatcher = make_dispatcher()
+    tank = Recorder()
+    dispatcher.register_routed_listener(tank, 'ac_damage', 'tank')
+    dispatcher.unregister_listener(tank)
+    dispatcher.add_event(BearEvent('ac_damage', ('tank', 1)))
+    dispatcher.dispatch_events()
+    assert tank.events == []
+    assert dispatcher.routed_listeners['ac_damage'] == {}
+
+
+def test_deferred_after_the_queue():
+    dispatcher = make_dispatcher()
+    logger = Recorder()
+    dispatcher.register_listener(logger, 'ac_damage')
+    dispatcher.defer(lambda: dispatcher.add_event(
+        BearEvent('ac_damage', ('late', 0))))
+    dispatcher.add_event(BearEvent('ac_damage', ('early', 0)))
+    dispatcher.dispatch_events()
+    assert logger.events == [('early', 0), ('late', 0)]
@@ -0,0 +1,88 @@
+"""
+Checks for snapshots, deltas and History.
+
+Run with ``python -m pytest test_snapshot.py``.
+"""
+
+import pytest
+
+from headless import HeadlessGame
+from replay import state_hash
+from snapshot import Snapshotter, Snapshot, Delta, History
+
+
+def keys(tick):
+    if tick % 60 < 30:
+        return ['TK_W'] if tick % 3 else ['TK_SPACE']
+    return ['TK_D']
+
+
+def make_game(**kwargs):
+    game = HeadlessGame(seed=5, enemies=6, input_script=keys, **kwargs)
+    return game, Snapshotter(game.dispatcher, game.atlas, game.world)
+
+
+def hashes(game, ticks, step=10):
+    r = []
+    for _ in range(ticks // step):
+        game.run(ticks=step)
+        r.append(state_hash(game.world))
+    return r
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compact_storage': True},
+                                    {'batched_ai': True}])
+def test_restore_replays_the_same(kwargs):
+    game, snapshotter = make_game(**kwargs)
+    game.run(ticks=120)
+    snapshot = snapshotter.capture()
+    tick_count = game.terminal.tick_count
+    expected = hashes(game, 150)
+    snapshotter.restore(snapshot)
+    game.terminal.tick_count = tick_count
+    assert hashes(game, 150) == expected
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compact_storage': True}])
+def test_restore_into_fresh_game(kwargs):
+    game, snapshotter = make_game(**kwargs)
+    game.run(ticks=120)
+    snapshot = snapshotter.capture()
+    tick_count = game.terminal.tick_count
+    expected = hashes(game, 150)
+    game, snapshotter = make_game(**kwargs)
+    snapshotter.restore(snapshot)
+    game.terminal.tick_count = tick_count
+    assert hashes(game, 150) == expected
+
+
+def test_diff_apply():
+    game, snapshotter = make_game()
+    game.run(ticks=60)
+    old = snapshotter.capture()
+    game.run(ticks=20)
+    new = snapshotter.capture()
+    delta = old.diff(new)
+    assert old.apply(delta).to_bytes() == new.to_bytes()
+    data = delta.to_bytes()
+    assert Delta.from_bytes(data).to_bytes() == data
+    assert old.apply(Delta.from_bytes(data)).to_bytes() == new.to_bytes()
+    assert Snapshot.from_bytes(new.to_bytes()).to_bytes() == new.to_bytes()
+    with pytest.raises(ValueError):
+        Snapshot.from_bytes(data)
+
+
+def test_rewind_drops_the_future():
+    game, snapshotter = make_game()
+    history = History(snapshotter, length=100, keyframe_interval=10)
+    game.dispatcher.register_listener(history, 'service')
+    game.run(ticks=45)
+    assert len(history) == 45
+    past = history.get(12).to_bytes()
+    history.rewind(12)
+    assert len(history) == 33
+    assert history.get(0).to_bytes() == past
+    assert snapshotter.capture().to_bytes() == past
+    # Recording goes on from the restored state
+    game.run(ticks=5)
+    assert len(history) == 38
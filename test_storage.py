@@ -0,0 +1,49 @@
+"""
+Checks for CompactStorage and the compact components.
+
+Run with ``python -m pytest test_storage.py``.
+"""
+
+from json import loads
+
+import pytest
+
+from bear_hug.ecs import deserialize_component, PositionComponent
+
+from entities import CompactDestructorHealthComponent, \
+    CompactVisualDamageHealthComponent, DestructorHealthComponent, \
+    VisualDamageHealthComponent
+from routing import RoutingDispatcher
+from storage import CompactStorage, CompactPositionComponent
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = RoutingDispatcher()
+    dispatcher.register_event_type('ac_damage')
+    return dispatcher
+
+
+@pytest.mark.parametrize('compact_class, regular_class, kwargs', [
+    (CompactDestructorHealthComponent, DestructorHealthComponent,
+     {'hitpoints': 5}),
+    (CompactVisualDamageHealthComponent, VisualDamageHealthComponent,
+     {'hitpoints': 3, 'widgets_dict': {3: 'wall_3', 1: 'wall_1'}}),
+    (CompactPositionComponent, PositionComponent,
+     {'x': 12, 'y': 34, 'vx': 0, 'vy': -20})])
+def test_repr_round_trip(dispatcher, compact_class, regular_class, kwargs):
+    component = compact_class(dispatcher, storage=CompactStorage(), **kwargs)
+    serial = repr(component)
+    assert loads(serial)['class'] == regular_class.__name__
+    restored = deserialize_component(serial, dispatcher)
+    assert type(restored) is regular_class
+    assert loads(repr(restored)) == loads(serial)
+
+
+def test_slot_released(dispatcher):
+    storage = CompactStorage()
+    component = CompactPositionComponent(dispatcher, 1, 2, storage=storage)
+    assert len(storage.positions) == 1
+    component.release_slot()
+    component.release_slot()
+    assert len(storage.positions) == 0
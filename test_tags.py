@@ -0,0 +1,68 @@
+"""
+Checks for EntityIndex.
+
+Run with ``python -m pytest test_tags.py``.
+"""
+
+from bear_hug.ecs import Entity, PositionComponent
+from bear_hug.event import BearEvent
+
+from routing import RoutingDispatcher
+from tags import Tag, EntityIndex
+
+
+def make_entity(dispatcher, entity_id, tags):
+    entity = Entity(entity_id)
+    entity.tags = tags
+    entity.add_component(PositionComponent(dispatcher, 1, 2))
+    return entity
+
+
+def test_add_and_destroy():
+    dispatcher = RoutingDispatcher()
+    index = EntityIndex()
+    index.clear()
+    index.on_event(BearEvent('ecs_create', make_entity(dispatcher, 'wall',
+                                                       Tag.WALL)))
+    tank = make_entity(dispatcher, 'enemy', Tag.ENEMY_TANK)
+    index.on_event(BearEvent('ecs_create', tank))
+    assert index.tagged(Tag.ENEMY_TANK) == {'enemy'}
+    assert index.tagged(Tag.ENEMY) == {'enemy'}
+    assert index.tagged(Tag.WALL) == {'wall'}
+    assert index.tagged(Tag.ENEMY | Tag.WALL) == set()
+    assert index.with_component('position') == {'wall', 'enemy'}
+    assert index.is_a('enemy', Tag.TANK)
+    assert not index.is_a('enemy', Tag.PLAYER)
+
+    index.on_event(BearEvent('ecs_destroy', 'enemy'))
+    assert index.tagged(Tag.ENEMY_TANK) == set()
+    assert index.tagged(Tag.ENEMY) == set()
+    assert index.with_component('position') == {'wall'}
+    assert not index.has_component('enemy', 'position')
+    # Still known until the end of the tick
+    assert index.tags_of('enemy') == Tag.ENEMY_TANK
+    assert index.is_a('enemy', Tag.ENEMY)
+    index.on_event(BearEvent('service', 'tick_over'))
+    assert index.tags_of('enemy') == Tag.NONE
+    assert not index.is_a('enemy', Tag.ENEMY)
+    assert index.tags_of('wall') == Tag.WALL
+
+    # Same ID comes back, eg a pooled bullet or a restored snapshot
+    index.on_event(BearEvent('ecs_create', tank))
+    assert index.tagged(Tag.ENEMY_TANK) == {'enemy'}
+    assert index.has_component('enemy', 'position')
+
+
+def test_destroyed_and_created_in_one_tick():
+    dispatcher = RoutingDispatcher()
+    index = EntityIndex()
+    index.clear()
+    bullet = make_entity(dispatcher, 'bullet_0', Tag.PLAYER_BULLET)
+    index.on_event(BearEvent('ecs_create', bullet))
+    index.on_event(BearEvent('ecs_destroy', 'bullet_0'))
+    bullet.tags = Tag.ENEMY_BULLET
+    index.on_event(BearEvent('ecs_create', bullet))
+    index.on_event(BearEvent('service', 'tick_over'))
+    assert index.tags_of('bullet_0') == Tag.ENEMY_BULLET
+    assert index.tagged(Tag.ENEMY_BULLET) == {'bullet_0'}
+    assert index.tagged(Tag.PLAYER_BULLET) == set()
@@ -0,0 +1,175 @@
+"""
+Fixed-timestep loop.
+
+BearLoop runs a single tick per iteration and reports the time that has
+actually passed since the previous one. When the machine is loaded, ticks get
+longer, and everything in the game gets coarser with them: bullets, which
+move by ``vx * dt`` chars per tick, jump over tanks, and tanks stutter.
+
+FixedStepLoop keeps the simulation at exactly ``fps`` ticks of ``1/fps``
+seconds each. If it falls behind, it runs several ticks in a row to catch up,
+without rendering in between. Rendering happens after the simulation, at a
+rate that is reduced automatically when drawing a frame does not fit into
+the frame budget. The simulation itself only slows down if it alone can't
+keep up.
+"""
+
+from bear_hug.bear_hug import BearLoop
+from bear_hug.event import BearEvent
+
+import math
+import sys
+import time
+
+
+class FixedStepLoop(BearLoop):
+    """
+    A BearLoop with a fixed simulation timestep and adaptive frame skipping.
+
+    Every simulation step is a normal bear_hug tick ('tick' with a value of
+    exactly ``1/fps``, then 'service' 'tick_over'), except that the terminal
+    is not refreshed. Every tick that is not followed by a refresh is a
+    skipped frame. The loop renders (refreshes the terminal and tells the
+    ``layouts`` to draw their frames) once every ``render_interval`` ticks,
+    and picks the interval as the smallest one where the average step time
+    plus the average render time spread over the interval fits into the
+    frame budget (that is, ``1/fps``). It never skips more than
+    ``max_skip`` frames in a row.
+
+    If the simulation is more than ``max_steps`` ticks behind, the extra time
+    is dropped: the game slows down instead of trying to catch up forever.
+
+    Telemetry, all times in seconds:
+
+    ``steps``, ``frames`` and ``skipped_frames`` are the numbers of ticks
+    simulated, frames rendered and frames skipped.
+
+    ``lag`` is how far the simulation is behind the wall clock, and
+    ``max_lag`` the largest lag seen. ``dropped_time`` is the total time
+    dropped because of ``max_steps``.
+
+    ``step_time`` and ``render_time`` are moving averages of the time taken
+    by a tick and by a frame.
+
+    :param layouts: DirtyRectLayouts to draw at render time only. They are
+    switched to deferred mode. Other widgets draw themselves as usual, but
+    are only put on screen when the terminal is refreshed.
+
+    :param max_steps: maximum number of ticks to run in a row.
+
+    :param max_skip: maximum number of frames to skip in a row.
+    """
+    def __init__(self, terminal, queue, fps=30, layouts=(), max_steps=5,
+                 max_skip=5, **kwargs):
+        super().__init__(terminal, queue, fps=fps, **kwargs)
+        self.layouts = []
+        for layout in layouts:
+            self.add_layout(layout)
+        self.max_steps = max_steps
+        self.max_skip = max_skip
+        self.render_interval = 1
+        # Telemetry
+        self.steps = 0
+        self.frames = 0
+        self.skipped_frames = 0
+        self.lag = 0
+        self.max_lag = 0
+        self.dropped_time = 0
+        self.step_time = 0
+        self.render_time = 0
+
+    def run(self):
+        """
+        Start a loop.
+
+        It would run until stopped with ``self.stop()``
+        """
+        self.last_time = time.perf_counter()
+        # Ticks since the latest frame
+        pending = 0
+        while not self.stopped:
+            now = time.perf_counter()
+            self.lag += now - self.last_time
+            self.last_time = now
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.lag > self.max_steps * self.frame_time:
+                self.dropped_time += self.lag - \
+                    self.max_steps * self.frame_time
+                self.lag = self.max_steps * self.frame_time
+            # Catching up, but not for longer than max_skip frames
+            while self.lag >= self.frame_time and \
+                    pending <= self.max_skip and not self.stopped:
+                start = time.perf_counter()
+                self._simulate(self.frame_time)
+                self._update_average('step_time',
+                                     time.perf_counter() - start)
+                self.lag -= self.frame_time
+                self.steps += 1
+                pending += 1
+            if pending >= self.render_interval:
+                start = time.perf_counter()
+                self.render()
+                self._update_average('render_time',
+                                     time.perf_counter() - start)
+                self.skipped_frames += pending - 1
+                pending = 0
+                self._adapt()
+            # Anything that's left for the next tick is waited for
+            sleep_time = self.frame_time - self.lag - \
+                (time.perf_counter() - self.last_time)
+            if sleep_time > 0.05 * self.frame_time:
+                time.sleep(sleep_time)
+        self.terminal.close()
+
+    def _simulate(self, time_since_last_tick):
+        # Same as BearLoop._run_iteration, minus the refresh
+        for event in self.terminal.check_input():
+            self.queue.add_event(event)
+        self.queue.add_event(BearEvent(event_type='tick',
+                                       event_value=time_since_last_tick))
+        self.queue.dispatch_events()
+        self.queue.add_event(BearEvent(event_type='service',
+                                       event_value='tick_over'))
+        self.queue.dispatch_events()
+
+    def add_layout(self, layout):
+        """
+        Draw a DirtyRectLayout at render time only
+        """
+        layout.deferred = True
+        self.layouts.append(layout)
+
+    def render(self):
+        """
+        Draw the deferred layouts and put everything on screen
+        """
+        for layout in self.layouts:
+            layout.draw_frame()
+        self.terminal.refresh()
+        self.frames += 1
+
+    def _update_average(self, name, value):
+        # Exponential moving average, that starts with the first value
+        average = getattr(self, name)
+        setattr(self, name, value if not average
+                else average * 0.9 + value * 0.1)
+
+    def _adapt(self):
+        spare = self.frame_time - self.step_time
+        if spare <= 0:
+            # The simulation alone takes the whole budget
+            self.render_interval = self.max_skip + 1
+        else:
+            self.render_interval = max(1, min(
+                math.ceil(self.render_time / spare), self.max_skip + 1))
+
+    def dump(self, file=sys.stderr):
+        """
+        Print the telemetry
+        """
+        print(f'{self.steps} ticks, {self.frames} frames rendered, '
+              f'{self.skipped_frames} skipped; render interval '
+              f'{self.render_interval}; {self.step_time * 1000:.2f} ms per '
+              f'tick, {self.render_time * 1000:.2f} ms per frame; max lag '
+              f'{self.max_lag * 1000:.0f} ms, {self.dropped_time:.2f} s '
+              f'dropped', file=file)
@@ -0,0 +1,310 @@
+"""
+Game world setup.
+
+Everything that goes onto the map (the layout, the tanks and walls, the
+spawner) and the sidebar listeners is created here, so that both the windowed
+game and the headless runner build exactly the same world.
+"""
+
+from bear_hug.bear_utilities import copy_shape
+from bear_hug.widgets import Widget
+
+from chunks import ChunkedLayout, ChunkedWallLayer, ChunkManager
+from damage import DamageSystem
+from entities import create_player_tank, create_wall, create_spawner_house,\
+    BulletPool
+from level import Level, StaticWallLayer, load_level, random_level, \
+    wall_id, TILE_SIZE, DEFAULT_LEVEL
+from listeners import SpawnerListener, ScoreLabel, HPLabel, GameOverListener
+from pathfinding import FlowField
+from render import DirtyRectLayout
+from routing import RoutingDispatcher, route_nowhere
+from sight import LineOfSight
+from spatial import GridECSLayout
+from storage import CompactStorage
+from tags import EntityIndex
+
+
+# Map size of the default level in chars. The window is 91 chars wide; the
+# columns to the right of the map are used by the sidebar labels
+MAP_WIDTH = 84
+MAP_HEIGHT = 60
+
+# The default level (level1.json) as a wall array, 1 for wall and 0 for nothing
+WALL_ARRAY = load_level().walls
+
+
+class World:
+    """
+    A bunch of listeners and widgets that make up the game world.
+
+    The entities themselves are not stored here; they are available from the
+    EntityTracker, just like during the game.
+    """
+    def __init__(self, layout, spawner, score, hp, gameover, ai_system=None,
+                 bullet_pool=None, storage=None, static_walls=None,
+                 flow_field=None, line_of_sight=None, chunks=None,
+                 damage_system=None, players=1):
+        self.layout = layout
+        self.spawner = spawner
+        self.score = score
+        self.hp = hp
+        self.gameover = gameover
+        self.ai_system = ai_system
+        self.bullet_pool = bullet_pool
+        self.storage = storage
+        self.static_walls = static_walls
+        self.flow_field = flow_field
+        self.line_of_sight = line_of_sight
+        self.chunks = chunks
+        self.damage_system = damage_system
+        self.players = players
+
+    def add_widgets(self, terminal):
+        """
+        Place the layout and sidebar labels on a (started) terminal
+        """
+        terminal.add_widget(self.layout)
+        terminal.add_widget(self.score, pos=(85, 10))
+        terminal.add_widget(self.hp, pos=(85, 15))
+
+
+def build_world(dispatcher, atlas, terminal, level=None, wall_array=None,
+                player_pos=None, spawner_cooldown=5.0, enemies=3,
+                layout_class=DirtyRectLayout, batched_ai=False,
+                bullet_pool=True, compact_storage=False, static_walls=True,
+                controller_params=None, pathfinding=False,
+                line_of_sight=False, chunked=False, map_size=None,
+                chunk_size=16, batched_damage=False, players=1,
+                player2_pos=None, array_layout=False):
+    """
+    Create the layout, all the starting entities and the game listeners.
+
+    Expects the dispatcher to already have the EntityTracker subscribed and the
+    'ac_damage' event type registered (and 'ac_input', for two players). The
+    EntityIndex is cleared and subscribed here. Entities are not actually
+    created until the dispatcher processes the queued 'ecs_create' events.
+
+    :param dispatcher: BearEventDispatcher
+
+    :param atlas: Atlas with battlecity images
+
+    :param terminal: BearTerminal for the sidebar and GAME OVER widgets
+
+    :param level: a Level or a path to level file. Defaults to level1.json
+
+    :param wall_array: a 2-nested list of tiles, 1 for wall and 0 for nothing.
+    If set, it is used instead of the level's walls.
+
+    :param player_pos: player's starting position. Defaults to the level's one.
+
+    :param layout_class: ECSLayout or its subclass to use for the map
+
+    :param batched_ai: if True, enemies are controlled by a single
+    EnemyAISystem instead of a ControllerComponent each. Requires NumPy.
+    The system makes its random choices with a NumPy generator seeded from
+    the global RNG, so a given seed is still reproducible within either mode,
+    but plays out differently in the two: the enemies behave the same only
+    statistically. Benchmarks and replays should compare runs in the same
+    mode.
+
+    :param bullet_pool: if True, all tanks take their bullets from a shared
+    BulletPool instead of creating a new entity for every shot.
+
+    :param compact_storage: if True, positions and hitpoints of all entities
+    are stored in a shared CompactStorage.
+
+    :param static_walls: if True and the layout is a GridECSLayout, walls are
+    drawn on a StaticWallLayer and only become entities when hit.
+
+    :param controller_params: a dict of kwargs for enemy controllers, such as
+    ``move_delay``, ``shoot_delay`` or ``weight_distance``.
+
+    :param pathfinding: if True, enemies find their way to the player along a
+    shared FlowField.
+
+    :param line_of_sight: if True, enemies don't shoot at the player through
+    walls, as told by a shared LineOfSight index.
+
+    :param chunked: if True, the map can be larger than the screen. The
+    layout is a ChunkedLayout of the screen size (or less), which follows the
+    player, and only the entities near the player are simulated, as told by a
+    ChunkManager. Walls are always static. Batched AI and pathfinding are not
+    supported.
+
+    :param map_size: if set, the level is generated by ``random_level``, using
+    the global RNG, with this many tiles (width, height).
+
+    :param chunk_size: ChunkManager chunk size, in tiles
+
+    :param batched_damage: if True, hits are collected by a DamageSystem and
+    applied once per tick, and the labels, the spawner and the GAME OVER
+    listener learn about the damage from its 'ac_damage_resolved' instead of
+    every 'ac_damage' and 'ecs_destroy'. Requires a RoutingDispatcher.
+
+    :param players: 1 or 2. The second player's tank is called 'player2';
+    enemies still only hunt the first one, and the labels and GAME OVER are
+    about the first one too. With two players, both tanks take their keys
+    from routed 'ac_input' events (see netplay.py) instead of the terminal.
+    Chunked maps are single player only.
+
+    :param player2_pos: second player's starting position. Defaults to three
+    tiles to the right of the first player.
+
+    :param array_layout: if True, the map is an ArrayLayout, which composites
+    it in NumPy arrays, instead of ``layout_class``. Requires NumPy and a
+    terminal that supports it. Not supported on chunked maps.
+
+    :returns: World instance
+    """
+    if chunked and (batched_ai or pathfinding):
+        raise ValueError('Chunked maps support neither batched AI nor '
+                         'pathfinding')
+    if players not in (1, 2):
+        raise ValueError('There should be one or two players')
+    if chunked and players > 1:
+        raise ValueError('Chunked maps are single player only')
+    if chunked and array_layout:
+        raise ValueError('Chunked maps do not support the array layout')
+    if array_layout:
+        from buffers import ArrayLayout
+        layout_class = ArrayLayout
+    if batched_damage and not isinstance(dispatcher, RoutingDispatcher):
+        raise ValueError('Batched damage requires a RoutingDispatcher')
+    if map_size:
+        level = random_level(*map_size)
+    elif level is None or isinstance(level, str):
+        level = load_level(level or DEFAULT_LEVEL)
+    if wall_array is not None:
+        level = Level(wall_array, player_pos=level.player_pos,
+                      spawner_pos=level.spawner_pos)
+    if player_pos is None:
+        player_pos = level.player_pos
+    # Setting the level layout and its background.
+    map_width = level.width * TILE_SIZE
+    map_height = level.height * TILE_SIZE
+    if chunked:
+        # Only what is on screen
+        chars = [[' ' for x in range(min(map_width, MAP_WIDTH))]
+                 for y in range(min(map_height, MAP_HEIGHT))]
+        colors = copy_shape(chars, 'gray')
+        if not issubclass(layout_class, ChunkedLayout):
+            layout_class = ChunkedLayout
+        layout = layout_class(chars, colors,
+                              map_size=(map_width, map_height))
+    else:
+        chars = [[' ' for x in range(map_width)] for y in range(map_height)]
+        colors = copy_shape(chars, 'gray')
+        layout = layout_class(chars, colors)
+    # The index goes first, so that other listeners can look up the entities
+    # they are told about
+    index = EntityIndex()
+    index.clear()
+    dispatcher.register_listener(index,
+                                 ['ecs_create', 'ecs_destroy', 'service'])
+    if batched_damage:
+        # Health components don't get the hits; the DamageSystem applies them
+        dispatcher.add_route('ac_damage', route_nowhere)
+        if 'ac_damage_resolved' not in dispatcher.event_types:
+            dispatcher.register_event_type('ac_damage_resolved')
+        damage_system = DamageSystem(dispatcher=dispatcher)
+        dispatcher.register_listener(damage_system, 'ac_damage')
+        # These are told about the damage and kills once per tick
+        destroy_events = 'ac_damage_resolved'
+        damage_events = 'ac_damage_resolved'
+    else:
+        damage_system = None
+        destroy_events = 'ecs_destroy'
+        damage_events = 'ac_damage'
+    # Subscribing the layout to all events that have 'ecs' as a part of their
+    # event_type
+    dispatcher.register_listener(layout, 'all')
+    # Creating in-game entities
+    storage = CompactStorage() if compact_storage else None
+    bullet_pool = BulletPool(dispatcher, storage=storage) if bullet_pool \
+        else None
+    create_player_tank(dispatcher, atlas, *player_pos, bullet_pool=bullet_pool,
+                       storage=storage, networked=players > 1)
+    if players > 1:
+        if player2_pos is None:
+            player2_pos = (player_pos[0] + 3 * TILE_SIZE, player_pos[1])
+        create_player_tank(dispatcher, atlas, *player2_pos,
+                           bullet_pool=bullet_pool, storage=storage,
+                           entity_id='player2', networked=True)
+    if chunked:
+        # Untouched walls are only drawn when they are in view
+        static_walls = ChunkedWallLayer(dispatcher, atlas, layout, level.walls,
+                                        storage=storage)
+        layout.static_layer = static_walls
+    elif static_walls and isinstance(layout, GridECSLayout):
+        # Walls are drawn on the background and become entities when hit
+        static_walls = StaticWallLayer(dispatcher, atlas, layout, level.walls,
+                                       storage=storage)
+        layout.static_layer = static_walls
+    else:
+        static_walls = None
+        for y in range(level.height):
+            for x in range(level.width):
+                if level.walls[y][x] == 1:
+                    create_wall(dispatcher, atlas, wall_id(x, y),
+                                x*TILE_SIZE, y*TILE_SIZE, storage=storage)
+    # Spawner house is just an image. It doesn't even collide.
+    spawner_x, spawner_y = level.spawner_pos
+    create_spawner_house(dispatcher, atlas, spawner_x, spawner_y,
+                         storage=storage)
+    if pathfinding:
+        # A single field for all enemies, following the player and the walls
+        flow_field = FlowField(walls=level.walls, target=player_pos)
+        dispatcher.register_listener(flow_field, ['ecs_move', 'ecs_destroy'])
+        controller_params = dict(controller_params or {},
+                                 flow_field=flow_field)
+    else:
+        flow_field = None
+    if line_of_sight:
+        line_of_sight = LineOfSight(walls=level.walls)
+        dispatcher.register_listener(line_of_sight,
+                                     ['ecs_create', 'ecs_destroy'])
+        controller_params = dict(controller_params or {},
+                                 line_of_sight=line_of_sight)
+    else:
+        line_of_sight = None
+    if chunked:
+        chunks = ChunkManager(dispatcher=dispatcher, chunk_size=chunk_size)
+        dispatcher.register_listener(chunks, ['ecs_add', 'ecs_move',
+                                              'ecs_destroy', 'service'])
+    else:
+        chunks = None
+    if batched_ai:
+        from ai import EnemyAISystem
+        ai_system = EnemyAISystem()
+    else:
+        ai_system = None
+    # Actual spawning is done by this invisible listener:
+    spawner = SpawnerListener(dispatcher=dispatcher,
+                              atlas=atlas,
+                              x=spawner_x + 1, y=spawner_y + 1,
+                              cooldown=spawner_cooldown,
+                              enemies=enemies,
+                              ai_system=ai_system,
+                              bullet_pool=bullet_pool,
+                              storage=storage,
+                              controller_params=controller_params)
+    dispatcher.register_listener(spawner, ['tick', destroy_events])
+    if ai_system:
+        # After the spawner, so that new enemies get the tick they spawned on
+        dispatcher.register_listener(ai_system, ['tick', 'ecs_destroy'])
+    # These two are sidebar widgets, which can accept the events but are
+    # outside the ECSLayout (ie game map). They are redrawn on 'tick_over'
+    score = ScoreLabel(terminal)
+    dispatcher.register_listener(score, [destroy_events, 'service'])
+    hp = HPLabel(terminal)
+    dispatcher.register_listener(hp, [damage_events, 'service'])
+    # And this listener should display the GAME OVER widget
+    gameover_widget = Widget(*atlas.get_element('game_over'))
+    gameover = GameOverListener(terminal, widget=gameover_widget)
+    dispatcher.register_listener(gameover, destroy_events)
+    return World(layout, spawner, score, hp, gameover, ai_system=ai_system,
+                 bullet_pool=bullet_pool, storage=storage,
+                 static_walls=static_walls, flow_field=flow_field,
+                 line_of_sight=line_of_sight, chunks=chunks,
+                 damage_system=damage_system, players=players)